@@ -0,0 +1,548 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the dataset managers against a local stand-in for the CKAN
+action API with configurable latency and bandwidth
+
+    python benchmark.py --ensembles 52 --file-size 2000000 --latency 0.05 --output results.json
+"""
+import argparse
+import BaseHTTPServer
+import cgi
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import re
+from shutil import rmtree
+import SocketServer
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+from dataset_manager import (ECMWFRAPIDDatasetManager,
+                             MetricsRegistry,
+                             RAPIDInputDatasetManager,
+                             RequestGovernor,
+                             WRFHydroHRRRDatasetManager)
+
+#------------------------------------------------------------------------------
+#Fake CKAN Server
+#------------------------------------------------------------------------------
+class FakeCKANState(object):
+    """
+    In memory datasets, resources and files of the fake CKAN server
+    """
+    def __init__(self, latency=0, bandwidth=0):
+        self.latency = latency
+        #bytes per second for each transfer, 0 for unlimited
+        self.bandwidth = bandwidth
+        self.datasets = {}
+        self.files = {}
+        self.request_counts = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        #number of the next file downloads that close the connection
+        #halfway or send a changed byte, to test recovery
+        self.truncate_downloads = 0
+        self.corrupt_downloads = 0
+        #actions that always fail with a server error
+        self.failed_actions = set()
+        #answer chunked uploads with 411 Length Required like servers without chunked support
+        self.reject_chunked = False
+        self.lock = threading.Lock()
+
+    def count_request(self, action):
+        with self.lock:
+            self.request_counts[action] = self.request_counts.get(action, 0) + 1
+
+    def take_fault(self, fault_name):
+        """
+        Returns True and counts down if the next download should have the fault
+        """
+        with self.lock:
+            if getattr(self, fault_name) > 0:
+                setattr(self, fault_name, getattr(self, fault_name) - 1)
+                return True
+        return False
+
+    def reset_counts(self):
+        with self.lock:
+            self.request_counts = {}
+            self.bytes_received = 0
+            self.bytes_sent = 0
+
+    def find_dataset(self, dataset_id):
+        for dataset in self.datasets.values():
+            if dataset_id in (dataset['id'], dataset['name']):
+                return dataset
+        raise KeyError("Dataset %s not found" % dataset_id)
+
+class FakeCKANRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles the CKAN action API calls used by the dataset managers and
+    resource file downloads
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    chunk_size = 64*1024
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def throttle(self, start_time, transferred):
+        if self.state.bandwidth:
+            delay = transferred/float(self.state.bandwidth) - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+    def read_body(self, output_file):
+        start_time = time.time()
+        transferred = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_length = int(self.rfile.readline().strip().split(';')[0], 16)
+                if chunk_length == 0:
+                    self.rfile.readline()
+                    break
+                output_file.write(self.rfile.read(chunk_length))
+                self.rfile.readline()
+                transferred += chunk_length
+                self.throttle(start_time, transferred)
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining:
+                chunk = self.rfile.read(min(remaining, self.chunk_size))
+                if not chunk:
+                    break
+                output_file.write(chunk)
+                remaining -= len(chunk)
+                transferred += len(chunk)
+                self.throttle(start_time, transferred)
+        with self.state.lock:
+            self.state.bytes_received += transferred
+        return transferred
+
+    def send_json(self, response_dict, status=200):
+        body = json.dumps(response_dict)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_file(head=True)
+
+    def do_GET(self):
+        self.send_file()
+
+    def send_file(self, head=False):
+        file_match = re.match(r'/files/([\w-]+)', self.path)
+        data = self.state.files.get(file_match.group(1)) if file_match else None
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.state.count_request('download')
+        start, end = 0, len(data) - 1
+        range_match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if range_match:
+            if not range_match.group(1):
+                start = max(0, len(data) - int(range_match.group(2)))
+            else:
+                start = int(range_match.group(1))
+                if range_match.group(2):
+                    end = min(end, int(range_match.group(2)))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % len(data))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if head:
+            return
+        if self.state.take_fault('truncate_downloads'):
+            #close the connection cleanly after half of the body
+            end = start + (end - start + 1)//2 - 1
+            self.close_connection = 1
+        elif self.state.take_fault('corrupt_downloads'):
+            data = data[:start] + chr(ord(data[start]) ^ 0xff) + data[start + 1:]
+        start_time = time.time()
+        for offset in range(start, end + 1, self.chunk_size):
+            chunk = data[offset:min(offset + self.chunk_size, end + 1)]
+            self.wfile.write(chunk)
+            self.throttle(start_time, offset + len(chunk) - start)
+        with self.state.lock:
+            self.state.bytes_sent += end - start + 1
+
+    def do_POST(self):
+        action = self.path.rstrip('/').split('/')[-1]
+        self.state.count_request(action)
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        upload = None
+        content_type = self.headers.get('Content-Type', '')
+        if self.state.reject_chunked and \
+                self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            self.read_body(tempfile.TemporaryFile())
+            self.send_json({'success': False, 'error': {'message': 'Length Required'}}, status=411)
+            return
+        if content_type.startswith('multipart/form-data'):
+            request_file = tempfile.TemporaryFile()
+            content_length = self.read_body(request_file)
+            request_file.seek(0)
+            form = cgi.FieldStorage(fp=request_file,
+                                    environ={'REQUEST_METHOD': 'POST',
+                                             'CONTENT_TYPE': content_type,
+                                             'CONTENT_LENGTH': str(content_length)},
+                                    keep_blank_values=True)
+            params = {}
+            for key in form.keys():
+                if key == 'upload':
+                    upload = form[key].file.read()
+                else:
+                    params[key] = form.getvalue(key)
+        else:
+            request_file = tempfile.TemporaryFile()
+            self.read_body(request_file)
+            request_file.seek(0)
+            params = json.loads(request_file.read() or '{}')
+
+        if action in self.state.failed_actions:
+            self.send_json({'success': False, 'error': {'message': 'Internal server error'}}, 500)
+            return
+        action_function = getattr(self, 'action_%s' % action, None)
+        if action_function is None:
+            self.send_json({'success': False, 'error': {'message': 'Unknown action %s' % action}}, 400)
+            return
+        try:
+            self.send_json({'success': True, 'result': action_function(params, upload)})
+        except KeyError, ex:
+            self.send_json({'success': False, 'error': {'message': str(ex)}}, 409)
+
+    def action_package_search(self, params, upload):
+        query = params.get('q', '')
+        query_terms = query if isinstance(query, list) else [query]
+        with self.state.lock:
+            datasets = []
+            for dataset in self.state.datasets.values():
+                matches = True
+                for query_term in query_terms:
+                    if ':' in query_term:
+                        field, value = query_term.split(':', 1)
+                        matches = matches and fnmatch.fnmatch(unicode(dataset.get(field, '')), value)
+                if matches:
+                    datasets.append(json.loads(json.dumps(dataset)))
+        datasets.sort(key=lambda dataset: dataset['name'], reverse=True)
+        if params.get('fl'):
+            fields = params['fl'].split(',')
+            datasets = [dict((key, dataset[key]) for key in fields if key in dataset) \
+                        for dataset in datasets]
+        return {'count': len(datasets), 'results': datasets[:int(params.get('rows', 10))]}
+
+    def action_package_show(self, params, upload):
+        with self.state.lock:
+            return json.loads(json.dumps(self.state.find_dataset(params['id'])))
+
+    def action_package_create(self, params, upload):
+        with self.state.lock:
+            if any(dataset['name'] == params['name'] for dataset in self.state.datasets.values()):
+                raise KeyError("Dataset %s already exists" % params['name'])
+            dataset = dict(params)
+            dataset.update({'id': str(uuid.uuid4()),
+                            'resources': [],
+                            'num_resources': 0,
+                            'metadata_modified': datetime.datetime.utcnow().isoformat()})
+            self.state.datasets[dataset['id']] = dataset
+            return dataset
+
+    def action_resource_create(self, params, upload):
+        with self.state.lock:
+            dataset = self.state.find_dataset(params['package_id'])
+            resource = dict(params)
+            resource['id'] = str(uuid.uuid4())
+            resource['created'] = datetime.datetime.utcnow().isoformat()
+            if upload is not None:
+                self.state.files[resource['id']] = upload
+                resource['url'] = 'http://%s/files/%s' % (self.headers.get('Host'), resource['id'])
+            dataset['resources'].append(resource)
+            dataset['num_resources'] = len(dataset['resources'])
+            dataset['metadata_modified'] = resource['created']
+            return resource
+
+    def action_resource_delete(self, params, upload):
+        with self.state.lock:
+            for dataset in self.state.datasets.values():
+                for resource in dataset['resources']:
+                    if resource['id'] == params['id']:
+                        dataset['resources'].remove(resource)
+                        dataset['num_resources'] = len(dataset['resources'])
+                        dataset['metadata_modified'] = datetime.datetime.utcnow().isoformat()
+                        self.state.files.pop(resource['id'], None)
+                        return None
+        raise KeyError("Resource %s not found" % params['id'])
+
+    def action_resource_search(self, params, upload):
+        field, value = params['query'].split(':', 1)
+        with self.state.lock:
+            resources = [resource for dataset in self.state.datasets.values() \
+                         for resource in dataset['resources'] if resource.get(field) == value]
+        return {'count': len(resources), 'results': resources}
+
+class FakeCKANServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded local stand-in for a CKAN server
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0, bandwidth=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), FakeCKANRequestHandler)
+        self.state = FakeCKANState(latency, bandwidth)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        server_thread = threading.Thread(target=self.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        return self
+
+#------------------------------------------------------------------------------
+#Synthetic Data
+#------------------------------------------------------------------------------
+def write_synthetic_file(file_path, file_size):
+    """
+    Writes a file that compresses about as well as a NetCDF3 Qout file
+    """
+    block = os.urandom(256) + '\0'*768
+    with open(file_path, 'wb') as synthetic_file:
+        for offset in range(0, file_size, len(block)):
+            synthetic_file.write(block[:file_size - offset])
+
+def get_recent_ecmwf_date_string():
+    """
+    Returns the date string of an ECMWF run more than a day old so it is
+    downloaded whatever the number of ensembles
+    """
+    run_datetime = datetime.datetime.utcnow() - datetime.timedelta(hours=36)
+    return '%s.%s' % (run_datetime.strftime("%Y%m%d"), '1200' if run_datetime.hour > 11 else '0')
+
+def make_ecmwf_tree(source_directory, num_watersheds, num_subbasins, num_ensembles, file_size):
+    """
+    Creates watershed/date/Qout_<subbasin>_<ensemble>.nc files
+    """
+    date_string = get_recent_ecmwf_date_string()
+    for watershed_index in range(num_watersheds):
+        date_directory = os.path.join(source_directory, 'watershed_%s' % watershed_index, date_string)
+        os.makedirs(date_directory)
+        for subbasin_index in range(num_subbasins):
+            for ensemble_number in range(1, num_ensembles + 1):
+                write_synthetic_file(os.path.join(date_directory,
+                                                  'Qout_subbasin_%s_%s.nc' % (subbasin_index, ensemble_number)),
+                                     file_size)
+            for return_period in (2, 10, 20):
+                with open(os.path.join(date_directory, 'return_%s_points.txt' % return_period), 'w') as points:
+                    points.write('lat,lon,comid\n' * 100)
+    return date_string
+
+def make_wrf_hydro_file(source_directory, file_size):
+    """
+    Creates a RapidResult_<date>_CF.nc file for the previous hour
+    """
+    run_datetime = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    source_file = os.path.join(source_directory, 'RapidResult_%s_CF.nc' % run_datetime.strftime("%Y%m%dT%H00Z"))
+    write_synthetic_file(source_file, file_size)
+    return source_file
+
+def make_rapid_input_tree(source_directory, num_watersheds, file_size):
+    """
+    Creates <watershed>/rapid_namelist_<subbasin>.dat input directories
+    """
+    input_directories = []
+    for watershed_index in range(num_watersheds):
+        input_directory = os.path.join(source_directory, 'watershed_%s' % watershed_index)
+        os.makedirs(input_directory)
+        with open(os.path.join(input_directory, 'rapid_namelist_subbasin_%s.dat' % watershed_index), 'w') as namelist:
+            namelist.write('&NL_namelist\n/\n')
+        for input_name in ('rapid_connect.csv', 'riv_bas_id.csv', 'k.csv', 'x.csv'):
+            write_synthetic_file(os.path.join(input_directory, input_name), file_size)
+        input_directories.append(input_directory)
+    return input_directories
+
+#------------------------------------------------------------------------------
+#Benchmarks
+#------------------------------------------------------------------------------
+def get_directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, file_name)) \
+               for root, directories, file_names in os.walk(directory) for file_name in file_names)
+
+def time_stage(server, metrics, name, stage_function, data_directory=None):
+    """
+    Runs one benchmark stage and returns its timing, request counts and
+    the time spent in each stage of the dataset manager
+    """
+    server.state.reset_counts()
+    metrics.reset()
+    start_time = time.time()
+    stage_function()
+    seconds = time.time() - start_time
+    result = {'name': name,
+              'seconds': round(seconds, 4),
+              'requests': dict(server.state.request_counts),
+              'bytes_uploaded': server.state.bytes_received,
+              'bytes_downloaded': server.state.bytes_sent,
+              'stages': metrics.get_summary()}
+    if data_directory:
+        result['local_bytes'] = get_directory_size(data_directory)
+    print "%-36s %8.3f s" % (name, seconds)
+    return result
+
+def run_benchmarks(options):
+    """
+    Runs the ECMWF, WRF-Hydro and RAPID input benchmarks and returns the results
+    """
+    server = FakeCKANServer(options.latency, int(options.bandwidth*1024*1024)).start()
+    metrics = MetricsRegistry()
+    manager_options = {'metrics': metrics,
+                       'stream_upload': options.stream_upload,
+                       'stream_download': options.stream_download,
+                       'compression_level': options.compression_level,
+                       'compression_workers': options.compression_workers,
+                       'compression_codec': options.compression_codec,
+                       'download_workers': options.download_workers,
+                       'download_segments': options.download_segments,
+                       'segment_threshold': options.segment_threshold,
+                       'request_governor': RequestGovernor(rate=options.max_request_rate or None) \
+                                           if options.governor else None}
+    work_directory = tempfile.mkdtemp(prefix='sfpt_benchmark_')
+    results = []
+    managers = []
+    def create_manager(manager_class, *args, **extra_options):
+        manager = manager_class(server.url, 'benchmark', *args, **dict(manager_options, **extra_options))
+        managers.append(manager)
+        return manager
+    try:
+        #ECMWF
+        ecmwf_source = os.path.join(work_directory, 'ecmwf_output')
+        date_string = make_ecmwf_tree(ecmwf_source, options.watersheds, options.subbasins,
+                                      options.ensembles, options.file_size)
+        ecmwf_manager = create_manager(ECMWFRAPIDDatasetManager, bundle_ensembles=options.bundle_ensembles)
+        results.append(time_stage(server, metrics, 'ecmwf.zip_upload_resources',
+                                  lambda: ecmwf_manager.zip_upload_resources(ecmwf_source,
+                                                                             options.upload_workers or None),
+                                  ecmwf_source))
+        ecmwf_download = os.path.join(work_directory, 'ecmwf_predictions')
+        os.makedirs(ecmwf_download)
+        download_manager = create_manager(ECMWFRAPIDDatasetManager)
+        results.append(time_stage(server, metrics, 'ecmwf.download_recent_resource',
+                                  lambda: [download_manager.download_recent_resource('watershed_%s' % watershed_index,
+                                                                                     'subbasin_%s' % subbasin_index,
+                                                                                     ecmwf_download) \
+                                           for watershed_index in range(options.watersheds) \
+                                           for subbasin_index in range(options.subbasins)],
+                                  ecmwf_download))
+
+        #WRF-Hydro
+        wrf_source = os.path.join(work_directory, 'wrf_hydro_output')
+        os.makedirs(wrf_source)
+        wrf_file = make_wrf_hydro_file(wrf_source, options.file_size*options.ensembles)
+        wrf_manager = create_manager(WRFHydroHRRRDatasetManager)
+        results.append(time_stage(server, metrics, 'wrf_hydro.zip_upload_resource',
+                                  lambda: wrf_manager.zip_upload_resource(wrf_file, 'conus', 'conus'),
+                                  wrf_source))
+        wrf_download = os.path.join(work_directory, 'wrf_hydro_predictions')
+        os.makedirs(wrf_download)
+        results.append(time_stage(server, metrics, 'wrf_hydro.download_recent_resource',
+                                  lambda: create_manager(WRFHydroHRRRDatasetManager) \
+                                              .download_recent_resource('conus', 'conus', wrf_download),
+                                  wrf_download))
+
+        #RAPID input
+        rapid_source = os.path.join(work_directory, 'rapid_input')
+        input_directories = make_rapid_input_tree(rapid_source, options.watersheds, options.file_size)
+        rapid_manager = create_manager(RAPIDInputDatasetManager, 'ecmwf', 'benchmark')
+        results.append(time_stage(server, metrics, 'rapid_input.zip_upload_resource',
+                                  lambda: [rapid_manager.zip_upload_resource(input_directory) \
+                                           for input_directory in input_directories],
+                                  rapid_source))
+        rapid_download = os.path.join(work_directory, 'rapid_input_sync')
+        os.makedirs(rapid_download)
+        sync_manager = create_manager(RAPIDInputDatasetManager, 'ecmwf', 'benchmark')
+        results.append(time_stage(server, metrics, 'rapid_input.sync_dataset',
+                                  lambda: sync_manager.sync_dataset(rapid_download),
+                                  rapid_download))
+    finally:
+        for manager in managers:
+            manager.http_session.close()
+        server.shutdown()
+        server.server_close()
+        if not options.keep:
+            rmtree(work_directory)
+    return results
+
+def get_version():
+    """
+    Returns the git revision of the dataset manager if available
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the dataset managers against a fake CKAN server')
+    parser.add_argument('--watersheds', type=int, default=2)
+    parser.add_argument('--subbasins', type=int, default=1)
+    parser.add_argument('--ensembles', type=int, default=52)
+    parser.add_argument('--file-size', type=int, default=1024*1024, help='bytes per synthetic file')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to each API call')
+    parser.add_argument('--bandwidth', type=float, default=0, help='MB/s per transfer, 0 for unlimited')
+    parser.add_argument('--upload-workers', type=int, default=0, help='ECMWF upload pipeline workers')
+    parser.add_argument('--download-workers', type=int, default=1)
+    parser.add_argument('--download-segments', type=int, default=1, help='connections per large download')
+    parser.add_argument('--segment-threshold', type=int, default=64*1024*1024,
+                        help='bytes from which downloads are segmented')
+    parser.add_argument('--compression-workers', type=int, default=1)
+    parser.add_argument('--compression-level', type=int, default=None, help='default for the codec if not set')
+    parser.add_argument('--compression-codec', default='gzip', help='gzip, zstd, lzma, store or adaptive')
+    parser.add_argument('--governor', action='store_true', help='send requests through a RequestGovernor')
+    parser.add_argument('--max-request-rate', type=float, default=0, help='requests per second with --governor')
+    parser.add_argument('--bundle-ensembles', action='store_true', help='upload ECMWF runs as ensemble bundles')
+    parser.add_argument('--stream-upload', action='store_true',
+                        help='send uploads chunked, the server must accept chunked request bodies')
+    parser.add_argument('--stream-download', action='store_true')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic data directory')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    options = parser.parse_args()
+
+    benchmark_results = {'version': get_version(),
+                         'timestamp': datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                         'python': platform.python_version(),
+                         'settings': vars(options),
+                         'results': run_benchmarks(options)}
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2, sort_keys=True)
+    else:
+        print json.dumps(benchmark_results, indent=2, sort_keys=True)
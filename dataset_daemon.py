@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+"""
+Long running local service for the dataset managers. The managers are
+created once and keep their connection pools, metadata and resource caches
+warm between requests. Identical requests that arrive while one is running
+are coalesced into a single transfer (single-flight) and every waiter gets
+the same result and progress events. Requests writing to the same directory
+run one at a time.
+
+    python dataset_daemon.py --engine-url http://ciwckan.chpc.utah.edu --api-key KEY --port 8765
+
+    POST /ecmwf/download_recent {"watershed": "magdalena", "subbasin": "el_banco",
+                                 "main_extract_directory": "/path/to/predictions"}
+    GET  /requests/<request id>
+    GET  /status
+"""
+import argparse
+import BaseHTTPServer
+from collections import deque, OrderedDict
+import copy
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import SocketServer
+import threading
+import time
+import uuid
+
+from requests import Session
+
+from dataset_manager import (ECMWFRAPIDDatasetManager,
+                             FileHashManifest,
+                             MetricsRegistry,
+                             NullMetrics,
+                             RAPIDInputDatasetManager,
+                             RequestGovernor,
+                             WRFHydroHRRRDatasetManager)
+
+#------------------------------------------------------------------------------
+#Daemon Operations
+#------------------------------------------------------------------------------
+class DaemonOperation(object):
+    """
+    Dataset manager method that can be requested from the daemon.
+    lock_path returns the directory or file written by the call from its
+    parameters so calls writing to the same place run one at a time
+    """
+    def __init__(self, manager_type, method_name, required, optional=(), lock_path=None):
+        self.manager_type = manager_type
+        self.method_name = method_name
+        self.required = required
+        self.optional = optional
+        self.lock_path = lock_path
+
+    def get_arguments(self, params):
+        """
+        Returns the keyword arguments of the call, raising ValueError for
+        missing or unknown parameters
+        """
+        missing = [name for name in self.required if params.get(name) is None]
+        if missing:
+            raise ValueError("Missing parameters: %s" % ", ".join(missing))
+        unknown = [name for name in params if name not in self.required and name not in self.optional]
+        if unknown:
+            raise ValueError("Unknown parameters: %s" % ", ".join(sorted(unknown)))
+        return dict((name, params[name]) for name in params)
+
+def _recent_extract_path(params):
+    return os.path.join(params['main_extract_directory'], params['watershed'].lower(), params['subbasin'].lower())
+
+#manager parameters of the RAPID input operations
+RAPID_INPUT_PARAMS = ('model_name', 'app_instance_id')
+
+DAEMON_OPERATIONS = {
+    'ecmwf/download_recent': DaemonOperation('ecmwf', 'download_recent_resource',
+                                             ('watershed', 'subbasin', 'main_extract_directory'),
+                                             lock_path=_recent_extract_path),
+    'ecmwf/upload': DaemonOperation('ecmwf', 'zip_upload_resources',
+                                    ('source_directory',),
+                                    ('num_workers', 'journal_file'),
+                                    lambda params: params['source_directory']),
+    'wrf_hydro/download_recent': DaemonOperation('wrf_hydro', 'download_recent_resource',
+                                                 ('watershed', 'subbasin', 'main_extract_directory'),
+                                                 lock_path=_recent_extract_path),
+    'wrf_hydro/download_prediction': DaemonOperation('wrf_hydro', 'download_prediction_resource',
+                                                     ('watershed', 'subbasin', 'date_string', 'extract_directory'),
+                                                     ('members',),
+                                                     lambda params: params['extract_directory']),
+    'wrf_hydro/upload': DaemonOperation('wrf_hydro', 'zip_upload_resource',
+                                        ('source_file', 'watershed', 'subbasin'),
+                                        lock_path=lambda params: params['source_file']),
+    'rapid_input/sync': DaemonOperation('rapid_input', 'sync_dataset',
+                                        RAPID_INPUT_PARAMS + ('extract_directory',),
+                                        lock_path=lambda params: params['extract_directory']),
+    'rapid_input/upload': DaemonOperation('rapid_input', 'zip_upload_resource',
+                                          RAPID_INPUT_PARAMS + ('source_directory',),
+                                          lock_path=lambda params: params['source_directory']),
+}
+
+#------------------------------------------------------------------------------
+#Single-Flight Requests
+#------------------------------------------------------------------------------
+class Flight(object):
+    """
+    One running call shared by every request with the same key. Keeps the
+    status, result and the latest progress events (the metrics events of
+    the call)
+    """
+    def __init__(self, key, operation_name, params, max_events=1000):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.operation_name = operation_name
+        self.params = params
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.waiters = 1
+        self.bytes = 0
+        self.event_count = 0
+        self.events = []
+        self.max_events = max_events
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+
+    def add_waiter(self):
+        with self.lock:
+            self.waiters += 1
+
+    def add_event(self, event):
+        """
+        Metrics hook that keeps the progress of the call
+        """
+        with self.lock:
+            self.event_count += 1
+            self.bytes += event['bytes']
+            self.events.append(event)
+            if len(self.events) > self.max_events:
+                del self.events[0]
+
+    def start(self):
+        with self.lock:
+            self.status = 'running'
+            self.started = time.time()
+
+    def finish(self, result=None, error=None):
+        with self.lock:
+            self.status = 'failed' if error else 'finished'
+            self.result = result
+            self.error = str(error) if error else None
+            self.finished = time.time()
+        self.done.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the call to finish and returns True if it did
+        """
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+    def get_info(self, num_events=20):
+        """
+        Returns the status and progress of the call as a dictionary
+        """
+        with self.lock:
+            return {'request_id': self.id,
+                    'operation': self.operation_name,
+                    'params': self.params,
+                    'status': self.status,
+                    'result': self.result,
+                    'error': self.error,
+                    'waiters': self.waiters,
+                    'bytes': self.bytes,
+                    'event_count': self.event_count,
+                    'events': self.events[-num_events:] if num_events else [],
+                    'submitted': self.submitted,
+                    'started': self.started,
+                    'finished': self.finished}
+
+class _PathQueues(object):
+    """
+    Queues of the calls waiting for a path that is written by a running
+    call. Waiting calls are kept here instead of in the worker pool so they
+    do not hold workers that other calls could use
+    """
+    def __init__(self):
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def enter(self, path, task):
+        """
+        Returns True if the path is free and the task can run now, or queues
+        the task behind the running call and returns False
+        """
+        with self.lock:
+            if path in self.queues:
+                self.queues[path].append(task)
+                return False
+            self.queues[path] = deque()
+            return True
+
+    def leave(self, path):
+        """
+        Returns the next task queued for the path, which then holds it, or
+        None once the path is free
+        """
+        with self.lock:
+            queue = self.queues[path]
+            if queue:
+                return queue.popleft()
+            del self.queues[path]
+        return None
+
+#------------------------------------------------------------------------------
+#Dataset Daemon
+#------------------------------------------------------------------------------
+class DatasetDaemon(object):
+    """
+    Runs dataset manager operations for the daemon server on a pool of
+    num_workers threads. The managers are created on first use and reused,
+    each call running on a copy so calls do not share run state. The
+    managers share one hash manifest so they do not overwrite each other's
+    manifest file. The remaining keyword arguments are passed to the managers
+    """
+    def __init__(self, engine_url, api_key, num_workers=8, history_size=256,
+                 metrics=None, request_governor=None, readiness_state_file=None,
+                 **manager_options):
+        self.engine_url = engine_url
+        self.api_key = api_key
+        self.manager_options = manager_options
+        self.readiness_state_file = readiness_state_file
+        self.metrics = metrics or NullMetrics()
+        self.request_governor = request_governor
+        self.hash_manifest = FileHashManifest(manager_options.get('hash_manifest_file'))
+        self.managers = {}
+        self.managers_lock = threading.Lock()
+        self.pool = ThreadPool(num_workers)
+        #running calls by key and recent calls by id
+        self.flights = {}
+        self.history = OrderedDict()
+        self.history_size = history_size
+        self.flights_lock = threading.Lock()
+        self.path_queues = _PathQueues()
+        self.coalesced_count = 0
+
+    def get_manager(self, manager_type, params):
+        """
+        Returns the manager for the type, creating it on first use
+        """
+        manager_key = (manager_type,)
+        if manager_type == 'rapid_input':
+            manager_key += tuple(params[name] for name in RAPID_INPUT_PARAMS)
+        with self.managers_lock:
+            if manager_key not in self.managers:
+                manager_options = dict(self.manager_options,
+                                       metrics=self.metrics,
+                                       request_governor=self.request_governor)
+                if manager_type == 'ecmwf':
+                    manager = ECMWFRAPIDDatasetManager(self.engine_url, self.api_key,
+                                                       self.readiness_state_file, **manager_options)
+                elif manager_type == 'wrf_hydro':
+                    manager = WRFHydroHRRRDatasetManager(self.engine_url, self.api_key, **manager_options)
+                else:
+                    manager = RAPIDInputDatasetManager(self.engine_url, self.api_key,
+                                                       *manager_key[1:], **manager_options)
+                manager.hash_manifest = self.hash_manifest
+                self.managers[manager_key] = manager
+            return self.managers[manager_key]
+
+    def submit(self, operation_name, params):
+        """
+        This function starts the operation, or joins the identical call that
+        is already running. Returns the Flight and whether it was joined
+        """
+        operation = DAEMON_OPERATIONS.get(operation_name)
+        if operation is None:
+            raise KeyError("Unknown operation: %s" % operation_name)
+        arguments = operation.get_arguments(params)
+        key = json.dumps([operation_name, arguments], sort_keys=True)
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                flight.add_waiter()
+                self.coalesced_count += 1
+                return flight, True
+            flight = Flight(key, operation_name, params)
+            self.flights[key] = flight
+            self.history[flight.id] = flight
+            while len(self.history) > self.history_size:
+                self.history.popitem(last=False)
+        lock_path = os.path.abspath(operation.lock_path(params)) if operation.lock_path else None
+        dispatch = lambda: self.pool.apply_async(self._run_flight, (flight, operation, arguments, lock_path))
+        #calls writing to a path that is in use wait for it outside the pool
+        if lock_path is None or self.path_queues.enter(lock_path, dispatch):
+            dispatch()
+        return flight, False
+
+    def _run_flight(self, flight, operation, arguments, lock_path=None):
+        """
+        Runs the call of a flight on a copy of the manager reporting its
+        events, including its CKAN API calls, to the flight and to the
+        daemon metrics. The next call queued for lock_path is dispatched
+        when it finishes
+        """
+        try:
+            manager_params = dict((name, arguments.pop(name)) for name in RAPID_INPUT_PARAMS
+                                  if operation.manager_type == 'rapid_input')
+            run_manager = copy.copy(self.get_manager(operation.manager_type, manager_params))
+            hooks = [flight.add_event]
+            if self.metrics.enabled:
+                hooks.append(lambda event: self.metrics.record(event['stage'], event['seconds'],
+                                                               event['bytes'], event['resource'],
+                                                               event['error']))
+            run_manager.use_metrics(MetricsRegistry(hooks=hooks))
+            flight.start()
+            result = getattr(run_manager, operation.method_name)(**arguments)
+        except Exception, ex:
+            flight.finish(error=ex)
+        else:
+            flight.finish(result=_json_safe(result))
+        finally:
+            with self.flights_lock:
+                self.flights.pop(flight.key, None)
+            if lock_path:
+                dispatch_next = self.path_queues.leave(lock_path)
+                if dispatch_next:
+                    dispatch_next()
+
+    def get_flight(self, flight_id):
+        with self.flights_lock:
+            return self.history.get(flight_id)
+
+    def get_status(self):
+        """
+        Returns the running calls, metrics and request governor statistics
+        """
+        with self.flights_lock:
+            running = [flight.get_info(num_events=0) for flight in self.flights.values()]
+            coalesced_count = self.coalesced_count
+        with self.managers_lock:
+            managers = sorted("/".join(manager_key) for manager_key in self.managers)
+        status = {'running': running,
+                  'coalesced_count': coalesced_count,
+                  'managers': managers,
+                  'metrics': self.metrics.get_summary() if self.metrics.enabled else {}}
+        if self.request_governor:
+            status['request_governor'] = self.request_governor.get_stats()
+        return status
+
+    def close(self):
+        """
+        This function waits for running calls and stops the workers
+        """
+        self.pool.close()
+        self.pool.join()
+
+def _json_safe(result):
+    """
+    Returns the result if it can be sent as JSON or its string otherwise
+    """
+    try:
+        json.dumps(result)
+        return result
+    except (TypeError, ValueError):
+        return str(result)
+
+#------------------------------------------------------------------------------
+#HTTP API
+#------------------------------------------------------------------------------
+class DatasetDaemonRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    HTTP API of the daemon. POST /<operation> with the JSON parameters
+    waits for the call unless "wait" is false or the "timeout" in seconds
+    passes, in which case 202 is returned with the request id to poll
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_json(self, content, status_code=200):
+        body = json.dumps(content)
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        if self.path.rstrip('/') == '/status':
+            return self.send_json(daemon.get_status())
+        request_match = re.match(r'^/requests/(\w+)$', self.path)
+        flight = daemon.get_flight(request_match.group(1)) if request_match else None
+        if flight is None:
+            return self.send_json({'error': 'Not found: %s' % self.path}, 404)
+        self.send_json(flight.get_info())
+
+    def do_POST(self):
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or '{}')
+            if not isinstance(params, dict):
+                raise ValueError("Parameters must be a JSON object")
+        except ValueError, ex:
+            return self.send_json({'error': str(ex)}, 400)
+        wait = params.pop('wait', True)
+        timeout = params.pop('timeout', None)
+        try:
+            flight, coalesced = self.server.daemon.submit(self.path.strip('/'), params)
+        except KeyError, ex:
+            return self.send_json({'error': ex.args[0]}, 404)
+        except ValueError, ex:
+            return self.send_json({'error': str(ex)}, 400)
+        finished = wait and flight.wait(timeout)
+        flight_info = flight.get_info()
+        flight_info['coalesced'] = coalesced
+        if not finished:
+            return self.send_json(flight_info, 202)
+        self.send_json(flight_info, 500 if flight_info['error'] else 200)
+
+class DatasetDaemonServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server for a DatasetDaemon
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, daemon, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, DatasetDaemonRequestHandler)
+        self.daemon = daemon
+        self.verbose = verbose
+
+class DatasetDaemonClient(object):
+    """
+    Client for the daemon HTTP API
+    """
+    def __init__(self, daemon_url='http://127.0.0.1:8765', poll_interval=1):
+        self.daemon_url = daemon_url.rstrip('/')
+        self.poll_interval = poll_interval
+        self.http_session = Session()
+
+    def submit(self, operation_name, **params):
+        """
+        This function starts an operation and returns its request
+        information without waiting for it
+        """
+        params['wait'] = False
+        return self.http_session.post("%s/%s" % (self.daemon_url, operation_name), json=params).json()
+
+    def get_request(self, request_id):
+        return self.http_session.get("%s/requests/%s" % (self.daemon_url, request_id)).json()
+
+    def get_status(self):
+        return self.http_session.get("%s/status" % self.daemon_url).json()
+
+    def call(self, operation_name, progress=None, **params):
+        """
+        This function runs an operation and returns its request information
+        when it finishes. progress is called with the request information
+        each time it is polled
+        """
+        request_info = self.submit(operation_name, **params)
+        if 'request_id' not in request_info:
+            raise ValueError(request_info.get('error'))
+        while request_info['status'] in ('queued', 'running'):
+            if progress:
+                progress(request_info)
+            time.sleep(self.poll_interval)
+            request_info = self.get_request(request_info['request_id'])
+        return request_info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the dataset managers as a local HTTP service')
+    parser.add_argument('--engine-url', required=True)
+    parser.add_argument('--api-key', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=8, help='operations run at once')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--download-segments', type=int, default=1, help='connections per large download')
+    parser.add_argument('--stream-download', action='store_true')
+    parser.add_argument('--resource-cache-directory', help='directory of the shared resource cache')
+    parser.add_argument('--hash-manifest-file', help='hashes of uploaded source files')
+    parser.add_argument('--readiness-state-file', help='ECMWF forecast readiness state')
+    parser.add_argument('--governor', action='store_true', help='send requests through a RequestGovernor')
+    parser.add_argument('--max-request-rate', type=float, default=0, help='requests per second with --governor')
+    parser.add_argument('--metrics-log', help='file to append the metrics events to')
+    parser.add_argument('--verbose', action='store_true', help='log each HTTP request')
+    options = parser.parse_args()
+
+    request_governor = None
+    if options.governor:
+        request_governor = RequestGovernor(rate=options.max_request_rate or None)
+    dataset_daemon = DatasetDaemon(options.engine_url,
+                                   options.api_key,
+                                   num_workers=options.workers,
+                                   metrics=MetricsRegistry(options.metrics_log),
+                                   request_governor=request_governor,
+                                   readiness_state_file=options.readiness_state_file,
+                                   download_workers=options.download_workers,
+                                   download_segments=options.download_segments,
+                                   stream_download=options.stream_download,
+                                   resource_cache_directory=options.resource_cache_directory,
+                                   hash_manifest_file=options.hash_manifest_file)
+    server = DatasetDaemonServer((options.host, options.port), dataset_daemon, options.verbose)
+    print "Dataset daemon listening on http://%s:%s" % (options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Stopping dataset daemon ..."
+    finally:
+        server.server_close()
+        dataset_daemon.close()
@@ -1,15 +1,1929 @@
 #!/usr/bin/env python
+from collections import deque, OrderedDict
+from contextlib import closing
+import copy
 import datetime
+from fnmatch import fnmatch
+#imported here because the first strptime call is not thread safe in Python 2
+import _strptime
 from glob import glob
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import hashlib
+import json
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import os
+import random
+from Queue import Queue, Empty, Full
 import re
-from requests import get
-from shutil import rmtree
+import socket
+import stat
+from requests import Session
+from requests.exceptions import ConnectionError, RequestException
+from requests.adapters import HTTPAdapter
+from shutil import copyfile, rmtree
+import struct
 import tarfile
+import tempfile
+import threading
+import time
+import uuid
 import zipfile
+import zlib
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from tethys_dataset_services.engines import CkanDatasetEngine
 
+#------------------------------------------------------------------------------
+#Metrics
+#------------------------------------------------------------------------------
+class _StageTimer(object):
+    """
+    Context manager that records the duration of a stage when it exits.
+    Set bytes to record the amount of data processed and error to record
+    a failure that did not raise
+    """
+    def __init__(self, metrics, stage, resource):
+        self.metrics = metrics
+        self.stage = stage
+        self.resource = resource
+        self.bytes = 0
+        self.error = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.record(self.stage, time.time() - self.start_time,
+                            self.bytes, self.resource, exc_value or self.error)
+        return False
+
+class _NullStageTimer(object):
+    """
+    Stage timer that does nothing when metrics are disabled
+    """
+    bytes = 0
+    error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class NullMetrics(object):
+    """
+    Metrics registry used when metrics are disabled
+    """
+    enabled = False
+    _timer = _NullStageTimer()
+
+    def timer(self, stage, resource=None):
+        return self._timer
+
+    def record(self, stage, seconds, bytes=0, resource=None, error=None):
+        pass
+
+class MetricsRegistry(object):
+    """
+    Thread safe registry of the count, duration, bytes and errors of each
+    stage (compress, upload, download, extract, hash and each CKAN API
+    call). Every event is passed to the hooks and, if log_file is set,
+    appended to it as a line of JSON
+    """
+    enabled = True
+
+    def __init__(self, log_file=None, hooks=None):
+        self.log_file = log_file
+        self.hooks = list(hooks or [])
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """
+        Adds a function that is called with the dictionary of each event
+        """
+        self.hooks.append(hook)
+
+    def timer(self, stage, resource=None):
+        return _StageTimer(self, stage, resource)
+
+    def record(self, stage, seconds, bytes=0, resource=None, error=None):
+        event = {'time': time.time(),
+                 'stage': stage,
+                 'resource': resource,
+                 'seconds': seconds,
+                 'bytes': bytes,
+                 'error': str(error) if error else None}
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += bytes
+            if error:
+                totals['errors'] += 1
+            if self.log_file:
+                with open(self.log_file, 'a') as log_file:
+                    log_file.write(json.dumps(event) + "\n")
+        for hook in self.hooks:
+            hook(event)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+    def get_summary(self):
+        """
+        Returns a copy of the totals for each stage
+        """
+        with self.lock:
+            return dict((stage, dict(totals)) for stage, totals in self.stages.items())
+
+    def write_prometheus(self, file_path, prefix='sfpt_dataset_manager'):
+        """
+        Writes the totals to a file in the Prometheus text format
+        """
+        lines = []
+        summary = self.get_summary()
+        for field, metric_type in (('count', 'counter'), ('seconds', 'counter'),
+                                   ('bytes', 'counter'), ('errors', 'counter')):
+            metric_name = '%s_stage_%s_total' % (prefix, field)
+            lines.append('# TYPE %s %s' % (metric_name, metric_type))
+            for stage in sorted(summary):
+                lines.append('%s{stage="%s"} %s' % (metric_name, stage, summary[stage][field]))
+        temp_file_path = "%s.%s.tmp" % (file_path, uuid.uuid4().hex)
+        with open(temp_file_path, 'w') as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.rename(temp_file_path, file_path)
+
+def _get_response_error(response_dict):
+    """
+    Returns the error of a CKAN API response or None if it succeeded. The
+    CKAN engine returns None or success False instead of raising
+    """
+    if response_dict is None:
+        return "No response"
+    if isinstance(response_dict, dict) and not response_dict.get('success', True):
+        return response_dict.get('error') or "Request failed"
+    return None
+
+class _InstrumentedEngine(object):
+    """
+    Wraps a dataset engine to record each API call in the metrics. Failed
+    responses are recorded as errors
+    """
+    def __init__(self, dataset_engine, metrics):
+        self.dataset_engine = dataset_engine
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        attribute = getattr(self.dataset_engine, name)
+        if not callable(attribute):
+            return attribute
+        def instrumented_call(*args, **kwargs):
+            with self.metrics.timer('ckan.%s' % name, kwargs.get('name')) as timer:
+                response_dict = attribute(*args, **kwargs)
+                timer.error = _get_response_error(response_dict)
+                return response_dict
+        return instrumented_call
+
+#------------------------------------------------------------------------------
+#Request Governor
+#------------------------------------------------------------------------------
+#HTTP status codes of responses that are retried
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def _failed_response(response):
+    """
+    Returns True if the CKAN API call or HTTP request should be retried
+    """
+    if response is None:
+        #the CKAN engine returns None when the server did not answer with JSON
+        return True
+    return getattr(response, 'status_code', None) in RETRY_STATUS_CODES
+
+class RequestGovernor(object):
+    """
+    Thread safe client side limit on the requests sent to a CKAN server.
+    The number of requests at once adapts between min_concurrency and
+    max_concurrency (additive increase when requests succeed within
+    latency_target seconds, multiplicative decrease on errors or slow
+    requests). The latency of a request is the time until its response
+    headers arrive, so the time spent sending or receiving a large body
+    does not count as slow. If rate is set, a token bucket limits requests to rate per
+    second with bursts of up to burst. Failed requests are retried up to
+    max_retries times with jittered exponential backoff
+    """
+    def __init__(self, initial_concurrency=4, min_concurrency=1, max_concurrency=32,
+                 latency_target=5.0, rate=None, burst=None,
+                 max_retries=4, backoff_base=0.5, backoff_max=30):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = float(max(min_concurrency, min(initial_concurrency, max_concurrency)))
+        self.latency_target = latency_target
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.tokens = float(self.burst)
+        self.token_time = time.time()
+        self.last_decrease = 0
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'decreases': 0}
+
+    def _take_token(self):
+        """
+        Waits for a token from the bucket if the rate is limited
+        """
+        if not self.rate:
+            return
+        while True:
+            with self.condition:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.token_time)*self.rate)
+                self.token_time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens)/self.rate
+            time.sleep(wait_seconds)
+
+    def _acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.stats['requests'] += 1
+
+    def _release(self, latency, failed):
+        """
+        Frees a slot and adapts the limit. A latency of None is not
+        checked against latency_target
+        """
+        with self.condition:
+            self.in_flight -= 1
+            now = time.time()
+            latency = latency or 0
+            if failed or (self.latency_target and latency > self.latency_target):
+                #decrease once for the requests that were in flight together
+                if now - self.last_decrease > max(latency, 1.0):
+                    self.limit = max(self.min_concurrency, self.limit/2)
+                    self.last_decrease = now
+                    self.stats['decreases'] += 1
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1.0/self.limit)
+            self.condition.notify_all()
+
+    def get_backoff(self, attempt, response=None):
+        """
+        Returns the seconds to wait before retrying, honoring Retry-After
+        """
+        retry_after = getattr(response, 'headers', {}).get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(self.backoff_max, int(retry_after))
+        return random.uniform(0, min(self.backoff_max, self.backoff_base*2**attempt))
+
+    def call(self, function, args=(), kwargs=None, idempotent=True, is_failure=_failed_response,
+             max_retries=None, streamed=False, check_latency=True):
+        """
+        Calls the function within the limits and retries it if it raises a
+        connection error or is_failure(result) is True. Requests that are not
+        idempotent are only retried if the connection could not be made.
+        If streamed is set, a successful response keeps its slot until it is
+        read to the end or closed. Set check_latency to False for calls that
+        send a body, such as uploads, whose duration depends on its size.
+        Returns the last result or raises the last error
+        """
+        kwargs = kwargs or {}
+        if max_retries is None:
+            max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            self._take_token()
+            self._acquire()
+            start_time = time.time()
+            result = None
+            error = None
+            try:
+                result = function(*args, **kwargs)
+            except (RequestException, socket.error), ex:
+                error = ex
+            failed = error is not None or is_failure(result)
+            latency = time.time() - start_time if check_latency else None
+            if streamed and not failed:
+                #the body is read after the headers have arrived
+                return _GovernedResponse(result, self, latency)
+            self._release(latency, failed)
+            if not failed:
+                return result
+            with self.condition:
+                self.stats['failures'] += 1
+            retryable = idempotent or isinstance(error, ConnectionError)
+            if attempt >= max_retries or not retryable:
+                if error is not None:
+                    raise error
+                return result
+            if hasattr(result, 'close'):
+                result.close()
+            with self.condition:
+                self.stats['retries'] += 1
+            time.sleep(self.get_backoff(attempt, result))
+
+    def get_options(self, num_shares=1):
+        """
+        Returns the arguments to create a governor in another process with
+        its share of the concurrency and rate limits
+        """
+        return {'initial_concurrency': max(1, int(self.limit)//num_shares),
+                'min_concurrency': max(1, self.min_concurrency//num_shares),
+                'max_concurrency': max(1, self.max_concurrency//num_shares),
+                'latency_target': self.latency_target,
+                'rate': float(self.rate)/num_shares if self.rate else None,
+                'burst': max(1, self.burst//num_shares) if self.rate else None,
+                'max_retries': self.max_retries,
+                'backoff_base': self.backoff_base,
+                'backoff_max': self.backoff_max}
+
+    def get_stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['concurrency'] = self.limit
+            stats['in_flight'] = self.in_flight
+        return stats
+
+class _GovernedResponse(object):
+    """
+    Wraps a streamed HTTP response to hold its request governor slot until
+    the body has been read or the response is closed. The latency is the
+    time until the headers arrived
+    """
+    def __init__(self, response, governor, latency):
+        self.response = response
+        self.governor = governor
+        self.latency = latency
+        self.released = False
+        self.release_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def _release(self, failed=False):
+        with self.release_lock:
+            if self.released:
+                return
+            self.released = True
+        self.governor._release(self.latency, failed)
+
+    def iter_content(self, *args, **kwargs):
+        try:
+            for chunk in self.response.iter_content(*args, **kwargs):
+                yield chunk
+        except (RequestException, socket.error):
+            self._release(True)
+            raise
+        self._release()
+
+    def close(self):
+        try:
+            self.response.close()
+        finally:
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class _GovernedEngine(object):
+    """
+    Wraps a dataset engine to send each API call through a request governor
+    """
+    #API calls that can be repeated without side effects
+    idempotent_prefixes = ('get_', 'search_', 'list_')
+
+    def __init__(self, dataset_engine, governor):
+        self.dataset_engine = dataset_engine
+        self.governor = governor
+
+    def __getattr__(self, name):
+        attribute = getattr(self.dataset_engine, name)
+        if not callable(attribute):
+            return attribute
+        def governed_call(*args, **kwargs):
+            #file uploads take as long as the file needs to be sent
+            return self.governor.call(attribute, args, kwargs,
+                                      idempotent=name.startswith(self.idempotent_prefixes),
+                                      check_latency='file' not in kwargs)
+        return governed_call
+
+#------------------------------------------------------------------------------
+#Metadata Cache
+#------------------------------------------------------------------------------
+class MetadataCache(object):
+    """
+    Thread safe cache for CKAN metadata with a time to live and
+    least recently used eviction. Values are copied in and out so callers
+    cannot change the cached metadata. A ttl of 0 disables the cache
+    """
+    def __init__(self, ttl=60, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            #move to the most recently used end
+            self.entries[key] = entry
+            return copy.deepcopy(entry[1])
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, copy.deepcopy(value))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def update(self, key, update_function):
+        """
+        Replaces a cached value with update_function(value) if it is cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = (entry[0], copy.deepcopy(update_function(copy.deepcopy(entry[1]))))
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+#------------------------------------------------------------------------------
+#Parallel Compression Helpers
+#------------------------------------------------------------------------------
+def _deflate_block(block, compression_level):
+    """
+    Compresses one block into raw deflate data ending on a byte boundary
+    """
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+class ParallelGzipWriter(object):
+    """
+    File-like object that compresses the data written to it in blocks on
+    a thread pool and writes them to fileobj as a single gzip member
+    """
+    def __init__(self, fileobj, compression_level=9, num_workers=4, block_size=1024*1024):
+        self.fileobj = fileobj
+        self.compression_level = compression_level
+        self.block_size = block_size
+        self.pool = ThreadPool(num_workers)
+        #limit the number of compressed blocks held in memory
+        self.max_pending = 2*num_workers
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32("")
+        self.size = 0
+        self.closed = False
+        #gzip header: magic, deflate, no flags, mtime, no extra flags, unknown OS
+        self.fileobj.write('\037\213\010\000' + struct.pack('<L', long(time.time())) + '\000\377')
+
+    def write(self, data):
+        if not data:
+            return
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit_block()
+
+    def _submit_block(self):
+        block = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.pool.apply_async(_deflate_block, (block, self.compression_level)))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffered:
+                self._submit_block()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            #final empty deflate block and gzip trailer
+            self.fileobj.write(zlib.compressobj(self.compression_level, zlib.DEFLATED, -zlib.MAX_WBITS).flush())
+            self.fileobj.write(struct.pack('<LL', self.crc & 0xffffffffL, self.size & 0xffffffffL))
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+#------------------------------------------------------------------------------
+#Compression Codecs
+#------------------------------------------------------------------------------
+class _CompressingWriter(object):
+    """
+    File-like object that compresses the data written to it into fileobj
+    """
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.closed = False
+
+    def write(self, data):
+        if data:
+            self.fileobj.write(self.compressor.compress(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.fileobj.write(self.compressor.flush())
+
+class _DecompressingReader(object):
+    """
+    File-like object that reads and decompresses data from fileobj without
+    seeking. Concatenated members (gzip) or frames (zstd) are read in turn
+    """
+    def __init__(self, fileobj, make_decompressor, chunk_size=64*1024):
+        self.fileobj = fileobj
+        self.make_decompressor = make_decompressor
+        self.decompressor = make_decompressor()
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.eof = False
+
+    def _decompress(self, data):
+        output = []
+        while data:
+            output.append(self.decompressor.decompress(data))
+            data = getattr(self.decompressor, 'unused_data', "")
+            if data:
+                #start of the next member or frame
+                self.decompressor = self.make_decompressor()
+        return "".join(output)
+
+    def read(self, size=-1):
+        output = [self.buffer]
+        buffered = len(self.buffer)
+        while not self.eof and (size < 0 or buffered < size):
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                self.eof = True
+                break
+            data = self._decompress(data)
+            output.append(data)
+            buffered += len(data)
+        data = "".join(output)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        pass
+
+class _StoreCompressor(object):
+    """
+    Compressor and decompressor that leave the data unchanged
+    """
+    unused_data = ""
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return ""
+
+class CompressionCodec(object):
+    """
+    A tar archive compression codec. The name is used to select the codec
+    and file_format is recorded in the format of the resource
+    """
+    name = None
+    file_format = None
+    default_level = None
+    #range of the compression levels of the codec
+    min_level = None
+    max_level = None
+    #name of the optional package the codec needs
+    requires = None
+
+    @property
+    def available(self):
+        return True
+
+    def check_available(self):
+        if not self.available:
+            raise IOError("The %s codec requires the %s package" % (self.name, self.requires))
+
+    def get_level(self, compression_level=None):
+        """
+        Returns the compression level within the range of the codec or the
+        default level if compression_level is None
+        """
+        if compression_level is None:
+            return self.default_level
+        return max(self.min_level, min(compression_level, self.max_level))
+
+    def make_compressor(self, compression_level, num_workers=1):
+        raise NotImplementedError
+
+    def make_decompressor(self):
+        raise NotImplementedError
+
+    def open_writer(self, fileobj, compression_level=None, num_workers=1):
+        """
+        Returns a file-like object that compresses into fileobj and must
+        be closed to finish the compressed data
+        """
+        self.check_available()
+        return _CompressingWriter(fileobj, self.make_compressor(self.get_level(compression_level), num_workers))
+
+    def open_reader(self, fileobj):
+        """
+        Returns a file-like object with the decompressed data from fileobj
+        """
+        self.check_available()
+        return _DecompressingReader(fileobj, self.make_decompressor)
+
+class GzipCodec(CompressionCodec):
+    name = 'gzip'
+    file_format = 'tar.gz'
+    default_level = 9
+    min_level = 0
+    max_level = 9
+
+    def make_compressor(self, compression_level, num_workers=1):
+        return zlib.compressobj(compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def make_decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def open_writer(self, fileobj, compression_level=None, num_workers=1):
+        if num_workers > 1:
+            return ParallelGzipWriter(fileobj, self.get_level(compression_level), num_workers)
+        return super(GzipCodec, self).open_writer(fileobj, compression_level, num_workers)
+
+class ZstdCodec(CompressionCodec):
+    name = 'zstd'
+    file_format = 'tar.zst'
+    default_level = 3
+    min_level = 1
+    max_level = 22
+    requires = 'zstandard'
+
+    @property
+    def available(self):
+        return zstandard is not None
+
+    def make_compressor(self, compression_level, num_workers=1):
+        return zstandard.ZstdCompressor(level=compression_level,
+                                        threads=num_workers if num_workers > 1 else 0).compressobj()
+
+    def make_decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+class LzmaCodec(CompressionCodec):
+    name = 'lzma'
+    file_format = 'tar.xz'
+    default_level = 6
+    min_level = 0
+    max_level = 9
+    requires = 'backports.lzma'
+
+    @property
+    def available(self):
+        return lzma is not None
+
+    def make_compressor(self, compression_level, num_workers=1):
+        return lzma.LZMACompressor(preset=compression_level)
+
+    def make_decompressor(self):
+        return lzma.LZMADecompressor()
+
+class StoreCodec(CompressionCodec):
+    name = 'store'
+    file_format = 'tar'
+    default_level = 0
+    min_level = 0
+    max_level = 0
+
+    def make_compressor(self, compression_level, num_workers=1):
+        return _StoreCompressor()
+
+    def make_decompressor(self):
+        return _StoreCompressor()
+
+    def open_reader(self, fileobj):
+        return fileobj
+
+COMPRESSION_CODECS = OrderedDict()
+
+def register_codec(codec):
+    """
+    Adds a codec to the registry used to write and extract archives
+    """
+    COMPRESSION_CODECS[codec.name] = codec
+
+def get_codec(name):
+    """
+    Returns the codec with the name or resource format (e.g. zstd or tar.zst).
+    Raises ValueError if there is no such codec
+    """
+    name = name.lower().lstrip('.')
+    for codec in COMPRESSION_CODECS.values():
+        if name in (codec.name, codec.file_format):
+            return codec
+    raise ValueError("Unknown compression codec %s" % name)
+
+def find_codec(file_format):
+    """
+    Returns the codec for the resource format or None if it is not a
+    compressed tar format
+    """
+    try:
+        return get_codec(file_format)
+    except ValueError:
+        return None
+
+register_codec(GzipCodec())
+register_codec(ZstdCodec())
+register_codec(LzmaCodec())
+register_codec(StoreCodec())
+
+class AdaptiveCodecSelector(object):
+    """
+    Chooses the codec for each file type by compressing a sample of the
+    first file of that type with each available codec. The codec with the
+    lowest estimated compress, transfer and decompress time at bandwidth
+    bytes per second is used for all files of that type. The compression
+    level is clamped to the range of each codec
+    """
+    def __init__(self, codec_names=None, bandwidth=10*1024*1024, sample_size=1024*1024):
+        self.codec_names = codec_names or COMPRESSION_CODECS.keys()
+        self.bandwidth = bandwidth
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+        self.choices = {}
+
+    def measure(self, codec, sample, compression_level=None):
+        """
+        Returns the estimated seconds to compress, transfer and decompress the sample
+        """
+        start_time = time.time()
+        compressor = codec.make_compressor(codec.get_level(compression_level))
+        compressed = compressor.compress(sample) + compressor.flush()
+        compress_seconds = time.time() - start_time
+        start_time = time.time()
+        codec.make_decompressor().decompress(compressed)
+        decompress_seconds = time.time() - start_time
+        return compress_seconds + decompress_seconds + float(len(compressed))/self.bandwidth
+
+    def choose(self, file_paths, compression_level=None):
+        """
+        Returns the codec for the file type with the most data in file_paths,
+        the file type and whether the codec was chosen by this call. Each file
+        type is measured once even if several threads ask for it at once
+        """
+        type_sizes = {}
+        type_files = {}
+        for file_path in file_paths:
+            file_type = os.path.splitext(file_path)[1].lower()
+            type_sizes[file_type] = type_sizes.get(file_type, 0) + os.path.getsize(file_path)
+            type_files.setdefault(file_type, file_path)
+        if not type_sizes:
+            return get_codec(self.codec_names[0]), None, False
+        file_type = max(type_sizes, key=type_sizes.get)
+        with self.lock:
+            codec = self.choices.get(file_type)
+            if codec:
+                return codec, file_type, False
+            with open(type_files[file_type], 'rb') as sample_file:
+                sample = sample_file.read(self.sample_size)
+            codecs = [get_codec(codec_name) for codec_name in self.codec_names]
+            codec = min([codec for codec in codecs if codec.available],
+                        key=lambda codec: self.measure(codec, sample, compression_level))
+            self.choices[file_type] = codec
+        return codec, file_type, True
+
+#------------------------------------------------------------------------------
+#Streaming Upload Helpers
+#------------------------------------------------------------------------------
+class ArchiveStreamAborted(Exception):
+    """
+    Raised in the archive thread when the reader stops consuming the stream
+    """
+    pass
+
+class _ChunkQueueWriter(object):
+    """
+    File-like object that groups written data into chunks and puts them on a queue
+    """
+    def __init__(self, chunk_queue, chunk_size, abort_event):
+        self.chunk_queue = chunk_queue
+        self.chunk_size = chunk_size
+        self.abort_event = abort_event
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered:
+            self.put(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def put(self, item):
+        while True:
+            if self.abort_event.is_set():
+                raise ArchiveStreamAborted()
+            try:
+                self.chunk_queue.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+class ArchiveStream(object):
+    """
+    Iterable that yields an archive of the files in chunks while it is
+    being written in a background thread. At most max_chunks chunks are
+    held in memory at once
+    """
+    def __init__(self, write_archive, file_paths, chunk_size=1024*1024, max_chunks=8):
+        self.write_archive = write_archive
+        self.file_paths = file_paths
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+
+    def _write(self, writer):
+        try:
+            self.write_archive(self.file_paths, writer)
+            writer.flush()
+            writer.put(None)
+        except ArchiveStreamAborted:
+            pass
+        except Exception, ex:
+            try:
+                writer.put(ex)
+            except ArchiveStreamAborted:
+                pass
+
+    def __iter__(self):
+        chunk_queue = Queue(self.max_chunks)
+        abort_event = threading.Event()
+        writer = _ChunkQueueWriter(chunk_queue, self.chunk_size, abort_event)
+        archive_thread = threading.Thread(target=self._write, args=(writer,))
+        archive_thread.daemon = True
+        archive_thread.start()
+        try:
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            #stop the archive thread if the upload stopped early
+            abort_event.set()
+            try:
+                while True:
+                    chunk_queue.get_nowait()
+            except Empty:
+                pass
+            archive_thread.join()
+
+def _multipart_field(boundary, key, value):
+    """
+    Returns one multipart/form-data field
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, key, value)
+
+def _multipart_stream(fields, file_field, file_name, file_chunks, boundary, trailing_fields=None):
+    """
+    Generator for a multipart/form-data request body with one streamed file.
+    trailing_fields is called after the file is sent for fields that depend on it
+    """
+    for key, value in fields:
+        yield _multipart_field(boundary, key, value)
+    yield '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n' \
+          'Content-Type: application/octet-stream\r\n\r\n' % (boundary, file_field, file_name)
+    for chunk in file_chunks:
+        yield chunk
+    yield '\r\n'
+    if trailing_fields:
+        for key, value in trailing_fields():
+            yield _multipart_field(boundary, key, value)
+    yield '--%s--\r\n' % boundary
+
+#------------------------------------------------------------------------------
+#Download Verification Helpers
+#------------------------------------------------------------------------------
+def get_file_hash(file_path, chunk_size=1024*1024):
+    """
+    Returns the sha256 hash of a file
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as hash_file:
+        for chunk in iter(lambda: hash_file.read(chunk_size), ''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+class _HashingReader(object):
+    """
+    File-like object that hashes and counts the data read from fileobj
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+class SegmentedDownloadError(IOError):
+    """
+    Raised when a file cannot be downloaded in byte range segments
+    """
+    pass
+
+class IncompleteDownloadError(IOError):
+    """
+    Raised when a response ends before all of the file has been received
+    """
+    pass
+
+class ChunkedUploadRejectedError(IOError):
+    """
+    Raised when the server does not accept a chunked upload request
+    """
+    pass
+
+def get_response_file_size(response, downloaded_size=0):
+    """
+    Returns the size of the whole file from the Content-Range or
+    Content-Length of a download response or None if it is not known
+    """
+    file_size_match = re.search(r'/(\d+)$', response.headers.get('Content-Range', ''))
+    if file_size_match:
+        return int(file_size_match.group(1))
+    content_length = response.headers.get('Content-Length')
+    if content_length and not response.headers.get('Content-Encoding'):
+        return int(content_length) + (downloaded_size if response.status_code == 206 else 0)
+    return None
+
+def verify_resource_data(resource_info, data_size, data_hash):
+    """
+    Raises an IOError if the size or sha256 hash of the data do not match
+    the values recorded in the resource at upload time
+    """
+    expected_size = resource_info.get('size')
+    if expected_size and int(expected_size) != data_size:
+        raise IOError("Resource %s size %s does not match the expected size %s" % \
+                      (resource_info['name'], data_size, expected_size))
+    expected_hash = resource_info.get('hash') or ""
+    if expected_hash.startswith('sha256:') and expected_hash[7:] != data_hash:
+        raise IOError("Resource %s failed checksum verification" % resource_info['name'])
+
+def member_selected(member_name, members=None):
+    """
+    Returns True if the archive member matches one of the names or glob
+    patterns in members, or if members is None
+    """
+    if members is None:
+        return True
+    if isinstance(members, basestring):
+        members = [members]
+    base_name = os.path.basename(member_name)
+    return any(fnmatch(member_name, pattern) or fnmatch(base_name, pattern) for pattern in members)
+
+def extract_tar_members(tar, extract_directory, members=None):
+    """
+    Extracts the members of an open tar archive that match members (see
+    member_selected) and returns their names. Other members are skipped
+    without being written, which also works on streamed archives
+    """
+    extracted_members = []
+    for tarinfo in tar:
+        if member_selected(tarinfo.name, members):
+            tar.extract(tarinfo, extract_directory)
+            extracted_members.append(tarinfo.name)
+    return extracted_members
+
+def move_extracted_files(source_directory, extract_directory):
+    """
+    Moves the files and directories extracted to source_directory into
+    extract_directory, replacing those with the same names
+    """
+    if not os.path.isdir(source_directory):
+        return
+    for file_name in os.listdir(source_directory):
+        destination_path = os.path.join(extract_directory, file_name)
+        if os.path.isdir(destination_path) and not os.path.islink(destination_path):
+            rmtree(destination_path)
+        elif os.path.lexists(destination_path):
+            os.remove(destination_path)
+        os.rename(os.path.join(source_directory, file_name), destination_path)
+
+def extract_zip_members(zip_file, extract_directory, members=None):
+    """
+    Extracts the members of an open zip archive that match members (see
+    member_selected) and returns their names
+    """
+    extracted_members = [member_name for member_name in zip_file.namelist() \
+                         if member_selected(member_name, members)]
+    zip_file.extractall(extract_directory, extracted_members)
+    return extracted_members
+
+def read_state_file(state_file, description):
+    """
+    Returns the dictionary saved in the JSON state file or an empty one if
+    there is no state file or it is invalid
+    """
+    if not state_file or not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file) as state:
+            return json.load(state)
+    except ValueError:
+        print "Invalid", description, state_file, "Ignoring ..."
+        return {}
+
+class FileHashManifest(object):
+    """
+    Thread safe record of the sha256 hashes of local files so that files
+    whose size and modification time have not changed are not hashed
+    again. The manifest is saved to manifest_file if it is set and has
+    changed, keeping the entries other processes saved there; call save
+    once per batch of files
+    """
+    def __init__(self, manifest_file=None):
+        self.manifest_file = manifest_file
+        self.lock = threading.Lock()
+        self.changed = False
+        self.entries = read_state_file(manifest_file, "hash manifest")
+
+    def get_hash(self, file_path):
+        """
+        Returns the sha256 hash of the file and whether it was computed
+        """
+        file_path = os.path.abspath(file_path)
+        file_stat = os.stat(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+        if entry and entry['size'] == file_stat.st_size and entry['mtime'] == file_stat.st_mtime:
+            return entry['hash'], False
+        file_hash = get_file_hash(file_path)
+        with self.lock:
+            self.entries[file_path] = {'size': file_stat.st_size,
+                                       'mtime': file_stat.st_mtime,
+                                       'hash': file_hash}
+            self.changed = True
+        return file_hash, True
+
+    def get_entries(self, file_paths):
+        """
+        Returns the entries of the files that have been hashed
+        """
+        with self.lock:
+            return dict((os.path.abspath(file_path), self.entries[os.path.abspath(file_path)]) \
+                        for file_path in file_paths if os.path.abspath(file_path) in self.entries)
+
+    def update(self, entries):
+        """
+        Adds entries hashed elsewhere, such as in a worker process
+        """
+        with self.lock:
+            self.entries.update(entries)
+            self.changed = self.changed or bool(entries)
+
+    def save(self):
+        if not self.manifest_file:
+            return
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            entries = read_state_file(self.manifest_file, "hash manifest")
+            entries.update(self.entries)
+            self.entries = entries
+            temp_manifest_file = "%s.%s.tmp" % (self.manifest_file, uuid.uuid4().hex)
+            with open(temp_manifest_file, 'w') as manifest:
+                json.dump(self.entries, manifest)
+            os.rename(temp_manifest_file, self.manifest_file)
+
+class ReadinessState(object):
+    """
+    Thread safe record of whether the datasets of forecast runs are ready
+    to download, with the metadata_modified time they were checked at so
+    unchanged datasets are not checked again. The state is saved to
+    state_file if it is set, keeping the entries other processes saved
+    there, and entries older than max_age days are dropped
+    """
+    def __init__(self, state_file=None, max_age=7):
+        self.state_file = state_file
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = read_state_file(state_file, "readiness state")
+
+    def get(self, dataset_name):
+        with self.lock:
+            return self.entries.get(dataset_name)
+
+    def set(self, dataset_name, entry):
+        entry['checked'] = time.time()
+        with self.lock:
+            self.entries[dataset_name] = entry
+
+    def save(self):
+        if not self.state_file:
+            return
+        with self.lock:
+            entries = read_state_file(self.state_file, "readiness state")
+            for dataset_name, entry in self.entries.items():
+                #keep the newest check of each dataset
+                if dataset_name not in entries or entries[dataset_name]['checked'] <= entry['checked']:
+                    entries[dataset_name] = entry
+            self.entries = entries
+            expired = time.time() - self.max_age*24*60*60
+            for dataset_name, entry in self.entries.items():
+                if entry['checked'] < expired:
+                    del self.entries[dataset_name]
+            temp_state_file = "%s.%s.tmp" % (self.state_file, uuid.uuid4().hex)
+            with open(temp_state_file, 'w') as state:
+                json.dump(self.entries, state)
+            os.rename(temp_state_file, self.state_file)
+
+#------------------------------------------------------------------------------
+#Warning Points Packs
+#------------------------------------------------------------------------------
+#name of the warning points file for a return period
+WARNING_POINTS_FILE = 'return_%s_points.txt'
+
+def write_warning_points_pack(warning_point_files, fileobj):
+    """
+    Writes the warning points files to a zip archive with a manifest of the
+    return periods, sizes and hashes of the files in the archive comment
+    so it is read with the zip index. Returns the manifest
+    """
+    return_period_search = re.compile(r'return_(\d+)_points\.txt')
+    manifest = {'return_periods': [], 'files': {}}
+    with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for file_path in sorted(warning_point_files,
+                                key=lambda file_path: int(return_period_search.search(os.path.basename(file_path)).group(1))):
+            file_name = os.path.basename(file_path)
+            return_period = return_period_search.search(file_name).group(1)
+            zip_file.write(file_path, file_name)
+            manifest['return_periods'].append(return_period)
+            manifest['files'][file_name] = {'return_period': return_period,
+                                            'size': os.path.getsize(file_path),
+                                            'hash': 'sha256:%s' % get_file_hash(file_path)}
+        zip_file.comment = json.dumps(manifest, sort_keys=True)
+    return manifest
+
+def read_warning_points_manifest(zip_file):
+    """
+    Returns the manifest of a warning points pack or None if the zip
+    archive is not one
+    """
+    try:
+        manifest = json.loads(zip_file.comment)
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or 'return_periods' not in manifest:
+        return None
+    return manifest
+
+def read_warning_points(pack_file, return_periods=None):
+    """
+    Returns a dictionary with the contents of the warning points files in
+    a pack (path or file object) by return period without extracting
+    the others. Raises KeyError if a return period is not in the pack
+    """
+    with zipfile.ZipFile(pack_file) as zip_file:
+        if return_periods is None:
+            manifest = read_warning_points_manifest(zip_file)
+            if manifest is None:
+                raise IOError("Not a warning points pack")
+            return_periods = manifest['return_periods']
+        return dict((str(return_period), zip_file.read(WARNING_POINTS_FILE % return_period)) \
+                    for return_period in return_periods)
+
+#------------------------------------------------------------------------------
+#Ensemble Bundles
+#------------------------------------------------------------------------------
+#resource format of ensemble bundles
+BUNDLE_FORMAT = 'bundle'
+#a bundle ends with the magic, the offset and the length of its JSON index
+BUNDLE_MAGIC = 'SFPTBNDL'
+BUNDLE_FOOTER = struct.Struct('<8sQQ')
+
+class BundleFormatError(IOError):
+    """
+    Raised when data is not a valid ensemble bundle
+    """
+    pass
+
+def _compress_bundle_member(job):
+    """
+    Compresses one file into a gzip member for an ensemble bundle
+    """
+    file_path, compression_level = job
+    with open(file_path, 'rb') as member_file:
+        data = member_file.read()
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, 31)
+    return (compressor.compress(data) + compressor.flush(),
+            len(data),
+            'sha256:%s' % hashlib.sha256(data).hexdigest())
+
+def write_ensemble_bundle(file_paths, fileobj, compression_level=6, num_workers=1):
+    """
+    Writes the files to an ensemble bundle: each file as an independent
+    gzip member followed by a JSON index of the member offsets and the
+    footer, so single members can be read with byte range requests.
+    Members are compressed on num_workers threads. Returns the index
+    """
+    ensemble_search = re.compile(r'_(\d+)\.nc$')
+    index = {'version': 1, 'members': []}
+    offset = 0
+    jobs = [(file_path, compression_level) for file_path in file_paths]
+    compress_pool = ThreadPool(num_workers) if num_workers > 1 else None
+    try:
+        members = compress_pool.imap(_compress_bundle_member, jobs) if compress_pool \
+                  else (_compress_bundle_member(job) for job in jobs)
+        for file_path, (member_data, member_size, member_hash) in zip(file_paths, members):
+            ensemble_match = ensemble_search.search(os.path.basename(file_path))
+            fileobj.write(member_data)
+            index['members'].append({'name': os.path.basename(file_path),
+                                     'ensemble': ensemble_match.group(1) if ensemble_match else None,
+                                     'offset': offset,
+                                     'length': len(member_data),
+                                     'size': member_size,
+                                     'hash': member_hash})
+            offset += len(member_data)
+    finally:
+        if compress_pool:
+            compress_pool.close()
+            compress_pool.join()
+    index_data = json.dumps(index, sort_keys=True)
+    fileobj.write(index_data)
+    fileobj.write(BUNDLE_FOOTER.pack(BUNDLE_MAGIC, offset, len(index_data)))
+    return index
+
+def read_bundle_footer(footer_data):
+    """
+    Returns the offset and length of the index from the footer at the end
+    of the data
+    """
+    if len(footer_data) < BUNDLE_FOOTER.size:
+        raise BundleFormatError("Bundle footer is truncated")
+    magic, index_offset, index_length = BUNDLE_FOOTER.unpack(footer_data[-BUNDLE_FOOTER.size:])
+    if magic != BUNDLE_MAGIC:
+        raise BundleFormatError("Not an ensemble bundle")
+    return index_offset, index_length
+
+def read_bundle_member(member_data, member):
+    """
+    Returns the decompressed data of a bundle member after checking its
+    size and hash against the index
+    """
+    try:
+        data = zlib.decompress(member_data, 31)
+    except zlib.error, ex:
+        raise BundleFormatError("Bundle member %s is corrupt: %s" % (member['name'], ex))
+    if len(data) != member['size'] or \
+            'sha256:%s' % hashlib.sha256(data).hexdigest() != member['hash']:
+        raise BundleFormatError("Bundle member %s does not match the index" % member['name'])
+    return data
+
+def read_ensemble_bundle(bundle_file, members=None):
+    """
+    Returns a dictionary with the data of the bundle members matching the
+    names or glob patterns in members (all if not set) from a local bundle
+    """
+    with open(bundle_file, 'rb') as bundle:
+        bundle.seek(-BUNDLE_FOOTER.size, os.SEEK_END)
+        index_offset, index_length = read_bundle_footer(bundle.read(BUNDLE_FOOTER.size))
+        bundle.seek(index_offset)
+        index = json.loads(bundle.read(index_length))
+        member_data = {}
+        for member in index['members']:
+            if member_selected(member['name'], members):
+                bundle.seek(member['offset'])
+                member_data[member['name']] = read_bundle_member(bundle.read(member['length']), member)
+    return member_data
+
+#------------------------------------------------------------------------------
+#Resource Cache
+#------------------------------------------------------------------------------
+class _CacheLock(object):
+    """
+    Exclusive lock on the cache directory shared by threads and processes
+    """
+    def __init__(self, lock_file):
+        self.lock_file = lock_file
+        self.thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.lock_handle = open(self.lock_file, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.lock_handle.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.lock_handle.fileno(), fcntl.LOCK_UN)
+            self.lock_handle.close()
+        finally:
+            self.thread_lock.release()
+        return False
+
+class ResourceCache(object):
+    """
+    Content addressed cache of downloaded resource archives shared by the
+    processes on a host. Archives are stored by sha256 hash (or resource id
+    if the resource has no hash) and served by copy, so the cached archives
+    never share an inode with files the caller changes or removes. The least
+    recently used archives are removed when the cache is over max_bytes
+    """
+    def __init__(self, cache_directory, max_bytes=10*1024*1024*1024):
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        try:
+            os.makedirs(cache_directory)
+        except OSError:
+            pass
+        self.lock = _CacheLock(os.path.join(cache_directory, ".lock"))
+
+    def get_cache_path(self, resource_info):
+        """
+        Returns the path of the resource archive in the cache
+        """
+        file_format = resource_info['format'].lower().lstrip('.')
+        resource_hash = resource_info.get('hash') or ""
+        if resource_hash.startswith('sha256:'):
+            return os.path.join(self.cache_directory, "%s.%s" % (resource_hash[7:], file_format))
+        #an in place re-upload keeps the id, so the version is part of the key
+        resource_version = re.sub(r'[^0-9A-Za-z]', '', "%s%s" % (resource_info.get('last_modified') or
+                                                                   resource_info.get('created') or "",
+                                                                   resource_info.get('size') or ""))
+        return os.path.join(self.cache_directory, "id-%s-%s.%s" % (resource_info['id'],
+                                                                   resource_version,
+                                                                   file_format))
+
+    def fetch(self, resource_info, file_path):
+        """
+        Copies the cached archive of the resource to file_path.
+        Returns False if the resource is not in the cache
+        """
+        cache_path = self.get_cache_path(resource_info)
+        with self.lock:
+            if not os.path.exists(cache_path):
+                return False
+            #the modification time orders the archives for eviction
+            os.utime(cache_path, None)
+            copyfile(cache_path, file_path)
+        return True
+
+    def store(self, resource_info, file_path):
+        """
+        Adds the downloaded archive of the resource to the cache and
+        removes the least recently used archives if it is over budget
+        """
+        if os.path.getsize(file_path) > self.max_bytes:
+            return
+        cache_path = self.get_cache_path(resource_info)
+        temp_cache_path = os.path.join(self.cache_directory, ".%s.tmp" % uuid.uuid4().hex)
+        copyfile(file_path, temp_cache_path)
+        with self.lock:
+            os.rename(temp_cache_path, cache_path)
+            os.utime(cache_path, None)
+            self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used archives until the cache is within
+        max_bytes. Must be called with the lock held
+        """
+        cache_entries = []
+        for file_name in os.listdir(self.cache_directory):
+            if file_name.startswith("."):
+                continue
+            cache_path = os.path.join(self.cache_directory, file_name)
+            try:
+                file_stat = os.stat(cache_path)
+            except OSError:
+                continue
+            cache_entries.append((file_stat.st_mtime, file_stat.st_size, cache_path))
+        cache_bytes = sum(cache_entry[1] for cache_entry in cache_entries)
+        for mtime, size, cache_path in sorted(cache_entries):
+            if cache_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(cache_path)
+                cache_bytes -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for file_name in os.listdir(self.cache_directory):
+                if not file_name.startswith("."):
+                    os.remove(os.path.join(self.cache_directory, file_name))
+
+#------------------------------------------------------------------------------
+#Source Tree Index
+#------------------------------------------------------------------------------
+def scan_directory(directory_path):
+    """
+    Returns a list of (name, is directory, size, modification time) for the
+    entries in the directory. With scandir, directories are found without
+    a stat call
+    """
+    directory_entries = []
+    if scandir is not None:
+        for entry in scandir(directory_path):
+            try:
+                if entry.is_dir():
+                    directory_entries.append((entry.name, True, 0, 0))
+                else:
+                    entry_stat = entry.stat()
+                    directory_entries.append((entry.name, False, entry_stat.st_size, entry_stat.st_mtime))
+            except OSError:
+                #removed while scanning
+                continue
+        return directory_entries
+    for name in os.listdir(directory_path):
+        try:
+            entry_stat = os.stat(os.path.join(directory_path, name))
+        except OSError:
+            continue
+        if stat.S_ISDIR(entry_stat.st_mode):
+            directory_entries.append((name, True, 0, 0))
+        else:
+            directory_entries.append((name, False, entry_stat.st_size, entry_stat.st_mtime))
+    return directory_entries
+
+class ForecastSourceIndex(object):
+    """
+    In memory index of an ECMWF output tree (watershed/date/files) built in
+    one pass over its directories. For each watershed and date it holds the
+    forecast files by subbasin, the warning points files and the names of
+    all files, with the size and modification time of each file. Date
+    directories that do not match date_format_string are left out
+    """
+    ensemble_search = re.compile(r'^Qout_(\w+)_(\d+)\.nc$')
+    return_period_search = re.compile(r'^return_(\d+)_points\.txt$')
+
+    def __init__(self, source_directory, date_format_string=None):
+        self.source_directory = source_directory
+        self.date_format_string = date_format_string
+        self.watersheds = OrderedDict()
+        self.scan()
+
+    def scan(self):
+        """
+        Rebuilds the index from the source directory
+        """
+        self.watersheds = OrderedDict()
+        for watershed, is_directory, size, mtime in sorted(scan_directory(self.source_directory)):
+            if not is_directory:
+                continue
+            watershed_dir = os.path.join(self.source_directory, watershed)
+            dates = OrderedDict()
+            for date_string, is_directory, size, mtime in sorted(scan_directory(watershed_dir)):
+                if not is_directory:
+                    continue
+                if self.date_format_string:
+                    try:
+                        datetime.datetime.strptime(date_string[:11], self.date_format_string)
+                    except ValueError:
+                        continue
+                dates[date_string] = self.scan_date_directory(os.path.join(watershed_dir, date_string))
+            self.watersheds[watershed] = dates
+
+    def scan_date_directory(self, date_dir):
+        """
+        Returns the index of the files in one date directory
+        """
+        date_info = {'path': date_dir,
+                     'subbasins': OrderedDict(),
+                     'warning_points': [],
+                     'files': set()}
+        for file_name, is_directory, size, mtime in sorted(scan_directory(date_dir)):
+            if is_directory:
+                continue
+            date_info['files'].add(file_name)
+            file_info = {'name': file_name,
+                         'path': os.path.join(date_dir, file_name),
+                         'size': size,
+                         'mtime': mtime,
+                         'subbasin': None,
+                         'ensemble': None,
+                         'return_period': None}
+            ensemble_match = self.ensemble_search.match(file_name)
+            if ensemble_match:
+                file_info['subbasin'], file_info['ensemble'] = ensemble_match.groups()
+                date_info['subbasins'].setdefault(file_info['subbasin'], []).append(file_info)
+                continue
+            return_period_match = self.return_period_search.match(file_name)
+            if return_period_match:
+                file_info['return_period'] = return_period_match.group(1)
+                date_info['warning_points'].append(file_info)
+        for forecast_files in date_info['subbasins'].values():
+            forecast_files.sort(key=lambda file_info: int(file_info['ensemble']))
+        #warning points belong to the only subbasin in the directory
+        if len(date_info['subbasins']) == 1:
+            for file_info in date_info['warning_points']:
+                file_info['subbasin'] = date_info['subbasins'].keys()[0]
+        return date_info
+
+    def iter_date_directories(self, newest_first=False):
+        """
+        Yields (watershed, date string, date index) for each date directory
+        """
+        for watershed, dates in self.watersheds.items():
+            date_strings = dates.keys()
+            if newest_first:
+                date_strings.reverse()
+            for date_string in date_strings:
+                yield watershed, date_string, dates[date_string]
+
+    def iter_files(self, newest_first=False):
+        """
+        Yields (watershed, date string, file index) for each forecast and
+        warning points file
+        """
+        for watershed, date_string, date_info in self.iter_date_directories(newest_first):
+            for forecast_files in date_info['subbasins'].values():
+                for file_info in forecast_files:
+                    yield watershed, date_string, file_info
+            for file_info in date_info['warning_points']:
+                yield watershed, date_string, file_info
+
+#------------------------------------------------------------------------------
+#Upload Journal
+#------------------------------------------------------------------------------
+class UploadJournal(object):
+    """
+    Thread safe, append only record of completed upload jobs so that a
+    restarted process can skip them, and of the failed attempts of jobs so
+    they are retried with backoff. Each line of journal_file is a JSON
+    object with the key of the job and its details. Later lines replace
+    earlier ones with the same key
+    """
+    def __init__(self, journal_file=None):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.journal = None
+        if journal_file:
+            if os.path.exists(journal_file):
+                with open(journal_file, 'rb') as journal:
+                    for line in journal:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            #ignore a line cut short by a crash
+                            continue
+                        self.entries[entry['key']] = entry
+            self.journal = open(journal_file, 'ab')
+            #start on a new line if the last one was cut short
+            if self.journal.tell() > 0:
+                with open(journal_file, 'rb') as journal:
+                    journal.seek(-1, os.SEEK_END)
+                    if journal.read(1) != "\n":
+                        self.journal.write("\n")
+
+    def get(self, key):
+        """
+        Returns the entry for the key or None if it is not in the journal
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    def is_complete(self, key, size, mtime):
+        """
+        Returns True if the job with the key was completed with a file of
+        the same size and modification time
+        """
+        entry = self.get(key)
+        return bool(entry and not entry.get('failed') and \
+                    entry['size'] == size and entry['mtime'] == mtime)
+
+    def _write(self, entry):
+        """
+        Adds the entry and writes it to the journal. Must be called with
+        the lock held
+        """
+        self.entries[entry['key']] = entry
+        if self.journal:
+            self.journal.write(json.dumps(entry) + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def record(self, key, **details):
+        """
+        Records the job with the key as complete and writes it to the journal
+        """
+        entry = dict(details, key=key, completed=datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"))
+        with self.lock:
+            self._write(entry)
+        return entry
+
+    def record_failure(self, key, size, mtime, error, retry_delay=60, max_retry_delay=3600):
+        """
+        Records a failed attempt of the job with the key. The attempts of a
+        file with the same size and modification time are counted, and the
+        next attempt is due after retry_delay seconds, doubled after each
+        attempt up to max_retry_delay
+        """
+        with self.lock:
+            previous_entry = self.entries.get(key)
+            attempts = 1
+            if previous_entry and previous_entry.get('failed') and \
+                    previous_entry['size'] == size and previous_entry['mtime'] == mtime:
+                attempts = previous_entry['attempts'] + 1
+            entry = {'key': key,
+                     'size': size,
+                     'mtime': mtime,
+                     'failed': True,
+                     'error': str(error),
+                     'attempts': attempts,
+                     'retry_time': time.time() + min(max_retry_delay, retry_delay*2**(attempts - 1))}
+            self._write(entry)
+        return entry
+
+    def is_retry_due(self, key, size, mtime, max_attempts):
+        """
+        Returns True if the job with the key has not failed for a file of
+        this size and modification time, or may be attempted again
+        """
+        entry = self.get(key)
+        if not entry or not entry.get('failed') or entry['size'] != size or entry['mtime'] != mtime:
+            return True
+        return entry['attempts'] < max_attempts and time.time() >= entry['retry_time']
+
+    def compact(self):
+        """
+        Rewrites the journal with one line for each key
+        """
+        if not self.journal:
+            return
+        with self.lock:
+            temp_journal_file = "%s.%s.tmp" % (self.journal_file, uuid.uuid4().hex)
+            with open(temp_journal_file, 'wb') as journal:
+                for entry in self.entries.values():
+                    journal.write(json.dumps(entry) + "\n")
+            self.journal.close()
+            os.rename(temp_journal_file, self.journal_file)
+            self.journal = open(self.journal_file, 'ab')
+
+    def close(self):
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+#------------------------------------------------------------------------------
+#Upload Pipeline Jobs
+#------------------------------------------------------------------------------
+def _zip_ensemble_job(job):
+    """
+    Packages one ensemble file into a compressed tar file for the upload pipeline
+    """
+    run_manager, file_path = job
+    result = {'ensemble': run_manager.resource_name.split("-")[-1],
+              'file': file_path,
+              'manager': run_manager,
+              'tar_file': None,
+              'file_format': None,
+              'source_hash': None,
+              'skipped': False,
+              'resource_info': None,
+              'error': None}
+    try:
+        if run_manager.get_resource_info():
+            #existing resources are not replaced so the file is not hashed
+            result['skipped'] = True
+            return result
+        result['source_hash'] = run_manager.get_source_hash([file_path])
+        if run_manager.find_unchanged_resource(result['source_hash']):
+            result['skipped'] = True
+        elif not run_manager.stream_upload:
+            result['file_format'] = run_manager.get_archive_codec([file_path]).file_format
+            result['tar_file'] = run_manager.make_tarfile(file_path)
+    except Exception, ex:
+        result['error'] = ex
+    return result
+
+def _upload_ensemble_job(result):
+    """
+    Uploads one packaged ensemble file for the upload pipeline
+    """
+    try:
+        if result['tar_file']:
+            result['resource_info'] = result['manager']._upload_resource(result['tar_file'],
+                                                                         file_format=result['file_format'],
+                                                                         source_hash=result['source_hash'])
+        else:
+            result['resource_info'] = result['manager']._stream_upload_resource([result['file']],
+                                                                                source_hash=result['source_hash'])
+    except Exception, ex:
+        result['error'] = ex
+    finally:
+        try:
+            if result['tar_file']:
+                os.remove(result['tar_file'])
+        except OSError:
+            pass
+    del result['manager']
+    return result
+
+def _upload_file_job(run_manager, job, dataset_lock):
+    """
+    Packages and uploads one forecast or warning points file, or the
+    warning points pack or ensemble bundle of jobs with 'pack' and 'files',
+    for the watch mode and the upload scheduler
+    """
+    result = {'resource_info': None,
+              'skipped': False,
+              'error': None}
+    tar_file = None
+    try:
+        run_manager.initialize_run_ecmwf(job['watershed'], job['subbasin'], job['date_string'])
+        if job.get('pack') == 'warning_points':
+            run_manager.update_resource_warning_points_pack()
+        elif job.get('pack') == 'ensembles':
+            run_manager.update_resource_ensemble_bundle()
+        elif job['return_period']:
+            run_manager.update_resource_return_period(job['return_period'])
+        else:
+            run_manager.update_resource_ensemble_number(job['ensemble'])
+        #create each dataset once so the upload workers do not race to create it
+        with dataset_lock:
+            run_manager.create_dataset()
+        if not job.get('pack') and run_manager.get_resource_info():
+            #existing resources are not replaced so the file is not hashed
+            result['skipped'] = True
+            return result
+        source_hash = run_manager.get_source_hash(job.get('files') or [job['file']])
+        if run_manager.find_unchanged_resource(source_hash):
+            result['skipped'] = True
+        elif job.get('pack'):
+            if job['pack'] == 'ensembles':
+                tar_file, resource_extras = run_manager.make_ensemble_bundle(job['files'])
+                file_format = BUNDLE_FORMAT
+            else:
+                tar_file, resource_extras = run_manager.make_warning_points_pack(job['files'])
+                file_format = 'zip'
+            #packs of files that changed replace the previous upload
+            result['resource_info'] = run_manager._upload_resource(tar_file,
+                                                                   overwrite=True,
+                                                                   file_format=file_format,
+                                                                   source_hash=source_hash,
+                                                                   resource_extras=resource_extras)
+        elif run_manager.stream_upload:
+            result['resource_info'] = run_manager._stream_upload_resource([job['file']],
+                                                                          source_hash=source_hash)
+        else:
+            file_format = run_manager.get_archive_codec([job['file']]).file_format
+            tar_file = run_manager.make_tarfile(job['file'])
+            result['resource_info'] = run_manager._upload_resource(tar_file,
+                                                                   file_format=file_format,
+                                                                   source_hash=source_hash)
+        if result['resource_info'] is None:
+            #the resource exists on CKAN already
+            result['skipped'] = True
+        elif not result['resource_info'].get('success'):
+            raise IOError(result['resource_info'].get('error', "Upload failed"))
+    except Exception, ex:
+        result['error'] = ex
+    finally:
+        try:
+            if tar_file:
+                os.remove(tar_file)
+        except OSError:
+            pass
+    return result
+
+#------------------------------------------------------------------------------
+#Upload Scheduler Jobs
+#------------------------------------------------------------------------------
+#dataset manager of each scheduler worker process
+_scheduler_manager = None
+#metrics events of the scheduler worker process not yet sent to the scheduler
+_scheduler_events = []
+
+def _init_scheduler_worker(manager_class, manager_args, manager_options,
+                           governor_options=None, record_metrics=False):
+    """
+    Creates the dataset manager of a scheduler worker process with its
+    own request governor and a registry collecting the metrics events
+    """
+    global _scheduler_manager
+    manager_options = dict(manager_options)
+    if governor_options:
+        manager_options['request_governor'] = RequestGovernor(**governor_options)
+    if record_metrics:
+        manager_options['metrics'] = MetricsRegistry(hooks=[_scheduler_events.append])
+    _scheduler_manager = manager_class(*manager_args, **manager_options)
+
+def _scheduled_upload_job(job):
+    """
+    Uploads one file in a scheduler worker process. The datasets are
+    created by the scheduler before the jobs are queued
+    """
+    result = _upload_file_job(copy.copy(_scheduler_manager), job, threading.Lock())
+    #the scheduler adds the hashes to its manifest and saves it once
+    result['hash_entries'] = _scheduler_manager.hash_manifest.get_entries(job.get('files') or [job['file']])
+    #the scheduler records the events in its metrics
+    result['metrics_events'] = list(_scheduler_events)
+    del _scheduler_events[:]
+    if result['error']:
+        #exceptions may not survive the trip back to the scheduler
+        result['error'] = "%s: %s" % (result['error'].__class__.__name__, result['error'])
+    return job, result
+
+def order_upload_jobs(jobs):
+    """
+    Orders the upload jobs newest forecast date first and takes turns
+    between the watersheds within each date so that no watershed waits
+    for all of another to finish
+    """
+    date_jobs = {}
+    for job in jobs:
+        date_jobs.setdefault(job['date_string'], OrderedDict()) \
+                 .setdefault(job['watershed'], []).append(job)
+    ordered_jobs = []
+    for date_string in sorted(date_jobs, reverse=True):
+        watershed_jobs = [sorted(watershed_job_list, key=lambda job: job['key']) \
+                          for watershed_job_list in date_jobs[date_string].values()]
+        for job_index in range(max(len(job_list) for job_list in watershed_jobs)):
+            for job_list in watershed_jobs:
+                if job_index < len(job_list):
+                    ordered_jobs.append(job_list[job_index])
+    return ordered_jobs
+
 #------------------------------------------------------------------------------
 #Main Dataset Manager Class
 #------------------------------------------------------------------------------
@@ -21,17 +1935,121 @@ class CKANDatasetManager(object):
     def __init__(self, engine_url, api_key, model_name, 
                  dataset_notes="CKAN Dataset", 
                  resource_description="CKAN Resource",
-                 date_format_string="%Y%m%d"):
+                 date_format_string="%Y%m%d",
+                 stream_upload=False,
+                 compression_level=None,
+                 compression_workers=1,
+                 compression_codec='gzip',
+                 adaptive_bandwidth=10*1024*1024,
+                 stream_download=False,
+                 download_chunk_size=1024*1024,
+                 download_workers=1,
+                 download_retries=3,
+                 cache_ttl=60,
+                 cache_size=1024,
+                 hash_manifest_file=None,
+                 metrics=None,
+                 resource_cache_directory=None,
+                 resource_cache_size=10*1024*1024*1024,
+                 request_governor=None,
+                 download_segments=1,
+                 segment_size=8*1024*1024,
+                 segment_threshold=64*1024*1024,
+                 connect_timeout=10,
+                 read_timeout=60):
         if engine_url.endswith('/'):
             engine_url = engine_url[:-1]
         if not engine_url.endswith('api/action') and not engine_url.endswith('api/3/action'):
             engine_url += '/api/action'
         
-        self.dataset_engine = CkanDatasetEngine(endpoint=engine_url, apikey=api_key)
+        #engine without the metrics and request governor wrappers
+        self.ckan_engine = CkanDatasetEngine(endpoint=engine_url, apikey=api_key)
+        self.dataset_engine = self.ckan_engine
+        #options used to create the same manager in worker processes
+        self.manager_options = {'stream_upload': stream_upload,
+                                'compression_level': compression_level,
+                                'compression_workers': compression_workers,
+                                'compression_codec': compression_codec,
+                                'adaptive_bandwidth': adaptive_bandwidth,
+                                'stream_download': stream_download,
+                                'download_chunk_size': download_chunk_size,
+                                'download_workers': download_workers,
+                                'download_retries': download_retries,
+                                'cache_ttl': cache_ttl,
+                                'cache_size': cache_size,
+                                'hash_manifest_file': hash_manifest_file,
+                                'resource_cache_directory': resource_cache_directory,
+                                'resource_cache_size': resource_cache_size,
+                                'download_segments': download_segments,
+                                'segment_size': segment_size,
+                                'segment_threshold': segment_threshold,
+                                'connect_timeout': connect_timeout,
+                                'read_timeout': read_timeout}
         self.model_name = model_name
         self.dataset_notes = dataset_notes
         self.resource_description = resource_description
         self.date_format_string = date_format_string
+        #compress archives straight into the upload request instead of a temporary file.
+        #The request is sent with chunked transfer encoding, so only enable this for
+        #servers that accept chunked request bodies (uploads fall back to a temporary
+        #file if the server answers 411 Length Required)
+        self.stream_upload = stream_upload
+        #compression level (None for the codec default) and number of threads used to compress archives
+        self.compression_level = compression_level
+        self.compression_workers = compression_workers
+        #codec used to compress archives or 'adaptive' to choose one for each file type
+        #by measuring how it performs at adaptive_bandwidth bytes per second
+        self.compression_codec = compression_codec
+        self.codec_selector = None
+        if compression_codec == 'adaptive':
+            self.codec_selector = AdaptiveCodecSelector(bandwidth=adaptive_bandwidth)
+        else:
+            get_codec(compression_codec).check_available()
+        #extract compressed tar resources while they download instead of from a local copy
+        self.stream_download = stream_download
+        self.download_chunk_size = download_chunk_size
+        #number of resources downloaded at once over the pooled session
+        self.download_workers = download_workers
+        #number of times an interrupted download is resumed before giving up
+        self.download_retries = download_retries
+        #files of at least segment_threshold bytes are downloaded in byte
+        #ranges of at least segment_size over download_segments connections
+        self.download_segments = download_segments
+        self.segment_size = segment_size
+        self.segment_threshold = segment_threshold
+        #seconds to wait for a connection and between bytes of a response
+        #so stalled transfers fail and are retried or resumed
+        self.request_timeout = (connect_timeout, read_timeout)
+        self.http_session = Session()
+        http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, download_workers*download_segments))
+        self.http_session.mount('http://', http_adapter)
+        self.http_session.mount('https://', http_adapter)
+        #dataset ids, dataset info and resource lists from CKAN
+        self.metadata_cache = MetadataCache(cache_ttl, cache_size)
+        #hashes of local source files used to skip unchanged uploads
+        self.hash_manifest = FileHashManifest(hash_manifest_file)
+        #downloaded archives shared with other managers and processes on the host
+        self.resource_cache = None
+        if resource_cache_directory:
+            self.resource_cache = ResourceCache(resource_cache_directory, resource_cache_size)
+        #limits on the requests sent to the server, shared by the managers using it
+        self.request_governor = request_governor
+        #stage timings and request counts
+        self.use_metrics(metrics or NullMetrics())
+
+    def use_metrics(self, metrics):
+        """
+        This function records the stages of the manager in metrics and
+        wraps the CKAN engine to record its API calls there as well. Each
+        attempt of an API call is timed without the time it waited for the
+        request governor
+        """
+        self.metrics = metrics
+        self.dataset_engine = self.ckan_engine
+        if metrics.enabled:
+            self.dataset_engine = _InstrumentedEngine(self.dataset_engine, metrics)
+        if self.request_governor:
+            self.dataset_engine = _GovernedEngine(self.dataset_engine, self.request_governor)
         
     def initialize_run(self, watershed, subbasin, date_string):
         """
@@ -50,34 +2068,72 @@ class CKANDatasetManager(object):
                                              self.subbasin,
                                              self.date_string)
 
+    def get_archive_codec(self, file_paths):
+        """
+        This function returns the codec used to compress an archive of the files
+        """
+        if self.codec_selector:
+            codec, file_type, chosen = self.codec_selector.choose(file_paths, self.compression_level)
+            if chosen:
+                print "Using", codec.name, "compression for", file_type or "files", "..."
+            return codec
+        return get_codec(self.compression_codec)
+
+    def get_archive_file_path(self, output_tar_file, codec):
+        """
+        This function replaces the archive extension of the path with the
+        one for the codec
+        """
+        for archive_codec in COMPRESSION_CODECS.values():
+            if output_tar_file.endswith(".%s" % archive_codec.file_format):
+                output_tar_file = output_tar_file[:-len(archive_codec.file_format)-1]
+                break
+        return "%s.%s" % (output_tar_file, codec.file_format)
+
+    def write_tar_archive(self, file_paths, fileobj, codec=None):
+        """
+        This function writes a compressed tar archive of the files to a file object
+        """
+        codec = codec or self.get_archive_codec(file_paths)
+        with self.metrics.timer('compress', self.resource_name) as timer:
+            archive_writer = codec.open_writer(fileobj, self.compression_level, self.compression_workers)
+            try:
+                with tarfile.open(fileobj=archive_writer, mode="w|") as tar:
+                    for file_path in file_paths:
+                        tar.add(file_path, arcname=os.path.basename(file_path))
+            finally:
+                archive_writer.close()
+            timer.bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+
     def make_tarfile(self, file_path):
         """
-        This function packages the dataset into a tar.gz file and
+        This function packages the dataset into a compressed tar file and
         returns the path
         """
         base_path = os.path.dirname(file_path)
-        output_tar_file =  os.path.join(base_path, "%s.tar.gz" % self.resource_name)
+        codec = self.get_archive_codec([file_path])
+        output_tar_file =  os.path.join(base_path, "%s.%s" % (self.resource_name, codec.file_format))
             
         
         if not os.path.exists(output_tar_file):
-            with tarfile.open(output_tar_file, "w:gz") as tar:
-                    tar.add(file_path, arcname=os.path.basename(file_path))
+            with open(output_tar_file, 'wb') as output_file:
+                self.write_tar_archive([file_path], output_file, codec)
 
         return output_tar_file
 
     def make_directory_tarfile(self, directory_path, search_string="*"):
         """
-        This function packages all of the datasets into a tar.gz file and
-        returns the path
+        This function packages all of the datasets into a compressed tar
+        file and returns the path
         """
         base_path = os.path.dirname(directory_path)
-        output_tar_file =  os.path.join(base_path, "%s.tar.gz" % self.resource_name)
+        directory_files = glob(os.path.join(directory_path,search_string))
+        codec = self.get_archive_codec(directory_files)
+        output_tar_file =  os.path.join(base_path, "%s.%s" % (self.resource_name, codec.file_format))
 
         if not os.path.exists(output_tar_file):
-            directory_files = glob(os.path.join(directory_path,search_string))
-            with tarfile.open(output_tar_file, "w:gz") as tar:
-                    for directory_file in directory_files:
-                        tar.add(directory_file, arcname=os.path.basename(directory_file))
+            with open(output_tar_file, 'wb') as output_file:
+                self.write_tar_archive(directory_files, output_file, codec)
 
         return output_tar_file
     
@@ -85,12 +2141,17 @@ class CKANDatasetManager(object):
         """
         This function gets the id of a dataset
         """
+        dataset_id = self.metadata_cache.get(('dataset_id', self.dataset_name))
+        if dataset_id:
+            return dataset_id
         # Use the json module to load CKAN's response into a dictionary.
         response_dict = self.dataset_engine.search_datasets({ 'name': self.dataset_name })
         
         if response_dict['success']:
             if int(response_dict['result']['count']) > 0:
-                return response_dict['result']['results'][0]['id']
+                dataset_id = response_dict['result']['results'][0]['id']
+                self.metadata_cache.set(('dataset_id', self.dataset_name), dataset_id)
+                return dataset_id
             return None
         else:
             return None
@@ -112,73 +2173,278 @@ class CKANDatasetManager(object):
                                           month=self.date.month,
                                           year=self.date.year)
             dataset_id = result['result']['id']
+            self.metadata_cache.set(('dataset_id', self.dataset_name), dataset_id)
         return dataset_id
+
+    def get_dataset_resources(self, dataset_id):
+        """
+        This function gets the list of resources in a dataset
+        """
+        resources = self.metadata_cache.get(('resources', dataset_id))
+        if resources is None:
+            response_dict = self.dataset_engine.get_dataset(dataset_id)
+            if not response_dict or not response_dict['success']:
+                return []
+            resources = response_dict['result']['resources']
+            self.metadata_cache.set(('resources', dataset_id), resources)
+        return resources
+
+    def cache_created_resource(self, dataset_id, response_dict):
+        """
+        This function adds a resource created by this manager to the cached
+        resource list so the next upload to the dataset does not fetch it
+        again. The list is fetched again if the result is not known
+        """
+        self.metadata_cache.invalidate(('dataset_info', self.dataset_name))
+        if response_dict and response_dict.get('success'):
+            self.metadata_cache.update(('resources', dataset_id),
+                                       lambda resources: resources + [response_dict['result']])
+        else:
+            self.metadata_cache.invalidate(('resources', dataset_id))
+
+    def delete_resource(self, dataset_id, resource_id):
+        """
+        This function deletes a resource and removes it from the cache
+        """
+        self.dataset_engine.delete_resource(resource_id)
+        self.metadata_cache.invalidate(('dataset_info', self.dataset_name))
+        self.metadata_cache.update(('resources', dataset_id),
+                                   lambda resources: [resource for resource in resources \
+                                                      if resource['id'] != resource_id])
        
-    def upload_resource(self, file_path, overwrite=False, file_format='tar.gz'):
+    def upload_resource(self, file_path, overwrite=False, file_format='tar.gz', source_hash=None,
+                        resource_extras=None):
+        """
+        This function uploads a resource to a dataset if it does not exist
+        """
+        try:
+            return self._upload_resource(file_path, overwrite, file_format, source_hash, resource_extras)
+        except Exception,e:
+            print e
+            pass
+
+    def stream_upload_resource(self, file_paths, overwrite=False, source_hash=None):
+        """
+        This function packages the files into a compressed tar archive while
+        uploading it to a dataset if it does not exist. The streamed body
+        cannot be sent again, so the upload is not retried if it fails
+        """
+        try:
+            return self._stream_upload_resource(file_paths, overwrite, source_hash=source_hash)
+        except Exception,e:
+            print e
+            pass
+
+    def _upload_resource(self, file_path, overwrite=False, file_format='tar.gz', source_hash=None,
+                         resource_extras=None):
         """
         This function uploads a resource to a dataset if it does not exist
+        and raises any errors that occur. resource_extras are added to the
+        resource fields
+        """
+        dataset_id = self.prepare_resource_upload(overwrite, source_hash)
+        if dataset_id:
+            #upload resources to the dataset
+            resource_metadata = self.get_resource_metadata(file_format, source_hash, resource_extras)
+            #record size and hash to verify downloads
+            resource_metadata['size'] = str(os.path.getsize(file_path))
+            resource_metadata['hash'] = 'sha256:%s' % get_file_hash(file_path)
+            with self.metrics.timer('upload', self.resource_name) as timer:
+                timer.bytes = int(resource_metadata['size'])
+                response_dict = self.dataset_engine.create_resource(dataset_id, 
+                                                                    file=file_path,
+                                                                    **resource_metadata)
+            self.cache_created_resource(dataset_id, response_dict)
+            return response_dict
+
+    def _stream_upload_resource(self, file_paths, overwrite=False, source_hash=None):
+        """
+        This function streams a compressed tar archive of the files to a
+        dataset if the resource does not exist and raises any errors that
+        occur. If the server rejects the chunked request, the archive is
+        uploaded from a temporary file instead
+        """
+        dataset_id = self.prepare_resource_upload(overwrite, source_hash)
+        if dataset_id:
+            codec = self.get_archive_codec(file_paths)
+            archive_stream = ArchiveStream(lambda file_paths, fileobj: self.write_tar_archive(file_paths, fileobj, codec),
+                                           file_paths)
+            try:
+                response_dict = self.stream_create_resource(dataset_id, archive_stream, codec.file_format, source_hash)
+            except ChunkedUploadRejectedError, ex:
+                print ex, "Uploading from a temporary file ..."
+                #the server will reject the next streamed uploads as well
+                self.stream_upload = False
+                return self._upload_temporary_archive(file_paths, codec, overwrite, source_hash)
+            self.cache_created_resource(dataset_id, response_dict)
+            return response_dict
+
+    def _upload_temporary_archive(self, file_paths, codec, overwrite=False, source_hash=None):
+        """
+        This function writes the files to a temporary compressed tar file,
+        uploads it and removes it
+        """
+        file_handle, archive_path = tempfile.mkstemp(suffix='.%s' % codec.file_format)
+        try:
+            with os.fdopen(file_handle, 'wb') as archive_file:
+                self.write_tar_archive(file_paths, archive_file, codec)
+            return self._upload_resource(archive_path, overwrite, codec.file_format, source_hash)
+        finally:
+            os.remove(archive_path)
+
+    def get_source_hash(self, file_paths):
+        """
+        This function returns a hash of the names and contents of the files
+        to compare with the source_hash of the resource on CKAN
+        """
+        source_hash = hashlib.sha256()
+        with self.metrics.timer('hash', self.resource_name):
+            for file_path in sorted(file_paths, key=os.path.basename):
+                file_hash, computed = self.hash_manifest.get_hash(file_path)
+                source_hash.update("%s:%s\n" % (os.path.basename(file_path), file_hash))
+        return source_hash.hexdigest()
+
+    def find_unchanged_resource(self, source_hash):
+        """
+        This function returns the resource on CKAN if it was uploaded
+        from files with the same source hash
+        """
+        dataset_id = self.get_dataset_id()
+        if dataset_id and source_hash:
+            for resource in self.get_dataset_resources(dataset_id):
+                if resource['name'] == self.resource_name and resource.get('source_hash') == source_hash:
+                    return resource
+        return None
+
+    def prepare_resource_upload(self, overwrite=False, source_hash=None):
+        """
+        This function creates the dataset if needed and removes the existing
+        resource if overwrite is set. Returns the dataset id if the resource
+        should be uploaded
         """
         #create dataset for each watershed-subbasin combo if needed
         dataset_id = self.create_dataset()
         if dataset_id:
-            #check if dataset already exists
-            
-            resource_results = self.dataset_engine.search_resources({'name':self.resource_name},
-                                                                    datset_id=dataset_id)
-            try:
-                #determine if results are exact or similar
-                same_ckan_resource_id = ""
-                if resource_results['result']['count'] > 0:
-                    for resource in resource_results['result']['results']:
-                        if resource['name'] == self.resource_name:
-                            same_ckan_resource_id = resource['id']
-                            break
-                        
-                if overwrite and same_ckan_resource_id:
-                    #delete resource
-                    """
-                    CKAN API CURRENTLY DOES NOT WORK FOR UPDATE - bug = needs file or url, 
-                    but requres both and to have only one ...
-
-                    #update existing resource
-                    print resource_results['result']['results'][0]
-                    update_results = self.dataset_engine.update_resource(resource_results['result']['results'][0]['id'], 
-                                                        file=file_to_upload,
-                                                        url="",
-                                                        date_uploaded=datetime.datetime.utcnow().strftime("%Y%m%d%H%M"))
-                    """
-                    self.dataset_engine.delete_resource(same_ckan_resource_id)
-
-                if not same_ckan_resource_id or overwrite:
+            #check if resource already exists
+            same_ckan_resource_id = ""
+            for resource in self.get_dataset_resources(dataset_id):
+                if resource['name'] == self.resource_name:
+                    same_ckan_resource_id = resource['id']
+                    if source_hash and resource.get('source_hash') == source_hash:
+                        print "Resource", self.resource_name ,"unchanged. Skipping ..."
+                        return None
+                    break
                     
-                    #upload resources to the dataset
-                    return self.dataset_engine.create_resource(dataset_id, 
-                                                    name=self.resource_name, 
-                                                    file=file_path,
-                                                    format=file_format, 
-                                                    tethys_app="erfp_tool",
-                                                    watershed=self.watershed,
-                                                    subbasin=self.subbasin,
-                                                    forecast_date=self.date_string,
-                                                    description=self.resource_description)
-                                                    
-                else:
-                    print "Resource", self.resource_name ,"exists. Skipping ..."
-            except Exception,e:
-                print e
-                pass
+            if overwrite and same_ckan_resource_id:
+                #delete resource
+                """
+                CKAN API CURRENTLY DOES NOT WORK FOR UPDATE - bug = needs file or url, 
+                but requres both and to have only one ...
+
+                #update existing resource
+                update_results = self.dataset_engine.update_resource(same_ckan_resource_id, 
+                                                    file=file_to_upload,
+                                                    url="",
+                                                    date_uploaded=datetime.datetime.utcnow().strftime("%Y%m%d%H%M"))
+                """
+                self.delete_resource(dataset_id, same_ckan_resource_id)
+
+            if not same_ckan_resource_id or overwrite:
+                return dataset_id
+            else:
+                print "Resource", self.resource_name ,"exists. Skipping ..."
+        return None
+
+    def get_resource_metadata(self, file_format='tar.gz', source_hash=None, resource_extras=None):
+        """
+        This function returns the metadata for the current resource
+        """
+        resource_metadata = {'name': self.resource_name,
+                             'format': file_format,
+                             'tethys_app': "erfp_tool",
+                             'watershed': self.watershed,
+                             'subbasin': self.subbasin,
+                             'forecast_date': self.date_string,
+                             'description': self.resource_description}
+        if source_hash:
+            resource_metadata['source_hash'] = source_hash
+        if resource_extras:
+            resource_metadata.update(resource_extras)
+        return resource_metadata
+
+    def stream_create_resource(self, dataset_id, file_chunks, file_format='tar.gz', source_hash=None):
+        """
+        This function creates a resource with the file data streamed from
+        file_chunks in a chunked multipart request. The size of the
+        compressed archive is not known until it is sent, so there is no
+        Content-Length and the server must accept chunked request bodies
+        """
+        resource_metadata = self.get_resource_metadata(file_format, source_hash)
+        fields = [('package_id', dataset_id), ('url', '')] + sorted(resource_metadata.items())
+        #size and hash are sent after the file once they are known
+        file_hash = hashlib.sha256()
+        file_size = [0]
+        def hashed_chunks():
+            for chunk in file_chunks:
+                file_hash.update(chunk)
+                file_size[0] += len(chunk)
+                yield chunk
+        boundary = uuid.uuid4().hex
+        request_body = _multipart_stream(fields, 'upload',
+                                         "%s.%s" % (self.resource_name, file_format),
+                                         hashed_chunks(), boundary,
+                                         lambda: [('size', str(file_size[0])),
+                                                  ('hash', 'sha256:%s' % file_hash.hexdigest())])
+        apikey = str(self.dataset_engine.apikey)
+        headers = {'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+                   'X-CKAN-API-Key': apikey,
+                   'Authorization': apikey}
+        with self.metrics.timer('upload', self.resource_name) as timer:
+            #the streamed body cannot be sent again so the upload is not retried
+            r = self.request('post', '%s/resource_create' % self.dataset_engine.endpoint.rstrip('/'),
+                             idempotent=False, max_retries=0,
+                             data=request_body, headers=headers)
+            timer.bytes = file_size[0]
+        if r.status_code == 411:
+            raise ChunkedUploadRejectedError("Server requires a Content-Length for %s" % self.resource_name)
+        return json.loads(r.text)
+
+    def zip_upload_files(self, file_paths, output_tar_file, overwrite=False):
+        """
+        This function packages the files into a compressed tar file and
+        uploads it. The extension of output_tar_file is replaced with the
+        one for the codec. If stream_upload is set, the archive is compressed
+        straight into the upload instead of output_tar_file. Files that are
+        unchanged since the last upload are skipped. The files are only
+        hashed if the resource may be uploaded
+        """
+        if not overwrite and self.get_resource_info():
+            print "Resource", self.resource_name ,"exists. Skipping ..."
+            return None
+        source_hash = self.get_source_hash(file_paths)
+        if self.find_unchanged_resource(source_hash):
+            print "Resource", self.resource_name ,"unchanged. Skipping ..."
+            return None
+        if self.stream_upload:
+            return self.stream_upload_resource(file_paths, overwrite, source_hash)
+        codec = self.get_archive_codec(file_paths)
+        output_tar_file = self.get_archive_file_path(output_tar_file, codec)
+        if not os.path.exists(output_tar_file):
+            with open(output_tar_file, 'wb') as output_file:
+                self.write_tar_archive(file_paths, output_file, codec)
+        resource_info = self.upload_resource(output_tar_file, overwrite, codec.file_format, source_hash)
+        os.remove(output_tar_file)
+        return resource_info
          
     def zip_upload_file(self, file_path):
         """
         This function uploads a resource to a dataset if it does not exist
         """
         #zip file and get dataset information
-        print "Zipping files for watershed: %s %s" % (self.watershed, self.subbasin)
-        tar_file_path = self.make_tarfile(file_path)    
-        print "Finished zipping files"
-        print "Uploading datasets"
-        resource_info = self.upload_resource(tar_file_path)
-        os.remove(tar_file_path)
+        print "Zipping and uploading files for watershed: %s %s" % (self.watershed, self.subbasin)
+        output_tar_file =  os.path.join(os.path.dirname(file_path), "%s.tar.gz" % self.resource_name)
+        resource_info = self.zip_upload_files([file_path], output_tar_file)
+        self.hash_manifest.save()
         print "Finished uploading datasets"
         return resource_info
 
@@ -187,130 +2453,537 @@ class CKANDatasetManager(object):
         This function uploads a resource to a dataset if it does not exist
         """
         #zip file and get dataset information
-        print "Zipping files for watershed: %s %s" % (self.watershed, self.subbasin)
-        tar_file_path = self.make_directory_tarfile(directory_path, search_string)    
-        print "Finished zipping files"
-        print "Uploading datasets"
-        resource_info = self.upload_resource(tar_file_path, overwrite)
-        os.remove(tar_file_path)
+        print "Zipping and uploading files for watershed: %s %s" % (self.watershed, self.subbasin)
+        output_tar_file =  os.path.join(os.path.dirname(directory_path), "%s.tar.gz" % self.resource_name)
+        resource_info = self.zip_upload_files(glob(os.path.join(directory_path, search_string)),
+                                              output_tar_file,
+                                              overwrite)
+        self.hash_manifest.save()
         print "Finished uploading datasets"
         return resource_info
            
     def get_resource_info(self):
         """
-        This function gets the info of a resource
+        This function gets the info of a resource
+        """
+        dataset_id = self.get_dataset_id()
+        if dataset_id:
+            #check if resource exists in the dataset
+            for resource in self.get_dataset_resources(dataset_id):
+                if resource['name'] == self.resource_name:
+                    return resource
+        return None
+
+    def get_dataset_info(self):
+        """
+        This function gets the info of a resource
+        """
+        dataset_info = self.metadata_cache.get(('dataset_info', self.dataset_name))
+        if dataset_info:
+            return dataset_info
+        # Use the json module to load CKAN's response into a dictionary.
+        response_dict = self.dataset_engine.search_datasets({ 'name': self.dataset_name })
+        
+        if response_dict['success']:
+            if int(response_dict['result']['count']) > 0:
+                for dataset in response_dict['result']['results']:
+                    if dataset['name'] == self.dataset_name:
+                        self.metadata_cache.set(('dataset_info', self.dataset_name), dataset)
+                        self.metadata_cache.set(('dataset_id', self.dataset_name), dataset['id'])
+                        return dataset
+            return None
+        else:
+            return None
+
+    def search_datasets_by_prefix(self, name_prefix, num_days, **kwargs):
+        """
+        This function finds all datasets with names starting with name_prefix
+        modified in the last num_days with one search. Returns None if the
+        search failed
+        """
+        try:
+            response_dict = self.dataset_engine.search_datasets({'name': '%s*' % name_prefix},
+                                                                {'metadata_modified': '[NOW-%sDAYS TO *]' % num_days},
+                                                                rows=1000,
+                                                                **kwargs)
+        except Exception, ex:
+            print ex
+            return None
+        if not response_dict or not response_dict['success']:
+            return None
+        datasets = [dataset for dataset in response_dict['result']['results'] \
+                    if dataset['name'].startswith(name_prefix)]
+        for dataset in datasets:
+            if 'resources' in dataset:
+                self.metadata_cache.set(('dataset_info', dataset['name']), dataset)
+            self.metadata_cache.set(('dataset_id', dataset['name']), dataset['id'])
+        return datasets
+
+    
+    def download_resource_from_info(self, extract_directory, resource_info_array, local_file=None, members=None):
+        """
+        Downloads a resource from url. If members is set, only the archive
+        members matching those names or glob patterns are extracted
+        """
+        data_downloaded = False
+        #only download if file does not exist already
+        check_location = extract_directory
+        if local_file:
+            check_location = os.path.join(extract_directory, local_file)
+        data_exists = os.path.exists(check_location)
+        if members and not local_file:
+            #the selected members exist if each pattern matches a local file
+            if isinstance(members, basestring):
+                members = [members]
+            data_exists = all(glob(os.path.join(extract_directory, pattern)) for pattern in members)
+        if data_exists and os.path.isdir(extract_directory):
+            #resume resources with interrupted downloads
+            partial_files = glob(os.path.join(extract_directory, "*.part"))
+            resource_info_array = [resource_info for resource_info in resource_info_array \
+                                   if self.get_partial_file_path(resource_info, extract_directory) in partial_files]
+            if resource_info_array:
+                print "Resuming interrupted downloads ..."
+        if not data_exists or resource_info_array:
+            print "Downloading and extracting files for watershed:", self.watershed, self.subbasin
+            try:
+                os.makedirs(extract_directory)
+            except OSError:
+                pass
+            for status in self.download_resources(extract_directory, resource_info_array, members):
+                if status['error']:
+                    print status['name'], status['error']
+                elif status['downloaded']:
+                    data_downloaded = True
+                
+            print "Finished downloading and extracting file(s)"
+            return data_downloaded
+        else:
+            print "Resource exists locally. Skipping ..."
+            return False
+
+    def download_resources(self, extract_directory, resource_info_array, members=None):
+        """
+        This function downloads and extracts the resources with up to
+        download_workers at once and returns a list with the status
+        of each resource
+        """
+        if self.download_workers > 1 and len(resource_info_array) > 1:
+            download_pool = ThreadPool(min(self.download_workers, len(resource_info_array)))
+            try:
+                return download_pool.map(lambda resource_info: self._download_resource_status(resource_info,
+                                                                                              extract_directory,
+                                                                                              members),
+                                         resource_info_array)
+            finally:
+                download_pool.close()
+                download_pool.join()
+        return [self._download_resource_status(resource_info, extract_directory, members) \
+                for resource_info in resource_info_array]
+
+    def _download_resource_status(self, resource_info, extract_directory, members=None):
+        """
+        This function downloads and extracts one resource and returns its status
+        """
+        status = {'name': resource_info['name'],
+                  'id': resource_info.get('id'),
+                  'downloaded': False,
+                  'error': None,
+                  'seconds': 0}
+        start_time = time.time()
+        try:
+            status['downloaded'] = self.download_and_extract_resource(resource_info, extract_directory, members)
+        except Exception, ex:
+            status['error'] = ex
+        status['seconds'] = time.time() - start_time
+        return status
+
+    def download_and_extract_resource(self, resource_info, extract_directory, members=None):
+        """
+        This function downloads a resource and extracts it into the directory.
+        With stream_download, compressed tar resources are extracted from the
+        response as they arrive to a temporary directory that is moved into
+        place once the size and hash are verified; zip resources are
+        downloaded to a local file first.
+        With a resource cache, archives are taken from the cache or downloaded
+        into it instead. If members is set, only the matching members are written.
+        Only the needed byte ranges of ensemble bundles are downloaded
+        """
+        file_format = resource_info['format'].lower().lstrip('.')
+        if file_format == BUNDLE_FORMAT:
+            return self.download_bundle_members(resource_info, extract_directory, members)
+        codec = find_codec(file_format)
+        if codec:
+            codec.check_available()
+        partial_file_path = self.get_partial_file_path(resource_info, extract_directory)
+        #partial downloads from a local copy are resumed instead of streamed again
+        if self.stream_download and codec and not self.resource_cache and \
+                not (os.path.exists(partial_file_path) and os.path.getsize(partial_file_path)):
+            #the empty partial file marks the resource as incomplete until the
+            #members extracted to a temporary directory are verified and moved
+            with open(partial_file_path, 'wb'):
+                pass
+            stream_directory = "%s.extract" % partial_file_path
+            if os.path.exists(stream_directory):
+                rmtree(stream_directory)
+            try:
+                with closing(self.request('get', resource_info['url'], stream=True)) as r:
+                    r.raise_for_status()
+                    r.raw.decode_content = True
+                    response_reader = _HashingReader(r.raw)
+                    with self.metrics.timer('download_extract', resource_info['name']) as timer:
+                        with tarfile.open(fileobj=codec.open_reader(response_reader), mode="r|",
+                                          bufsize=self.download_chunk_size) as tar:
+                            extract_tar_members(tar, stream_directory, members)
+                        #read the end of the archive to check it against the hash
+                        while response_reader.read(self.download_chunk_size):
+                            pass
+                        timer.bytes = response_reader.size
+                verify_resource_data(resource_info, response_reader.size, response_reader.hash.hexdigest())
+                move_extracted_files(stream_directory, extract_directory)
+            finally:
+                if os.path.exists(stream_directory):
+                    rmtree(stream_directory)
+            os.remove(partial_file_path)
+            return True
+
+        local_tar_file = "%s.%s" % (resource_info['name'], file_format)
+        local_tar_file_path = os.path.join(extract_directory,
+                                           local_tar_file)
+        if self.resource_cache and self.resource_cache.fetch(resource_info, local_tar_file_path):
+            self.metrics.record('cache_hit', 0, os.path.getsize(local_tar_file_path), resource_info['name'])
+        else:
+            #the partial file marks the resource as incomplete even if the
+            #download fails before any data arrives
+            with open(partial_file_path, 'ab'):
+                pass
+            with self.metrics.timer('download', resource_info['name']) as timer:
+                self.download_file(resource_info['url'], partial_file_path, resource_info.get('size'))
+                timer.bytes = os.path.getsize(partial_file_path)
+            try:
+                verify_resource_data(resource_info,
+                                     os.path.getsize(partial_file_path),
+                                     get_file_hash(partial_file_path))
+            except IOError:
+                #keep an empty partial file so it is downloaded again next time
+                with open(partial_file_path, 'wb'):
+                    pass
+                raise
+            if self.resource_cache:
+                self.resource_cache.store(resource_info, partial_file_path)
+            os.rename(partial_file_path, local_tar_file_path)
+        try:
+            if not codec and file_format != "zip":
+                print "Unsupported file format. Skipping ..."
+                return False
+            with self.metrics.timer('extract', resource_info['name']) as timer:
+                timer.bytes = os.path.getsize(local_tar_file_path)
+                if codec:
+                    with open(local_tar_file_path, 'rb') as local_tar:
+                        with tarfile.open(fileobj=codec.open_reader(local_tar), mode="r|",
+                                          bufsize=self.download_chunk_size) as tar:
+                            extract_tar_members(tar, extract_directory, members)
+                else:
+                    with zipfile.ZipFile(local_tar_file_path) as zip_file:
+                        extract_zip_members(zip_file, extract_directory, members)
+        finally:
+            try:
+                os.remove(local_tar_file_path)
+            except OSError:
+                pass
+        return True
+
+    def get_byte_range(self, url, start, length=None):
+        """
+        This function returns the bytes of a url from start (or the last
+        -start bytes if start is negative) with an HTTP Range request and
+        the size of the whole file. If the server ignores the range, the
+        bytes are taken from the whole file
+        """
+        if start < 0:
+            range_header = 'bytes=%d' % start
+        else:
+            range_header = 'bytes=%d-%d' % (start, start + length - 1)
+        r = self.request('get', url, headers={'Range': range_header})
+        r.raise_for_status()
+        if r.status_code == 206:
+            file_size_match = re.search(r'/(\d+)$', r.headers.get('Content-Range', ''))
+            if not file_size_match:
+                raise BundleFormatError("Range response without the file size for %s" % url)
+            return r.content, int(file_size_match.group(1))
+        data = r.content
+        if start < 0:
+            return data[start:], len(data)
+        return data[start:start + length], len(data)
+
+    def get_bundle_index(self, resource_info, tail_size=64*1024):
+        """
+        This function returns the index of an ensemble bundle resource
+        read from the last tail_size bytes (or the index range if it is
+        larger)
+        """
+        cache_key = ('bundle_index', resource_info['id'], resource_info.get('hash'))
+        index = self.metadata_cache.get(cache_key)
+        if index:
+            return index
+        tail_data, file_size = self.get_byte_range(resource_info['url'], -tail_size)
+        index_offset, index_length = read_bundle_footer(tail_data)
+        tail_offset = file_size - len(tail_data)
+        if index_offset >= tail_offset:
+            index_data = tail_data[index_offset - tail_offset:index_offset - tail_offset + index_length]
+        else:
+            index_data = self.get_byte_range(resource_info['url'], index_offset, index_length)[0]
+        try:
+            index = json.loads(index_data)
+        except ValueError:
+            raise BundleFormatError("Bundle index of %s is corrupt" % resource_info['name'])
+        self.metadata_cache.set(cache_key, index)
+        return index
+
+    def download_bundle_members(self, resource_info, extract_directory, members=None):
+        """
+        This function downloads the members of an ensemble bundle matching
+        the names or glob patterns in members (all if not set) with HTTP
+        Range requests. Members next to each other are read together up to
+        segment_size bytes, on up to download_workers connections
+        """
+        index = self.get_bundle_index(resource_info)
+        member_ranges = []
+        for member in sorted(index['members'], key=lambda member: member['offset']):
+            if not member_selected(member['name'], members):
+                continue
+            if member_ranges:
+                last_member = member_ranges[-1][-1]
+                range_length = last_member['offset'] + last_member['length'] - member_ranges[-1][0]['offset']
+                if last_member['offset'] + last_member['length'] == member['offset'] and \
+                        range_length + member['length'] <= self.segment_size:
+                    member_ranges[-1].append(member)
+                    continue
+            member_ranges.append([member])
+
+        def download_member_range(range_members):
+            range_start = range_members[0]['offset']
+            range_length = range_members[-1]['offset'] + range_members[-1]['length'] - range_start
+            with self.metrics.timer('download', resource_info['name']) as timer:
+                range_data = self.get_byte_range(resource_info['url'], range_start, range_length)[0]
+                timer.bytes = len(range_data)
+            if len(range_data) != range_length:
+                raise BundleFormatError("Bundle range of %s is truncated" % resource_info['name'])
+            with self.metrics.timer('extract', resource_info['name']) as timer:
+                timer.bytes = sum(member['size'] for member in range_members)
+                for member in range_members:
+                    member_start = member['offset'] - range_start
+                    data = read_bundle_member(range_data[member_start:member_start + member['length']], member)
+                    file_path = os.path.join(extract_directory, os.path.basename(member['name']))
+                    with open("%s.part" % file_path, 'wb') as member_file:
+                        member_file.write(data)
+                    os.rename("%s.part" % file_path, file_path)
+
+        if self.download_workers > 1 and len(member_ranges) > 1:
+            range_pool = ThreadPool(min(self.download_workers, len(member_ranges)))
+            try:
+                range_pool.map(download_member_range, member_ranges)
+            finally:
+                range_pool.close()
+                range_pool.join()
+        else:
+            for range_members in member_ranges:
+                download_member_range(range_members)
+        return len(member_ranges) > 0
+
+    def get_partial_file_path(self, resource_info, extract_directory):
+        """
+        This function returns the path for the partial download of a resource
+        """
+        return os.path.join(extract_directory, "%s.%s.part" % (resource_info.get('id') or resource_info['name'],
+                                                                resource_info['format'].lower().lstrip('.')))
+
+    def request(self, method, url, idempotent=True, max_retries=None, **kwargs):
         """
-        dataset_id = self.get_dataset_id()
-        if dataset_id:
-            #check if dataset already exists
-            resource_results = self.dataset_engine.search_resources({'name': self.resource_name},
-                                                                    datset_id=dataset_id)
+        This function sends an HTTP request with the pooled session through
+        the request governor if there is one. Requests time out after
+        request_timeout unless a timeout is given. Only the time until the
+        response headers arrive counts towards the governor latency, and
+        not at all for requests with a body, whose upload time depends on
+        its size
+        """
+        kwargs.setdefault('timeout', self.request_timeout)
+        session_method = getattr(self.http_session, method)
+        if self.request_governor:
+            return self.request_governor.call(session_method, (url,), kwargs,
+                                              idempotent=idempotent, max_retries=max_retries,
+                                              streamed=kwargs.get('stream', False),
+                                              check_latency=kwargs.get('data') is None)
+        return session_method(url, **kwargs)
+
+    def download_file(self, url, file_path, file_size=None):
+        """
+        This function downloads a url to a file, resuming from the end of an
+        existing partial file with HTTP Range requests. The partial file is
+        kept if the download fails so it can be resumed later. A response
+        that ends before file_size (or the size the server reports) is
+        resumed like an interrupted one. Files of at least segment_threshold
+        bytes are downloaded in segments if download_segments is more than one
+        """
+        segment_state_path = self.get_segment_state_path(file_path)
+        downloaded_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        if self.download_segments > 1 and \
+                (not downloaded_size or os.path.exists(segment_state_path)):
+            if not file_size:
+                file_size = self.get_remote_file_size(url)
+            if file_size and int(file_size) >= self.segment_threshold:
+                try:
+                    return self.download_file_segments(url, file_path, int(file_size))
+                except SegmentedDownloadError, ex:
+                    print ex, "Downloading in one stream ..."
+                    os.remove(file_path)
+                    os.remove(segment_state_path)
+        for attempt in range(self.download_retries + 1):
+            downloaded_size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            headers = {'Range': 'bytes=%s-' % downloaded_size} if downloaded_size else {}
             try:
-                if resource_results['result']['count'] > 0:
-                    for resource in resource_results['result']['results']:
-                        if resource['name'] == self.resource_name:
-                            #upload resources to the dataset
-                            return resource
-            except Exception,e:
-                print e
-                pass
-        return None
+                with closing(self.request('get', url, stream=True, headers=headers)) as r:
+                    if r.status_code == 416:
+                        #partial file already complete
+                        return
+                    r.raise_for_status()
+                    expected_size = int(file_size) if file_size else get_response_file_size(r, downloaded_size)
+                    #append if the server honored the range request
+                    with open(file_path, 'ab' if r.status_code == 206 else 'wb') as f:
+                        for chunk in r.iter_content(chunk_size=self.download_chunk_size): 
+                            if chunk: # filter out keep-alive new chunks
+                                f.write(chunk)
+                #a connection closed cleanly ends the body without an error
+                downloaded_size = os.path.getsize(file_path)
+                if expected_size and downloaded_size < expected_size:
+                    raise IncompleteDownloadError("Download ended after %s of %s bytes" % \
+                                                  (downloaded_size, expected_size))
+                return
+            except (RequestException, socket.error, IncompleteDownloadError), ex:
+                if attempt >= self.download_retries:
+                    raise
+                print "Download interrupted (%s). Resuming ..." % ex
+                time.sleep(2**attempt)
 
-    def get_dataset_info(self):
+    def get_remote_file_size(self, url):
         """
-        This function gets the info of a resource
+        This function returns the size of the file at the url if the server
+        accepts range requests for it, otherwise None
         """
-        # Use the json module to load CKAN's response into a dictionary.
-        response_dict = self.dataset_engine.search_datasets({ 'name': self.dataset_name })
-        
-        if response_dict['success']:
-            if int(response_dict['result']['count']) > 0:
-                for dataset in response_dict['result']['results']:
-                    if dataset['name'] == self.dataset_name:
-                        #upload resources to the dataset
-                        return dataset
-            return None
-        else:
+        try:
+            r = self.request('head', url, allow_redirects=True)
+        except (RequestException, socket.error):
             return None
+        if r.status_code == 200 and r.headers.get('Accept-Ranges') == 'bytes' and \
+                r.headers.get('Content-Length'):
+            return int(r.headers['Content-Length'])
+        return None
 
-    
-    def download_resource_from_info(self, extract_directory, resource_info_array, local_file=None):
+    def get_segment_state_path(self, file_path):
         """
-        Downloads a resource from url
+        This function returns the path of the record of the completed
+        segments of a segmented download
         """
-        data_downloaded = False
-        #only download if file does not exist already
-        check_location = extract_directory
-        if local_file:
-            check_location = os.path.join(extract_directory, local_file)
-        if not os.path.exists(check_location):
-            print "Downloading and extracting files for watershed:", self.watershed, self.subbasin
+        return "%s.segments" % file_path
+
+    def download_file_segments(self, url, file_path, file_size):
+        """
+        This function downloads a url to a file of file_size bytes in byte
+        range segments over download_segments connections at once. Each
+        segment is written at its offset in the preallocated file and the
+        completed segments are recorded so an interrupted download resumes
+        with the missing ones
+        """
+        state_path = self.get_segment_state_path(file_path)
+        segment_size = max(self.segment_size, -(-file_size // (self.download_segments*4)))
+        segments = [(offset, min(offset + segment_size, file_size) - 1) \
+                    for offset in range(0, file_size, segment_size)]
+        completed_segments = set()
+        if os.path.exists(state_path) and os.path.exists(file_path):
             try:
-                os.makedirs(extract_directory)
-            except OSError:
+                with open(state_path) as state_file:
+                    segment_state = json.load(state_file)
+                if segment_state['size'] == file_size and segment_state['segment_size'] == segment_size:
+                    completed_segments = set(segment_state['completed'])
+            except ValueError:
                 pass
-            for resource_info in resource_info_array:
-                #for resource
-                file_format = resource_info['format']
-                
-                local_tar_file = "%s.%s" % (resource_info['name'], file_format)
-                    
-                local_tar_file_path = os.path.join(extract_directory,
-                                                   local_tar_file)
-                if os.path.exists(local_tar_file_path):
-                    print "Local raw file found. Skipping ..."
-                    data_downloaded = False
-                try:    
-                    r = get(resource_info['url'], stream=True)
-                    with open(local_tar_file_path, 'wb') as f:
-                        for chunk in r.iter_content(chunk_size=1024): 
-                            if chunk: # filter out keep-alive new chunks
-                                f.write(chunk)
-                                f.flush()
-        
-                    if file_format.lower() == "tar.gz":
-                        with tarfile.open(local_tar_file_path) as tar:
-                            tar.extractall(extract_directory)
-                    elif file_format.lower() == "zip":
-                        with zipfile.ZipFile(local_tar_file_path) as zip_file:
-                            zip_file.extractall(extract_directory)
-                    else:
-                        print "Unsupported file format. Skipping ..."
-                except Exception, ex:
-                    print ex
-                    data_downloaded = False
-                    pass
-                
+        #preallocate the file
+        with open(file_path, 'ab'):
+            pass
+        with open(file_path, 'r+b') as segment_file:
+            segment_file.truncate(file_size)
+
+        state_lock = threading.Lock()
+        def save_state():
+            temp_state_path = "%s.%s.tmp" % (state_path, uuid.uuid4().hex)
+            with open(temp_state_path, 'w') as state_file:
+                json.dump({'size': file_size,
+                           'segment_size': segment_size,
+                           'completed': sorted(completed_segments)}, state_file)
+            os.rename(temp_state_path, state_path)
+        save_state()
+
+        def download_segment(segment_index):
+            start, end = segments[segment_index]
+            for attempt in range(self.download_retries + 1):
                 try:
-                    os.remove(local_tar_file_path)
-                except OSError:
-                    pass
-                
-            print "Finished downloading and extracting file(s)"
-            return data_downloaded
-        else:
-            print "Resource exists locally. Skipping ..."
-            return False
+                    written_size = 0
+                    with closing(self.request('get', url, stream=True,
+                                              headers={'Range': 'bytes=%s-%s' % (start, end)})) as r:
+                        r.raise_for_status()
+                        if r.status_code != 206:
+                            raise SegmentedDownloadError("The server does not support range requests for %s" % url)
+                        with open(file_path, 'r+b') as segment_file:
+                            segment_file.seek(start)
+                            for chunk in r.iter_content(chunk_size=self.download_chunk_size):
+                                if chunk:
+                                    segment_file.write(chunk)
+                                    written_size += len(chunk)
+                    if written_size != end - start + 1:
+                        raise IOError("Segment %s-%s was cut short" % (start, end))
+                    with state_lock:
+                        completed_segments.add(segment_index)
+                        save_state()
+                    return
+                except SegmentedDownloadError:
+                    raise
+                except (RequestException, socket.error, IOError), ex:
+                    if attempt >= self.download_retries:
+                        raise
+                    print "Segment download interrupted (%s). Retrying ..." % ex
+                    time.sleep(2**attempt)
+
+        pending_segments = [segment_index for segment_index in range(len(segments)) \
+                            if segment_index not in completed_segments]
+        if pending_segments:
+            segment_pool = ThreadPool(min(self.download_segments, len(pending_segments)))
+            try:
+                segment_pool.map(download_segment, pending_segments)
+            finally:
+                segment_pool.close()
+                segment_pool.join()
+        os.remove(state_path)
 
-    def download_resource(self, extract_directory, local_file=None):
+    def download_resource(self, extract_directory, local_file=None, members=None):
         """
-        This function downloads a resource
+        This function downloads a resource. If members is set, only the
+        archive members matching those names or glob patterns are extracted
         """
         resource_info = self.get_resource_info()
         if resource_info:
             return self.download_resource_from_info(extract_directory, 
                                                     [resource_info],
-                                                     local_file)
+                                                     local_file,
+                                                     members)
         else:
             print "Resource not found in CKAN. Skipping ..."
             return False
 
-    def download_prediction_resource(self, watershed, subbasin, date_string, extract_directory):
+    def download_prediction_resource(self, watershed, subbasin, date_string, extract_directory, members=None):
         """
         This function downloads a prediction resource
         """
         self.initialize_run(watershed, subbasin, date_string)
-        self.download_resource(extract_directory)
+        self.download_resource(extract_directory, members=members)
 
 #------------------------------------------------------------------------------
 #ECMWF RAPID Dataset Manager Class
@@ -320,15 +2993,32 @@ class ECMWFRAPIDDatasetManager(CKANDatasetManager):
     This class is used to find and download, zip and upload ECMWFRAPID 
     prediction files from/to a data server
     """
-    def __init__(self, engine_url, api_key):
+    #dataset fields searched to check if forecast runs are ready
+    readiness_fields = 'id,name,num_resources,metadata_modified'
+    #most resources of a run uploaded as an ensemble bundle (the bundle and
+    #the warning points pack or files)
+    bundle_resource_limit = 4
+
+    def __init__(self, engine_url, api_key, readiness_state_file=None, pack_warning_points=False,
+                 bundle_ensembles=False, **kwargs):
         super(ECMWFRAPIDDatasetManager, self).__init__(engine_url, 
                                                         api_key,
                                                         'erfp',
                                                         "ECMWF-RAPID Flood Predicition Dataset",
                                                         'This dataset contians NetCDF3 files produced by '
                                                         'downscalsing ECMWF forecasts and routing them with RAPID',
-                                                        "%Y%m%d.%H"
+                                                        "%Y%m%d.%H",
+                                                        **kwargs
                                                         )
+        #readiness of the forecast runs checked so far
+        self.readiness_state = ReadinessState(readiness_state_file)
+        self.manager_options['readiness_state_file'] = readiness_state_file
+        #upload the warning points files of a run as one zip resource
+        self.pack_warning_points = pack_warning_points
+        self.manager_options['pack_warning_points'] = pack_warning_points
+        #upload the ensembles of a run as one range readable bundle resource
+        self.bundle_ensembles = bundle_ensembles
+        self.manager_options['bundle_ensembles'] = bundle_ensembles
                                                         
     def initialize_run_ecmwf(self, watershed, subbasin, date_string):
         """
@@ -363,128 +3053,671 @@ class ECMWFRAPIDDatasetManager(CKANDatasetManager):
                                                                 self.date_string,
                                                                 return_period)
 
+    def update_resource_ensemble_bundle(self):
+        """
+        Set the resource name for the ensemble bundle of the run
+        """
+        self.resource_name = '%s-%s-%s-%s-ensembles' % (self.model_name,
+                                                        self.watershed,
+                                                        self.subbasin,
+                                                        self.date_string)
+
+    def update_resource_warning_points_pack(self):
+        """
+        Set the resource name for the warning points pack of the run
+        """
+        self.resource_name = '%s-%s-%s-%s-warning_points' % (self.model_name,
+                                                             self.watershed,
+                                                             self.subbasin,
+                                                             self.date_string)
+
     def get_subbasin_name_list(self, source_directory, subbasin_name_search):
         """
         Get a list of subbasins in directory
         """
         subbasin_list = []
+        subbasin_names = set()
         outflow_files = sorted(glob(os.path.join(source_directory,'Qout_*.nc')))
         for outflow_file in outflow_files:
             subbasin_name = subbasin_name_search.search(os.path.basename(outflow_file)).group(1)
-            if subbasin_name not in subbasin_list:
+            if subbasin_name not in subbasin_names:
+                subbasin_names.add(subbasin_name)
                 subbasin_list.append(subbasin_name)
         return subbasin_list
 
     def zip_upload_warning_points_in_directory(self, directory_path, search_string="return_*_points.txt"):
         """
         This function packages all of the datasets into individual tar.gz files and
-        uploads them to the dataset
+        uploads them to the dataset. With pack_warning_points they are
+        uploaded as one warning points pack instead
         """
-        base_path = os.path.dirname(directory_path)
-        return_period_search = re.compile(r'return_(\d+)_points\.txt')
-
         #zip file and get dataset information
         print "Zipping and uploading warning points files for watershed: %s %s" % (self.watershed, self.subbasin)
         directory_files = glob(os.path.join(directory_path,search_string))
-        for directory_file in directory_files:
-            return_period = return_period_search.search(os.path.basename(directory_file)).group(1)
+        if self.pack_warning_points:
+            return self.pack_upload_warning_points(directory_files)
+        self.zip_upload_warning_point_files(directory_files)
+
+    def zip_upload_warning_point_files(self, warning_point_files):
+        """
+        This function packages each of the warning points files into
+        individual tar.gz files and uploads them to the dataset
+        """
+        return_period_search = re.compile(r'return_(\d+)_points\.txt')
+        for warning_point_file in warning_point_files:
+            return_period = return_period_search.search(os.path.basename(warning_point_file)).group(1)
             self.update_resource_return_period(return_period)
-            #tar.gz file
+            #tar.gz file and upload file
+            base_path = os.path.dirname(os.path.dirname(warning_point_file))
             output_tar_file =  os.path.join(base_path, "%s.tar.gz" % self.resource_name)
-            if not os.path.exists(output_tar_file):
-                with tarfile.open(output_tar_file, "w:gz") as tar:
-                    tar.add(directory_file, arcname=os.path.basename(directory_file))
-            #upload file
-            self.upload_resource(output_tar_file)
-            os.remove(output_tar_file)
-        print "%s datasets uploaded" % len(directory_files)
+            self.zip_upload_files([warning_point_file], output_tar_file)
+        self.hash_manifest.save()
+        print "%s datasets uploaded" % len(warning_point_files)
+
+    def make_warning_points_pack(self, warning_point_files):
+        """
+        This function packages the warning points files into a zip file and
+        returns the path and the resource fields listing the return periods
+        """
+        pack_file = os.path.join(os.path.dirname(os.path.dirname(warning_point_files[0])),
+                                 "%s.zip" % self.resource_name)
+        with self.metrics.timer('compress', self.resource_name) as timer:
+            with open(pack_file, 'wb') as output_file:
+                manifest = write_warning_points_pack(warning_point_files, output_file)
+            timer.bytes = sum(file_info['size'] for file_info in manifest['files'].values())
+        return pack_file, {'return_periods': ",".join(manifest['return_periods'])}
+
+    def pack_upload_warning_points(self, warning_point_files, overwrite=False):
+        """
+        This function uploads the warning points files of the run as one zip
+        resource with the return periods in its manifest and resource fields
+        """
+        if not warning_point_files:
+            return None
+        self.update_resource_warning_points_pack()
+        source_hash = self.get_source_hash(warning_point_files)
+        self.hash_manifest.save()
+        if self.find_unchanged_resource(source_hash):
+            print "Resource", self.resource_name ,"unchanged. Skipping ..."
+            return None
+        pack_file, resource_extras = self.make_warning_points_pack(warning_point_files)
+        try:
+            resource_info = self.upload_resource(pack_file, overwrite, 'zip', source_hash, resource_extras)
+        finally:
+            os.remove(pack_file)
+        print "%s warning points files uploaded" % len(warning_point_files)
+        return resource_info
+
+    def make_ensemble_bundle(self, forecast_files):
+        """
+        This function packages the forecast files into an ensemble bundle and
+        returns the path and the resource fields listing the ensembles
+        """
+        ensemble_number_search = re.compile(r'Qout_\w+_(\d+)\.nc')
+        forecast_files = sorted(forecast_files,
+                                key=lambda file_path: int(ensemble_number_search.search(os.path.basename(file_path)).group(1)))
+        bundle_file = os.path.join(os.path.dirname(os.path.dirname(forecast_files[0])),
+                                   "%s.%s" % (self.resource_name, BUNDLE_FORMAT))
+        with self.metrics.timer('compress', self.resource_name) as timer:
+            with open(bundle_file, 'wb') as output_file:
+                index = write_ensemble_bundle(forecast_files, output_file,
+                                              get_codec('gzip').get_level(self.compression_level),
+                                              self.compression_workers)
+            timer.bytes = sum(member['size'] for member in index['members'])
+        return bundle_file, {'ensembles': ",".join(member['ensemble'] for member in index['members'])}
+
+    def bundle_upload_forecast_files(self, forecast_files):
+        """
+        This function uploads the forecast files of the run as one ensemble
+        bundle resource, replacing the bundle if the files changed
+        """
+        if not forecast_files:
+            return None
+        print "Bundling and uploading files for watershed: %s %s" % (self.watershed, self.subbasin)
+        self.update_resource_ensemble_bundle()
+        source_hash = self.get_source_hash(forecast_files)
+        self.hash_manifest.save()
+        if self.find_unchanged_resource(source_hash):
+            print "Resource", self.resource_name ,"unchanged. Skipping ..."
+            return None
+        bundle_file, resource_extras = self.make_ensemble_bundle(forecast_files)
+        try:
+            resource_info = self.upload_resource(bundle_file, True, BUNDLE_FORMAT, source_hash, resource_extras)
+        finally:
+            os.remove(bundle_file)
+        print "%s ensembles uploaded" % len(forecast_files)
+        return resource_info
+
+    def download_ensembles(self, watershed, subbasin, date_string, extract_directory, ensembles=None):
+        """
+        This function downloads the forecast files of a run, only the
+        ensembles listed if set. From an ensemble bundle only the byte
+        ranges of those ensembles are downloaded; runs without a bundle are
+        downloaded from the individual resources
+        """
+        self.initialize_run_ecmwf(watershed, subbasin, date_string)
+        self.update_resource_ensemble_bundle()
+        members = None
+        if ensembles:
+            members = ['Qout_*_%s.nc' % ensemble for ensemble in ensembles]
+        resource_info = self.get_resource_info()
+        if resource_info:
+            return self.download_resource_from_info(extract_directory, [resource_info], members=members)
+        dataset_id = self.get_dataset_id()
+        if not dataset_id:
+            print "Resource not found in CKAN. Skipping ..."
+            return False
+        ensemble_search = re.compile(r'-%s-(\d+)$' % re.escape(self.date_string))
+        resource_info_array = []
+        for resource in self.get_dataset_resources(dataset_id):
+            ensemble_match = ensemble_search.search(resource['name'])
+            if ensemble_match and (not ensembles or \
+                    ensemble_match.group(1) in [str(ensemble) for ensemble in ensembles]):
+                resource_info_array.append(resource)
+        return self.download_resource_from_info(extract_directory, resource_info_array, members=members)
+
+    def download_warning_points(self, watershed, subbasin, date_string, extract_directory, return_periods=None):
+        """
+        This function downloads the warning points files of a run, only
+        extracting the return_periods if set. Runs without a warning points
+        pack are downloaded from the individual resources
+        """
+        self.initialize_run_ecmwf(watershed, subbasin, date_string)
+        self.update_resource_warning_points_pack()
+        if return_periods:
+            members = [WARNING_POINTS_FILE % return_period for return_period in return_periods]
+        else:
+            members = [WARNING_POINTS_FILE % '*']
+        resource_info = self.get_resource_info()
+        if resource_info:
+            return self.download_resource_from_info(extract_directory, [resource_info], members=members)
+        dataset_id = self.get_dataset_id()
+        if not dataset_id:
+            print "Resource not found in CKAN. Skipping ..."
+            return False
+        warning_points_search = re.compile(r'-warning_points_(\d+)$')
+        resource_info_array = []
+        for resource in self.get_dataset_resources(dataset_id):
+            return_period_match = warning_points_search.search(resource['name'])
+            if return_period_match and (not return_periods or \
+                    return_period_match.group(1) in [str(return_period) for return_period in return_periods]):
+                resource_info_array.append(resource)
+        return self.download_resource_from_info(extract_directory, resource_info_array, members=members)
 
-    def zip_upload_forecasts_in_directory(self, directory_path, search_string="*.nc"):
+    def zip_upload_forecasts_in_directory(self, directory_path, search_string="*.nc", num_workers=None):
         """
         This function packages all of the datasets into individual tar.gz files and
         uploads them to the dataset
+        If num_workers is set, the pipelined upload is used and a list with the
+        result for each ensemble is returned
         """
-        base_path = os.path.dirname(directory_path)
+        return self.zip_upload_forecast_files(glob(os.path.join(directory_path,search_string)), num_workers)
+
+    def zip_upload_forecast_files(self, forecast_files, num_workers=None):
+        """
+        This function packages each of the forecast files into individual
+        tar.gz files and uploads them to the dataset
+        If num_workers is set, the pipelined upload is used and a list with the
+        result for each ensemble is returned. With bundle_ensembles the files
+        are uploaded as one ensemble bundle instead
+        """
+        if self.bundle_ensembles:
+            return self.bundle_upload_forecast_files(forecast_files)
+        if num_workers:
+            return self.pipeline_upload_forecast_files(sorted(forecast_files), num_workers)
+
         ensemble_number_search = re.compile(r'Qout_\w+_(\d+)\.nc')
 
         #zip file and get dataset information
         print "Zipping and uploading files for watershed: %s %s" % (self.watershed, self.subbasin)
-        directory_files = glob(os.path.join(directory_path,search_string))
-        for directory_file in directory_files:
-            ensemble_number = ensemble_number_search.search(os.path.basename(directory_file)).group(1)
+        resource_info = None
+        for forecast_file in forecast_files:
+            ensemble_number = ensemble_number_search.search(os.path.basename(forecast_file)).group(1)
             self.update_resource_ensemble_number(ensemble_number)
-            #tar.gz file
+            #tar.gz file and upload file
+            base_path = os.path.dirname(os.path.dirname(forecast_file))
             output_tar_file =  os.path.join(base_path, "%s.tar.gz" % self.resource_name)
-            if not os.path.exists(output_tar_file):
-                with tarfile.open(output_tar_file, "w:gz") as tar:
-                    tar.add(directory_file, arcname=os.path.basename(directory_file))
-            #upload file
-            resource_info = self.upload_resource(output_tar_file)
-            os.remove(output_tar_file)
-        print "%s datasets uploaded" % len(directory_files)
+            resource_info = self.zip_upload_files([forecast_file], output_tar_file)
+        self.hash_manifest.save()
+        print "%s datasets uploaded" % len(forecast_files)
         return resource_info
 
-    def zip_upload_resources(self, source_directory):
+    def pipeline_upload_forecasts_in_directory(self, directory_path, search_string="*.nc", num_workers=4):
         """
-        This function packages all of the datasets in to tar.gz files and
-        returns their attributes
+        This function uploads the forecast files in the directory with
+        pipeline_upload_forecast_files
         """
-        watersheds = [d for d in os.listdir(source_directory) \
-                        if os.path.isdir(os.path.join(source_directory, d))]
-        subbasin_name_search = re.compile(r'Qout_(\w+)_\d+\.nc')
+        return self.pipeline_upload_forecast_files(sorted(glob(os.path.join(directory_path,search_string))),
+                                                   num_workers)
 
-        for watershed in watersheds:
-            watershed_dir = os.path.join(source_directory, watershed)
-            date_strings = [d for d in os.listdir(watershed_dir) \
-                            if os.path.isdir(os.path.join(watershed_dir, d))]
-            for date_string in date_strings:
-                subbasin_list = self.get_subbasin_name_list(os.path.join(watershed_dir, date_string), 
-                                                       subbasin_name_search)
-                for subbasin in subbasin_list:
-                    self.initialize_run_ecmwf(watershed, subbasin, date_string)
-                    self.zip_upload_forecasts_in_directory(os.path.join(watershed_dir, date_string),
-                                                           'Qout_%s*.nc' % subbasin)
+    def pipeline_upload_forecast_files(self, directory_files, num_workers=4):
+        """
+        This function packages the ensembles on a pool of num_workers threads
+        and uploads each tar.gz file on a second pool of num_workers threads
+        as soon as it is ready (with stream_upload the upload workers do both).
+        Returns a list of dictionaries with the ensemble number, resource info
+        and error for each file
+        """
+        ensemble_number_search = re.compile(r'Qout_\w+_(\d+)\.nc')
+
+        print "Zipping and uploading files for watershed: %s %s" % (self.watershed, self.subbasin)
+        zip_jobs = []
+        for directory_file in directory_files:
+            #each ensemble gets its own copy of the run state
+            run_manager = copy.copy(self)
+            run_manager.update_resource_ensemble_number(ensemble_number_search.search(os.path.basename(directory_file)).group(1))
+            zip_jobs.append((run_manager, directory_file))
+        if not zip_jobs:
+            return []
+
+        #create the dataset once so the upload workers do not race to create it
+        self.create_dataset()
+
+        zip_pool = ThreadPool(num_workers)
+        upload_pool = ThreadPool(num_workers)
+        results = []
+        upload_jobs = []
+        try:
+            #start each upload as soon as its archive is finished
+            for result in zip_pool.imap_unordered(_zip_ensemble_job, zip_jobs):
+                if result['error'] or result['skipped']:
+                    del result['manager']
+                    results.append(result)
+                else:
+                    upload_jobs.append(upload_pool.apply_async(_upload_ensemble_job, (result,)))
+            for upload_job in upload_jobs:
+                results.append(upload_job.get())
+        finally:
+            zip_pool.close()
+            upload_pool.close()
+            zip_pool.join()
+            upload_pool.join()
+
+        results.sort(key=lambda result: int(result['ensemble']))
+        errors = [result for result in results if result['error']]
+        for result in errors:
+            print "Ensemble", result['ensemble'], "failed:", result['error']
+        self.hash_manifest.save()
+        print "%s datasets uploaded" % len([result for result in results \
+                                            if not result['error'] and not result['skipped']])
+        return results
+
+    def zip_upload_resources(self, source_directory, num_workers=None, num_processes=None, journal_file=None):
+        """
+        This function packages all of the datasets in to tar.gz files and
+        returns their attributes. The warning points files of each run are
+        uploaded as well (as one pack with pack_warning_points), as in the
+        scheduler and the watch mode. If num_processes is set, the files are
+        uploaded by schedule_upload_resources
+        """
+        if num_processes:
+            return self.schedule_upload_resources(source_directory, num_processes, journal_file)
+        source_index = ForecastSourceIndex(source_directory, self.date_format_string)
+        for watershed, date_string, date_info in source_index.iter_date_directories():
+            for subbasin, forecast_files in date_info['subbasins'].items():
+                self.initialize_run_ecmwf(watershed, subbasin, date_string)
+                self.zip_upload_forecast_files([file_info['path'] for file_info in forecast_files],
+                                               num_workers)
+                #warning points belong to the only subbasin of the run
+                warning_point_files = [file_info['path'] for file_info in date_info['warning_points'] \
+                                       if file_info['subbasin'] == subbasin]
+                if not warning_point_files:
+                    continue
+                print "Zipping and uploading warning points files for watershed: %s %s" % (self.watershed,
+                                                                                          self.subbasin)
+                if self.pack_warning_points:
+                    #packs of files that changed replace the previous upload
+                    self.pack_upload_warning_points(warning_point_files, overwrite=True)
+                else:
+                    self.zip_upload_warning_point_files(warning_point_files)
     
+    def find_completed_files(self, source_directory, file_states, stable_polls=2, sentinel_name=None,
+                             bundle_partial_runs=False):
+        """
+        This function scans the watershed/date directories for forecast and
+        warning points files and returns a job for each complete file. A file
+        is complete when its size and modification time have not changed for
+        stable_polls scans or its date directory has a sentinel_name file.
+        With pack_warning_points, the warning points files of a date directory
+        are returned as one job (with 'pack' and 'files') once all of them are
+        complete; with bundle_ensembles, so are the forecast files of each
+        subbasin once all 52 ensembles or the sentinel_name file are there,
+        or once all of them are complete if bundle_partial_runs is set.
+        file_states keeps the scan history between calls
+        """
+        source_index = ForecastSourceIndex(source_directory, self.date_format_string)
+        completed_files = []
+        seen_files = set()
+        #complete and incomplete files of the packs by date directory, subbasin and type
+        pack_jobs = OrderedDict()
+        for watershed, date_string, file_info in source_index.iter_files(newest_first=True):
+            file_path = file_info['path']
+            seen_files.add(file_path)
+            file_state = (file_info['size'], file_info['mtime'])
+            previous_state, stable_count = file_states.get(file_path, (None, 0))
+            stable_count = stable_count + 1 if file_state == previous_state else 0
+            file_states[file_path] = (file_state, stable_count)
+            if not file_info['subbasin']:
+                #warning points with more than one subbasin in the directory
+                continue
+            date_files = source_index.watersheds[watershed][date_string]['files']
+            file_complete = (sentinel_name and sentinel_name in date_files) or stable_count >= stable_polls - 1
+            if self.pack_warning_points and file_info['return_period']:
+                pack_jobs.setdefault((watershed, date_string, file_info['subbasin'], 'warning_points'),
+                                     []).append((file_info, file_complete))
+            elif self.bundle_ensembles and file_info['ensemble']:
+                pack_jobs.setdefault((watershed, date_string, file_info['subbasin'], 'ensembles'),
+                                     []).append((file_info, file_complete))
+            elif file_complete:
+                completed_files.append({'key': os.path.relpath(file_path, source_directory),
+                                        'file': file_path,
+                                        'watershed': watershed,
+                                        'date_string': date_string,
+                                        'subbasin': file_info['subbasin'],
+                                        'ensemble': file_info['ensemble'],
+                                        'return_period': file_info['return_period'],
+                                        'size': file_info['size'],
+                                        'mtime': file_info['mtime']})
+        for (watershed, date_string, subbasin, pack), file_jobs in pack_jobs.items():
+            #a pack is uploaded once all of its files are complete
+            if not all(file_complete for file_info, file_complete in file_jobs):
+                continue
+            date_files = source_index.watersheds[watershed][date_string]['files']
+            if pack == 'ensembles' and len(file_jobs) < 52 and not bundle_partial_runs and \
+                    not (sentinel_name and sentinel_name in date_files):
+                continue
+            date_dir = source_index.watersheds[watershed][date_string]['path']
+            pack_name = 'warning_points' if pack == 'warning_points' else '%s_ensembles' % subbasin
+            completed_files.append({'key': os.path.join(os.path.relpath(date_dir, source_directory), pack_name),
+                                    'file': date_dir,
+                                    'pack': pack,
+                                    'files': [file_info['path'] for file_info, file_complete in file_jobs],
+                                    'watershed': watershed,
+                                    'date_string': date_string,
+                                    'subbasin': subbasin,
+                                    'ensemble': None,
+                                    'return_period': None,
+                                    'size': sum(file_info['size'] for file_info, file_complete in file_jobs),
+                                    'mtime': max(file_info['mtime'] for file_info, file_complete in file_jobs)})
+        for file_path in file_states.keys():
+            if file_path not in seen_files:
+                del file_states[file_path]
+        return completed_files
+
+    def watch_upload_resources(self, source_directory, journal_file=None, num_workers=4,
+                               poll_interval=30, stable_polls=2, sentinel_name=None,
+                               stop_event=None, max_polls=None,
+                               max_attempts=5, retry_delay=60, max_retry_delay=3600):
+        """
+        This function watches the source directory and uploads each forecast
+        and warning points file on a pool of num_workers threads as soon as
+        it is complete (see find_completed_files). Uploaded files are recorded
+        in the journal so they are not uploaded again after a restart. A
+        failed upload is retried after retry_delay seconds, doubled after
+        each attempt up to max_retry_delay, until it has failed max_attempts
+        times; it is tried again once the file changes. Runs until
+        stop_event is set or max_polls scans are done and returns the number
+        of files uploaded
+        """
+        journal = UploadJournal(journal_file)
+        upload_pool = ThreadPool(num_workers)
+        dataset_lock = threading.Lock()
+        file_states = {}
+        pending = {}
+        num_uploaded = [0]
+        def finish_job(key, job, async_result):
+            result = async_result.get()
+            if result['error']:
+                print "Upload of", job['key'], "failed:", result['error']
+                entry = journal.record_failure(key, job['size'], job['mtime'], result['error'],
+                                               retry_delay, max_retry_delay)
+                if entry['attempts'] >= max_attempts:
+                    print "Upload of", job['key'], "failed", entry['attempts'], "times. Skipping until it changes ..."
+                return
+            resource_id = None
+            if result['resource_info']:
+                resource_id = result['resource_info']['result']['id']
+                num_uploaded[0] += 1
+                print "Uploaded", job['key']
+            journal.record(key,
+                           size=job['size'],
+                           mtime=job['mtime'],
+                           resource_id=resource_id,
+                           skipped=result['skipped'])
+
+        num_polls = 0
+        try:
+            while True:
+                for job in self.find_completed_files(source_directory, file_states, stable_polls, sentinel_name):
+                    if job['key'] in pending:
+                        continue
+                    if journal.is_complete(job['key'], job['size'], job['mtime']) or \
+                            not journal.is_retry_due(job['key'], job['size'], job['mtime'], max_attempts):
+                        continue
+                    pending[job['key']] = (job, upload_pool.apply_async(_upload_file_job,
+                                                                        (copy.copy(self), job, dataset_lock)))
+                for key, (job, async_result) in pending.items():
+                    if async_result.ready():
+                        del pending[key]
+                        finish_job(key, job, async_result)
+                self.hash_manifest.save()
+                num_polls += 1
+                if (stop_event and stop_event.is_set()) or (max_polls and num_polls >= max_polls):
+                    break
+                if stop_event:
+                    stop_event.wait(poll_interval)
+                else:
+                    time.sleep(poll_interval)
+            #wait for the uploads in progress
+            for key, (job, async_result) in pending.items():
+                async_result.wait()
+                finish_job(key, job, async_result)
+        finally:
+            upload_pool.close()
+            upload_pool.join()
+            journal.close()
+            self.hash_manifest.save()
+        return num_uploaded[0]
+
+    def schedule_upload_resources(self, source_directory, num_processes=4, journal_file=None):
+        """
+        This function uploads every forecast and warning points file in the
+        source directory as a separate job on a pool of num_processes worker
+        processes, newest forecast dates first and taking turns between
+        watersheds. Each worker gets its share of the request governor
+        limits and its metrics events are recorded in the metrics of this
+        manager. Finished jobs are checkpointed in the journal so a rerun
+        skips them. Returns a list of (job, result) for the jobs that ran
+        """
+        journal = UploadJournal(journal_file)
+        jobs = []
+        #the source directory is not being written, so runs with fewer
+        #ensembles are complete as they are
+        for job in self.find_completed_files(source_directory, {}, stable_polls=1, bundle_partial_runs=True):
+            if not journal.is_complete(job['key'], job['size'], job['mtime']):
+                jobs.append(job)
+        jobs = order_upload_jobs(jobs)
+        print "%s upload jobs scheduled" % len(jobs)
+        if not jobs:
+            journal.close()
+            return []
+
+        #create the datasets here so the worker processes do not race to create them
+        run_manager = copy.copy(self)
+        for job in jobs:
+            run_manager.initialize_run_ecmwf(job['watershed'], job['subbasin'], job['date_string'])
+            run_manager.create_dataset()
+
+        #each worker process gets its share of the request limits
+        governor_options = None
+        if self.request_governor:
+            governor_options = self.request_governor.get_options(num_processes)
+        job_pool = Pool(num_processes,
+                        _init_scheduler_worker,
+                        (self.__class__,
+                         (self.dataset_engine.endpoint, self.dataset_engine.apikey),
+                         self.manager_options,
+                         governor_options,
+                         self.metrics.enabled))
+        results = []
+        try:
+            for job, result in job_pool.imap_unordered(_scheduled_upload_job, jobs):
+                results.append((job, result))
+                self.hash_manifest.update(result.pop('hash_entries'))
+                for event in result.pop('metrics_events'):
+                    self.metrics.record(event['stage'], event['seconds'], event['bytes'],
+                                        event['resource'], event['error'])
+                if result['error']:
+                    print "Upload of", job['key'], "failed:", result['error']
+                    continue
+                journal.record(job['key'],
+                               size=job['size'],
+                               mtime=job['mtime'],
+                               resource_id=result['resource_info']['result']['id'] \
+                                           if result['resource_info'] else None,
+                               skipped=result['skipped'])
+            job_pool.close()
+        except:
+            job_pool.terminate()
+            raise
+        finally:
+            job_pool.join()
+            journal.close()
+            self.hash_manifest.save()
+        print "%s datasets uploaded" % len([result for job, result in results \
+                                            if not result['error'] and not result['skipped']])
+        return results
+
+    def get_recent_run_index(self, watershed, subbasin, num_days=6, fields=None):
+        """
+        This function finds the forecast runs for the watershed and subbasin
+        within num_days with one search and returns a list of (run date,
+        dataset info) sorted newest first. If fields is set, only those
+        dataset fields are returned. Returns None if the search failed
+        """
+        name_prefix = '%s-%s-%s-' % (self.model_name, watershed.lower(), subbasin.lower())
+        if fields:
+            datasets = self.search_datasets_by_prefix(name_prefix, num_days, fl=fields)
+        else:
+            datasets = self.search_datasets_by_prefix(name_prefix, num_days)
+        if datasets is None:
+            return None
+        date_compare = datetime.datetime.utcnow() - datetime.timedelta(days=num_days)
+        run_index = []
+        for dataset in datasets:
+            try:
+                run_date = datetime.datetime.strptime(dataset['name'][len(name_prefix):], "%Y%m%dt%H")
+            except ValueError:
+                continue
+            if run_date >= date_compare:
+                run_index.append((run_date, dataset))
+        return sorted(run_index, key=lambda run: run[0], reverse=True)
+
+    def is_run_ready(self, forecast_count, warning_point_count):
+        """
+        This function checks if a forecast run has all 52 ensembles and
+        either no warning points or all of them (a warning points pack
+        counts once for each of its return periods)
+        """
+        if warning_point_count > 0 and warning_point_count < 3:
+            return False
+        return forecast_count >= 52
+
+    def get_dataset_readiness(self, dataset_info):
+        """
+        This function checks if the forecast run of the dataset is ready to
+        download. Only the num_resources and metadata_modified fields are
+        needed; the resource list is fetched if the dataset changed since it
+        was last checked and has enough resources to be ready, or few enough
+        to be a run uploaded as an ensemble bundle
+        """
+        metadata_modified = dataset_info.get('metadata_modified')
+        readiness = self.readiness_state.get(dataset_info['name'])
+        if readiness and metadata_modified and readiness['metadata_modified'] == metadata_modified:
+            return readiness['ready']
+
+        forecast_count = 0
+        warning_point_count = 0
+        if dataset_info['num_resources'] >= 52 or \
+                0 < dataset_info['num_resources'] <= self.bundle_resource_limit:
+            resources = dataset_info.get('resources')
+            if resources is None:
+                #the cached list may be older than metadata_modified
+                self.metadata_cache.invalidate(('resources', dataset_info['id']))
+                resources = self.get_dataset_resources(dataset_info['id'])
+            for resource in resources:
+                if resource.get('ensembles'):
+                    #ensemble bundle
+                    forecast_count += len(resource['ensembles'].split(","))
+                elif resource.get('return_periods'):
+                    #warning points pack
+                    warning_point_count += len(resource['return_periods'].split(","))
+                elif "warning_points" in resource['name']:
+                    warning_point_count += 1
+                else:
+                    forecast_count += 1
+        ready = self.is_run_ready(forecast_count, warning_point_count)
+        self.readiness_state.set(dataset_info['name'], {'metadata_modified': metadata_modified,
+                                                        'num_resources': dataset_info['num_resources'],
+                                                        'forecast_count': forecast_count,
+                                                        'warning_point_count': warning_point_count,
+                                                        'ready': ready})
+        self.readiness_state.save()
+        return ready
+
+    def get_run_readiness(self, watershed, subbasin, num_days=6):
+        """
+        This function finds the forecast runs for the watershed and subbasin
+        within num_days with a search for the lightweight dataset fields and
+        yields (run date, dataset info, ready) newest first
+        """
+        run_index = self.get_recent_run_index(watershed, subbasin, num_days, self.readiness_fields)
+        if run_index is None:
+            #fall back to looking up each run if the search failed
+            run_index = self.probe_recent_runs(watershed, subbasin)
+        for run_date, dataset_info in run_index:
+            yield run_date, dataset_info, self.get_dataset_readiness(dataset_info)
+
+    def probe_recent_runs(self, watershed, subbasin, num_probes=12):
+        """
+        This function looks up the forecast runs every 12 hours back
+        from now and yields (run date, dataset info) for those found
+        """
+        today_datetime = datetime.datetime.utcnow()
+        for iteration in range(num_probes):
+            today =  today_datetime - datetime.timedelta(seconds=iteration*12*60*60)
+            hour = '1200' if today.hour > 11 else '0'
+            self.initialize_run_ecmwf(watershed, subbasin, '%s.%s' % (today.strftime("%Y%m%d"), hour))
+            dataset_info = self.get_dataset_info()
+            if dataset_info:
+                yield self.date, dataset_info
+
     def download_recent_resource(self, watershed, subbasin, main_extract_directory):
         """
         This function downloads the most recent resource within 6 days
         """
-        iteration = 0
         download_file = False
         today_datetime = datetime.datetime.utcnow()
-        #search for datasets within the last 6 days
-        while not download_file and iteration < 12:
-            today =  today_datetime - datetime.timedelta(seconds=iteration*12*60*60)
-            hour = '1200' if today.hour > 11 else '0'
-            date_string = '%s.%s' % (today.strftime("%Y%m%d"), hour)
-            
+        for run_date, dataset_info, dataset_ready in self.get_run_readiness(watershed, subbasin):
+            if not main_extract_directory or not os.path.exists(main_extract_directory):
+                break
+            date_string = '%s.%s' % (run_date.strftime("%Y%m%d"), '1200' if run_date.hour > 11 else '0')
             self.initialize_run_ecmwf(watershed, subbasin, date_string)
-            #get list of all resources
-            dataset_info = self.get_dataset_info()
-            if dataset_info and main_extract_directory and os.path.exists(main_extract_directory):
-                #check if forecast is ready to be downloaded
-                forecast_count = 0
-                warning_point_count = 0
-                if dataset_info['num_resources'] >= 52:
-                    for resource in dataset_info['resources']:
-                        if "warning_points" in resource['name']:
-                            warning_point_count += 1
-                        else:
-                           forecast_count += 1
-                dataset_ready = dataset_info['num_resources'] >= 52
-                if warning_point_count > 0 and warning_point_count < 3:
-                    dataset_ready = False
-                if forecast_count < 52:
-                    dataset_ready = False
-
-                #make sure there are at least 52 or at lest a day has passed before downloading
-                if dataset_ready or (today_datetime-today >= datetime.timedelta(1)):
-                    extract_directory = os.path.join(main_extract_directory, self.watershed, self.subbasin, date_string)
-                    download_file = self.download_resource_from_info(extract_directory,
-                                                     dataset_info['resources'])
-
-            iteration += 1
-                    
+
+            #make sure there are at least 52 or at lest a day has passed before downloading
+            if dataset_ready or (today_datetime-run_date >= datetime.timedelta(1)):
+                extract_directory = os.path.join(main_extract_directory, self.watershed, self.subbasin, date_string)
+                #interrupted downloads leave .part files that are resumed below
+                if os.path.exists(extract_directory) and not glob(os.path.join(extract_directory, "*.part")):
+                    print "Recent resource exists locally. Skipping ..."
+                    return
+                resources = dataset_info.get('resources')
+                if resources is None:
+                    resources = self.get_dataset_resources(dataset_info['id'])
+                download_file = self.download_resource_from_info(extract_directory, resources)
+                if download_file:
+                    return
+
         if not download_file:
             print "Recent resources not found. Skipping ..."
                                       
@@ -496,14 +3729,15 @@ class WRFHydroHRRRDatasetManager(CKANDatasetManager):
     This class is used to find and download, zip and upload ECMWFRAPID 
     prediction files from/to a data server
     """
-    def __init__(self, engine_url, api_key):
+    def __init__(self, engine_url, api_key, **kwargs):
         super(WRFHydroHRRRDatasetManager, self).__init__(engine_url, 
                                                         api_key,
                                                         'wrfp',
                                                         "WRF-Hydro HRRR Flood Predicition Dataset",
                                                         'This dataset contians NetCDF3 files produced by '
                                                         'downscalsing WRF-Hydro forecasts and routing them with RAPID',
-                                                        "%Y%m%dT%H%MZ"
+                                                        "%Y%m%dT%H%MZ",
+                                                        **kwargs
                                                         )
           
     def zip_upload_resource(self, source_file, watershed, subbasin):
@@ -518,23 +3752,67 @@ class WRFHydroHRRRDatasetManager(CKANDatasetManager):
         self.zip_upload_file(source_file)
 
 
+    def get_recent_run_index(self, watershed, subbasin, num_hours=24):
+        """
+        This function finds the forecast runs for the watershed and subbasin
+        within num_hours with one search and returns a list of (run date,
+        resource info) sorted newest first. Returns None if the search failed
+        """
+        name_prefix = '%s-%s-%s-' % (self.model_name, watershed.lower(), subbasin.lower())
+        datasets = self.search_datasets_by_prefix(name_prefix, num_hours/24 + 1)
+        if datasets is None:
+            return None
+        date_compare = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0) - \
+                       datetime.timedelta(hours=num_hours-1)
+        run_index = []
+        for dataset in datasets:
+            for resource in dataset.get('resources', []):
+                if not resource['name'].startswith(name_prefix):
+                    continue
+                try:
+                    run_date = datetime.datetime.strptime(resource['name'][len(name_prefix):],
+                                                          self.date_format_string)
+                except ValueError:
+                    continue
+                if run_date >= date_compare:
+                    run_index.append((run_date, resource))
+        return sorted(run_index, key=lambda run: run[0], reverse=True)
+
+    def probe_recent_runs(self, watershed, subbasin, num_probes=24):
+        """
+        This function looks up the forecast runs every hour back
+        from now and yields (run date, resource info) for those found
+        """
+        today_datetime = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        for iteration in range(num_probes):
+            today =  today_datetime - datetime.timedelta(seconds=iteration*60*60)
+            self.initialize_run(watershed, subbasin, today.strftime(self.date_format_string))
+            resource_info = self.get_resource_info()
+            if resource_info:
+                yield today, resource_info
+
     def download_recent_resource(self, watershed, subbasin, main_extract_directory):
         """
         This function downloads the most recent resource within 1 day
         """
-        iteration = 0
         download_file = False
-        today_datetime = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-        #search for datasets within the last day
-        while not download_file and iteration < 24:
-            today =  today_datetime - datetime.timedelta(seconds=iteration*60*60)
-            date_string = today.strftime(self.date_format_string)
+        run_index = self.get_recent_run_index(watershed, subbasin)
+        if run_index is None:
+            #fall back to looking up each run if the search failed
+            run_index = self.probe_recent_runs(watershed, subbasin)
+        for run_date, resource_info in run_index:
+            if not main_extract_directory or not os.path.exists(main_extract_directory):
+                break
+            date_string = run_date.strftime(self.date_format_string)
             self.initialize_run(watershed, subbasin, date_string)
-            resource_info = self.get_resource_info()
-            if resource_info and main_extract_directory and os.path.exists(main_extract_directory):
-                extract_directory = os.path.join(main_extract_directory, self.watershed, self.subbasin)
-                download_file = self.download_resource(extract_directory, "RapidResult_%s_CF.nc" % date_string)
-            iteration += 1
+            extract_directory = os.path.join(main_extract_directory, self.watershed, self.subbasin)
+            local_file = "RapidResult_%s_CF.nc" % date_string
+            if os.path.exists(os.path.join(extract_directory, local_file)):
+                print "Recent resource exists locally. Skipping ..."
+                return
+            download_file = self.download_resource_from_info(extract_directory, [resource_info], local_file)
+            if download_file:
+                return
                     
         if not download_file:
             print "Recent resources not found. Skipping ..."
@@ -547,12 +3825,13 @@ class RAPIDInputDatasetManager(CKANDatasetManager):
     This class is used to find and download, zip and upload ECMWFRAPID 
     prediction files from/to a data server
     """
-    def __init__(self, engine_url, api_key, model_name, app_instance_id):
+    def __init__(self, engine_url, api_key, model_name, app_instance_id, **kwargs):
         super(RAPIDInputDatasetManager, self).__init__(engine_url, 
                                                         api_key,
                                                         model_name,
                                                         "RAPID Input Dataset for %s" % model_name,
-                                                        'This dataset contians RAPID files for %s' % model_name)
+                                                        'This dataset contians RAPID files for %s' % model_name,
+                                                        **kwargs)
         self.app_instance_id = app_instance_id
         self.dataset_name = '%s-rapid-input-%s' % (self.model_name, self.app_instance_id)
 
@@ -596,62 +3875,273 @@ class RAPIDInputDatasetManager(CKANDatasetManager):
         self.initialize_run(watershed, subbasin)
         resource_info = self.upload_resource(upload_file, 
                                              True,
-                                             '.zip')
+                                             '.zip',
+                                             self.get_source_hash([upload_file]))
         os.remove(upload_file)
         return resource_info
         
+    def get_sync_manifest_path(self, extract_directory):
+        """
+        This function returns the path to the manifest of the resources
+        synced into the directory
+        """
+        return os.path.join(extract_directory, ".sync_manifest.json")
+
+    def load_sync_manifest(self, extract_directory):
+        """
+        This function loads the sync manifest of the directory
+        """
+        manifest_file = self.get_sync_manifest_path(extract_directory)
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file) as manifest:
+                    return json.load(manifest)
+            except ValueError:
+                print "Invalid sync manifest", manifest_file, "Ignoring ..."
+        return {}
+
+    def save_sync_manifest(self, extract_directory, sync_manifest):
+        """
+        This function atomically saves the sync manifest of the directory
+        """
+        manifest_file = self.get_sync_manifest_path(extract_directory)
+        temp_manifest_file = "%s.%s.tmp" % (manifest_file, uuid.uuid4().hex)
+        with open(temp_manifest_file, 'w') as manifest:
+            json.dump(sync_manifest, manifest)
+        os.rename(temp_manifest_file, manifest_file)
+
+    def get_sync_entry(self, ckan_resource, folder):
+        """
+        This function returns the sync manifest entry of a resource
+        """
+        return {'id': ckan_resource.get('id'),
+                'created': ckan_resource.get('created'),
+                'hash': ckan_resource.get('hash') or ckan_resource.get('source_hash'),
+                'folder': folder}
+
+    def is_synced(self, sync_entry, ckan_resource):
+        """
+        This function checks if the local copy in the manifest entry
+        matches the resource on CKAN
+        """
+        if not sync_entry or sync_entry.get('id') != ckan_resource.get('id'):
+            return False
+        ckan_hash = ckan_resource.get('hash') or ckan_resource.get('source_hash')
+        return not ckan_hash or sync_entry.get('hash') == ckan_hash
+
+    def sync_resource(self, ckan_resource, extract_directory, folder):
+        """
+        This function downloads a resource into a temporary folder and
+        swaps it in place of the local folder when complete
+        """
+        local_directory = os.path.join(extract_directory, folder)
+        #named by resource id so interrupted downloads resume on the next sync
+        temp_directory = os.path.join(extract_directory, ".%s.%s.tmp" % (folder, ckan_resource['id']))
+        old_directory = os.path.join(extract_directory, ".%s.%s.old" % (folder, uuid.uuid4().hex))
+        try:
+            os.makedirs(temp_directory)
+        except OSError:
+            pass
+        if not self.download_and_extract_resource(ckan_resource, temp_directory):
+            rmtree(temp_directory)
+            return False
+        if os.path.exists(local_directory):
+            os.rename(local_directory, old_directory)
+        os.rename(temp_directory, local_directory)
+        if os.path.exists(old_directory):
+            rmtree(old_directory)
+        return True
+
+    def _sync_resource_status(self, sync_job):
+        """
+        This function syncs one resource and returns its status
+        """
+        ckan_resource, extract_directory, folder = sync_job
+        status = {'key': (ckan_resource['watershed'].lower(), ckan_resource['subbasin'].lower()),
+                  'resource': ckan_resource,
+                  'folder': folder,
+                  'downloaded': False,
+                  'error': None}
+        try:
+            status['downloaded'] = self.sync_resource(ckan_resource, extract_directory, folder)
+        except Exception, ex:
+            status['error'] = ex
+        return status
+
     def sync_dataset(self, extract_directory):
         """
-        This function syncs the dataset with the directory
+        This function syncs the dataset with the directory. Only resources
+        that are new or changed since the last sync are downloaded
         """
-        # Use the json module to load CKAN's response into a dictionary.
         dataset_info = self.get_dataset_info()
-        if dataset_info:
-            #get list of resources on CKAN
-            current_ckan_resources = [d for d in dataset_info['resources'] \
-                                      if 'watershed' in d and 'subbasin' in d]
-
-            #get list of watersheds and subbasins on local instance
-            current_local_resources = []
-            rapid_input_folders = [d for d in os.listdir(extract_directory) \
-                                   if os.path.isdir(os.path.join(extract_directory, d))]
-    
-            for rapid_input_folder in rapid_input_folders:
-                input_folder_split = rapid_input_folder.split("-")
-                try:
-                    subbasin = input_folder_split[1]
-                except IndexError:
-                    subbasin = ""
-                    pass
-                current_local_resources.append({'watershed': input_folder_split[0],
-                                                'subbasin': subbasin,
-                                                'folder': rapid_input_folder
-                                                })
-
-            date_compare = datetime.datetime.utcnow()-datetime.timedelta(hours=12, minutes=30)
-            #STEP 1: Remove resources no longer on CKAN or update local resource
-            for local_resource in current_local_resources:
-                ckan_resource = [d for d in current_ckan_resources if \
-                                    (d['watershed'].lower() == local_resource['watershed'].lower()) and \
-                                    d['subbasin'].lower() == local_resource['subbasin'].lower()]
-
-                local_directory = os.path.join(extract_directory, local_resource['folder'])
-                if not ckan_resource:
-                    #remove resources no longer on CKAN
-                    print "LOCAL DELETE", local_resource['watershed'], local_resource['subbasin']
-                    rmtree(local_directory)
-                elif datetime.datetime.strptime(ckan_resource[0]['created'].split(".")[0], "%Y-%m-%dT%H:%M:%S") > date_compare:
-                    #2015-05-12T14:01:08.572338
-                    #remove out of date local resources
-                    print "LOCAL PAST DELETE", local_resource['watershed'], local_resource['subbasin']
-                    rmtree(local_directory)
-            
-            #STEP 2: Add new resources to local instance if not already here
-            for ckan_resource in current_ckan_resources:         
-                print "ATTEMPT DOWNLOAD", ckan_resource['watershed'], ckan_resource['subbasin']
-                self.download_model_resource(ckan_resource,
-                                             os.path.join(extract_directory, "%s-%s" % (ckan_resource['watershed'],
-                                                                                        ckan_resource['subbasin'])))
+        if not dataset_info:
+            return
+
+        #index resources on CKAN by watershed and subbasin
+        ckan_index = {}
+        for ckan_resource in dataset_info['resources']:
+            if 'watershed' in ckan_resource and 'subbasin' in ckan_resource:
+                key = (ckan_resource['watershed'].lower(), ckan_resource['subbasin'].lower())
+                if key not in ckan_index or \
+                        ckan_resource.get('created', '') > ckan_index[key].get('created', ''):
+                    ckan_index[key] = ckan_resource
+
+        #index local folders by watershed and subbasin
+        try:
+            os.makedirs(extract_directory)
+        except OSError:
+            pass
+        local_index = {}
+        work_directories = []
+        for rapid_input_folder in os.listdir(extract_directory):
+            if not os.path.isdir(os.path.join(extract_directory, rapid_input_folder)):
+                continue
+            if rapid_input_folder.startswith("."):
+                work_directories.append(rapid_input_folder)
+                continue
+            input_folder_split = rapid_input_folder.split("-")
+            try:
+                subbasin = input_folder_split[1]
+            except IndexError:
+                subbasin = ""
+            local_index[(input_folder_split[0].lower(), subbasin.lower())] = rapid_input_folder
+
+        sync_manifest = self.load_sync_manifest(extract_directory)
+        date_compare = datetime.datetime.utcnow()-datetime.timedelta(hours=12, minutes=30)
+
+        #STEP 1: Remove resources no longer on CKAN
+        for key, local_folder in local_index.items():
+            if key not in ckan_index:
+                print "LOCAL DELETE", key[0], key[1]
+                rmtree(os.path.join(extract_directory, local_folder))
+                sync_manifest.pop("%s-%s" % key, None)
+                del local_index[key]
+
+        #STEP 2: Find new or changed resources on CKAN
+        sync_jobs = []
+        for key, ckan_resource in ckan_index.items():
+            manifest_key = "%s-%s" % key
+            local_folder = local_index.get(key)
+            if local_folder:
+                if self.is_synced(sync_manifest.get(manifest_key), ckan_resource):
+                    continue
+                if manifest_key not in sync_manifest and \
+                        datetime.datetime.strptime(ckan_resource['created'].split(".")[0], "%Y-%m-%dT%H:%M:%S") <= date_compare:
+                    #adopt folders synced before the manifest existed
+                    sync_manifest[manifest_key] = self.get_sync_entry(ckan_resource, local_folder)
+                    continue
+            else:
+                local_folder = "%s-%s" % (ckan_resource['watershed'], ckan_resource['subbasin'])
+            print "ATTEMPT DOWNLOAD", ckan_resource['watershed'], ckan_resource['subbasin']
+            sync_jobs.append((ckan_resource, extract_directory, local_folder))
+
+        #remove work folders left behind by older syncs
+        current_work_directories = [".%s.%s.tmp" % (sync_job[2], sync_job[0]['id']) \
+                                    for sync_job in sync_jobs]
+        for work_directory in work_directories:
+            if (work_directory.endswith(".tmp") or work_directory.endswith(".old")) and \
+                    work_directory not in current_work_directories:
+                rmtree(os.path.join(extract_directory, work_directory))
+
+        #STEP 3: Download new or changed resources
+        if self.download_workers > 1 and len(sync_jobs) > 1:
+            sync_pool = ThreadPool(min(self.download_workers, len(sync_jobs)))
+            try:
+                sync_statuses = sync_pool.map(self._sync_resource_status, sync_jobs)
+            finally:
+                sync_pool.close()
+                sync_pool.join()
+        else:
+            sync_statuses = [self._sync_resource_status(sync_job) for sync_job in sync_jobs]
+
+        for status in sync_statuses:
+            if status['error']:
+                print "DOWNLOAD FAILED", status['key'][0], status['key'][1], status['error']
+            elif status['downloaded']:
+                sync_manifest["%s-%s" % status['key']] = self.get_sync_entry(status['resource'],
+                                                                              status['folder'])
+        self.save_sync_manifest(extract_directory, sync_manifest)
+        return sync_statuses
+
+#------------------------------------------------------------------------------
+#Concurrent Dataset Manager Class
+#------------------------------------------------------------------------------
+def _run_concurrent_call(run_manager, method_name, args, kwargs, pending):
+    """
+    Runs one dataset manager call for ConcurrentDatasetManager
+    """
+    try:
+        return getattr(run_manager, method_name)(*args, **kwargs)
+    finally:
+        pending.release()
+
+class ConcurrentDatasetManager(object):
+    """
+    This class runs operations of a dataset manager (or one of its
+    subclasses) for many watersheds at once on an executor of num_workers
+    threads. Any method of the wrapped manager can be called and returns
+    an AsyncResult. Each call runs on a copy of the manager so calls do not
+    share run state, so use methods that take the watershed and subbasin
+    such as zip_upload_resource, download_recent_resource or sync_dataset.
+    The copies share the thread safe HTTP connection pool, metadata cache,
+    hash manifest and request governor. At most max_pending calls are
+    queued or running at once; further calls block until one finishes
+    """
+    def __init__(self, dataset_manager, num_workers=8, max_pending=None):
+        self.dataset_manager = dataset_manager
+        self.pool = ThreadPool(num_workers)
+        self.pending = threading.BoundedSemaphore(max_pending or 2*num_workers)
+
+    def submit(self, method_name, *args, **kwargs):
+        """
+        This function queues a call to a method of the dataset manager
+        and returns an AsyncResult
+        """
+        if method_name.startswith('initialize_run'):
+            #the run would only be set on the copy of the call
+            raise AttributeError("%s cannot be called concurrently" % method_name)
+        method = getattr(self.dataset_manager, method_name)
+        if method_name.startswith('_') or not callable(method):
+            raise AttributeError("%s is not a dataset manager method" % method_name)
+        self.pending.acquire()
+        try:
+            return self.pool.apply_async(_run_concurrent_call,
+                                         (copy.copy(self.dataset_manager), method_name,
+                                          args, kwargs, self.pending))
+        except:
+            self.pending.release()
+            raise
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(self.dataset_manager, name)):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.submit(name, *args, **kwargs)
+
+    def wait(self, async_results):
+        """
+        This function waits for the calls to finish and returns a list of
+        (result, error) for each of them
+        """
+        results = []
+        for async_result in async_results:
+            try:
+                results.append((async_result.get(), None))
+            except Exception, ex:
+                results.append((None, ex))
+        return results
+
+    def close(self):
+        """
+        This function waits for queued calls and stops the workers
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 if __name__ == "__main__":
@@ -664,10 +4154,25 @@ if __name__ == "__main__":
     """
     er_manager = ECMWFRAPIDDatasetManager(engine_url, api_key)
     er_manager.zip_upload_resources(source_directory='/home/alan/work/rapid/output/')
+    er_manager.watch_upload_resources(source_directory='/home/alan/work/rapid/output/',
+                                      journal_file='/home/alan/work/rapid/upload_journal.jsonl')
+    er_manager.zip_upload_resources(source_directory='/home/alan/work/rapid/output/',
+                                    num_processes=4,
+                                    journal_file='/home/alan/work/rapid/upload_journal.jsonl')
     er_manager.download_prediction_resource(watershed='magdalena', 
                                             subbasin='el_banco', 
                                             date_string='20150505.0', 
                                             extract_directory='/home/alan/work/rapid/output/magdalena/20150505.0')
+    er_manager.download_ensembles(watershed='magdalena',
+                                  subbasin='el_banco',
+                                  date_string='20150505.0',
+                                  extract_directory='/home/alan/work/rapid/output/magdalena/20150505.0',
+                                  ensembles=[52])
+    er_manager.download_warning_points(watershed='magdalena',
+                                       subbasin='el_banco',
+                                       date_string='20150505.0',
+                                       extract_directory='/home/alan/work/rapid/warning_points',
+                                       return_periods=[10, 20])
     er_manager.download_recent_resource(watershed="rio_yds", 
                                         subbasin="palo_alto", 
                                         main_extract_directory='/home/alan/tethysdev/tethysapp-erfp_tool/ecmwf_rapid_predictions' )
@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import FakeCKANServer
+
+
+@pytest.fixture
+def fake_ckan():
+    server = FakeCKANServer().start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,69 @@
+import datetime
+import os
+import threading
+import time
+
+import pytest
+
+from dataset_manager import ConcurrentDatasetManager, WRFHydroHRRRDatasetManager
+
+WATERSHEDS = ['watershed_%s' % watershed_index for watershed_index in range(4)]
+
+
+def make_source_files(tmpdir):
+    date_string = (datetime.datetime.utcnow() - datetime.timedelta(hours=1)).strftime("%Y%m%dT%H00Z")
+    source_files = []
+    for watershed in WATERSHEDS:
+        source_file = tmpdir.mkdir(watershed).join('RapidResult_%s_CF.nc' % date_string)
+        source_file.write(os.urandom(10000), 'wb')
+        source_files.append(str(source_file))
+    return source_files
+
+
+def test_uploads_and_downloads_run_concurrently(fake_ckan, tmpdir):
+    source_files = make_source_files(tmpdir)
+    fake_ckan.state.latency = 0.2
+    manager = WRFHydroHRRRDatasetManager(fake_ckan.url, 'key')
+    start_time = time.time()
+    with ConcurrentDatasetManager(manager, num_workers=4) as concurrent_manager:
+        results = concurrent_manager.wait([concurrent_manager.zip_upload_resource(source_file, watershed, 'subbasin')
+                                           for source_file, watershed in zip(source_files, WATERSHEDS)])
+    seconds = time.time() - start_time
+    assert [error for result, error in results] == [None]*len(WATERSHEDS)
+    assert len(fake_ckan.state.datasets) == len(WATERSHEDS)
+    #each upload makes at least three API calls
+    assert seconds < 3*0.2*len(WATERSHEDS)
+
+    extract_directory = tmpdir.mkdir('out')
+    with ConcurrentDatasetManager(manager, num_workers=4) as concurrent_manager:
+        results = concurrent_manager.wait([concurrent_manager.download_recent_resource(watershed, 'subbasin',
+                                                                                       str(extract_directory))
+                                           for watershed in WATERSHEDS])
+    assert [error for result, error in results] == [None]*len(WATERSHEDS)
+    for source_file, watershed in zip(source_files, WATERSHEDS):
+        assert os.listdir(str(extract_directory.join(watershed, 'subbasin'))) == [os.path.basename(source_file)]
+
+
+def test_pending_calls_are_limited(fake_ckan):
+    manager = WRFHydroHRRRDatasetManager(fake_ckan.url, 'key')
+    release_event = threading.Event()
+    manager.wait_for_release = release_event.wait
+    concurrent_manager = ConcurrentDatasetManager(manager, num_workers=1, max_pending=2)
+    concurrent_manager.submit('wait_for_release')
+    concurrent_manager.submit('wait_for_release')
+    submitted = []
+    submit_thread = threading.Thread(target=lambda: submitted.append(concurrent_manager.submit('wait_for_release')))
+    submit_thread.start()
+    submit_thread.join(0.2)
+    assert not submitted
+    release_event.set()
+    submit_thread.join(5)
+    assert submitted
+    concurrent_manager.close()
+
+
+def test_run_state_cannot_be_set_concurrently(fake_ckan):
+    manager = WRFHydroHRRRDatasetManager(fake_ckan.url, 'key')
+    with ConcurrentDatasetManager(manager) as concurrent_manager:
+        with pytest.raises(AttributeError):
+            concurrent_manager.initialize_run('watershed', 'subbasin', '20150405T2300Z')
@@ -0,0 +1,32 @@
+import threading
+
+import dataset_daemon
+from dataset_daemon import DaemonOperation, DatasetDaemon
+from dataset_manager import ECMWFRAPIDDatasetManager
+
+
+def test_flights_waiting_for_a_path_do_not_hold_workers(fake_ckan, tmpdir, monkeypatch):
+    release = threading.Event()
+    calls = []
+    def write_path(manager, path, block=False):
+        calls.append(path)
+        if block:
+            assert release.wait(10)
+        return path
+    monkeypatch.setattr(ECMWFRAPIDDatasetManager, 'write_path', write_path, raising=False)
+    monkeypatch.setitem(dataset_daemon.DAEMON_OPERATIONS, 'test/write',
+                        DaemonOperation('ecmwf', 'write_path', ('path',), ('block',),
+                                        lambda params: params['path']))
+    busy_path = str(tmpdir.join('busy'))
+    free_path = str(tmpdir.join('free'))
+    daemon = DatasetDaemon(fake_ckan.url, 'key', num_workers=2)
+    running_flight = daemon.submit('test/write', {'path': busy_path, 'block': True})[0]
+    queued_flight = daemon.submit('test/write', {'path': busy_path})[0]
+    other_flight = daemon.submit('test/write', {'path': free_path})[0]
+    #the other path runs on the second worker while the first path is busy
+    assert other_flight.wait(5)
+    assert queued_flight.get_info()['status'] == 'queued'
+    release.set()
+    assert running_flight.wait(5) and queued_flight.wait(5)
+    assert calls == [busy_path, free_path, busy_path]
+    assert not daemon.path_queues.queues
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from dataset_manager import WRFHydroHRRRDatasetManager
+
+DATE_STRING = '20150405T2300Z'
+
+
+def upload_source_file(server, tmpdir, file_size=300000):
+    source_directory = tmpdir.mkdir('source')
+    source_directory.join('RapidResult_%s_CF.nc' % DATE_STRING).write(os.urandom(file_size), 'wb')
+    manager = WRFHydroHRRRDatasetManager(server.url, 'key')
+    manager.initialize_run('watershed', 'subbasin', DATE_STRING)
+    manager.zip_upload_directory(str(source_directory))
+    return source_directory
+
+
+def download(server, extract_directory, **kwargs):
+    manager = WRFHydroHRRRDatasetManager(server.url, 'key', **kwargs)
+    manager.initialize_run('watershed', 'subbasin', DATE_STRING)
+    return manager.download_resource(str(extract_directory))
+
+
+def get_partial_files(extract_directory):
+    return [file_name for file_name in os.listdir(str(extract_directory)) if file_name.endswith('.part')]
+
+
+def test_truncated_body_is_resumed(fake_ckan, tmpdir):
+    upload_source_file(fake_ckan, tmpdir)
+    fake_ckan.state.truncate_downloads = 1
+    extract_directory = tmpdir.join('out')
+    assert download(fake_ckan, extract_directory)
+    assert fake_ckan.state.request_counts['download'] == 2
+    assert os.listdir(str(extract_directory)) == ['RapidResult_%s_CF.nc' % DATE_STRING]
+
+
+def test_truncated_body_is_resumed_on_next_call(fake_ckan, tmpdir):
+    upload_source_file(fake_ckan, tmpdir)
+    fake_ckan.state.truncate_downloads = 1
+    extract_directory = tmpdir.join('out')
+    assert not download(fake_ckan, extract_directory, download_retries=0)
+    partial_files = get_partial_files(extract_directory)
+    assert len(partial_files) == 1
+    assert extract_directory.join(partial_files[0]).size() > 0
+
+    fake_ckan.state.bytes_sent = 0
+    assert download(fake_ckan, extract_directory, download_retries=0)
+    assert os.listdir(str(extract_directory)) == ['RapidResult_%s_CF.nc' % DATE_STRING]
+    #only the missing half was downloaded again
+    assert fake_ckan.state.bytes_sent < fake_ckan.state.files.values()[0].__len__()
+
+
+@pytest.mark.parametrize('stream_download', [False, True])
+def test_checksum_mismatch_is_downloaded_again(fake_ckan, tmpdir, stream_download):
+    source_directory = upload_source_file(fake_ckan, tmpdir)
+    fake_ckan.state.corrupt_downloads = 1
+    extract_directory = tmpdir.join('out')
+    assert not download(fake_ckan, extract_directory, stream_download=stream_download)
+    assert [extract_directory.join(file_name).size() for file_name in get_partial_files(extract_directory)] == [0]
+
+    assert download(fake_ckan, extract_directory, stream_download=stream_download)
+    file_name = 'RapidResult_%s_CF.nc' % DATE_STRING
+    assert os.listdir(str(extract_directory)) == [file_name]
+    assert extract_directory.join(file_name).read('rb') == source_directory.join(file_name).read('rb')
+
+
+def test_interrupted_segmented_download_resumes_missing_segments(fake_ckan, tmpdir):
+    source_directory = upload_source_file(fake_ckan, tmpdir, file_size=400000)
+    archive_size = len(fake_ckan.state.files.values()[0])
+    segment_options = {'download_segments': 4, 'segment_size': 50000, 'segment_threshold': 100000}
+    fake_ckan.state.truncate_downloads = 1
+    extract_directory = tmpdir.join('out')
+    assert not download(fake_ckan, extract_directory, download_retries=0, **segment_options)
+    assert [file_name for file_name in os.listdir(str(extract_directory)) if file_name.endswith('.segments')]
+
+    fake_ckan.state.bytes_sent = 0
+    assert download(fake_ckan, extract_directory, download_retries=0, **segment_options)
+    file_name = 'RapidResult_%s_CF.nc' % DATE_STRING
+    assert os.listdir(str(extract_directory)) == [file_name]
+    assert extract_directory.join(file_name).read('rb') == source_directory.join(file_name).read('rb')
+    #the completed segments were not downloaded again
+    assert fake_ckan.state.bytes_sent < archive_size
+
+
+def test_truncated_segment_is_retried(fake_ckan, tmpdir):
+    source_directory = upload_source_file(fake_ckan, tmpdir, file_size=400000)
+    fake_ckan.state.truncate_downloads = 2
+    extract_directory = tmpdir.join('out')
+    assert download(fake_ckan, extract_directory, download_segments=4,
+                    segment_size=50000, segment_threshold=100000)
+    file_name = 'RapidResult_%s_CF.nc' % DATE_STRING
+    assert os.listdir(str(extract_directory)) == [file_name]
+    assert extract_directory.join(file_name).read('rb') == source_directory.join(file_name).read('rb')
@@ -0,0 +1,35 @@
+import copy
+
+from benchmark import make_ecmwf_tree
+from dataset_manager import ECMWFRAPIDDatasetManager, MetadataCache
+
+
+def test_cached_values_are_copies():
+    metadata_cache = MetadataCache()
+    resources = [{'name': 'resource'}]
+    metadata_cache.set('resources', resources)
+    resources.append({'name': 'changed'})
+    cached_resources = metadata_cache.get('resources')
+    cached_resources[0]['name'] = 'changed'
+    assert metadata_cache.get('resources') == [{'name': 'resource'}]
+
+
+def test_update_does_not_share_values():
+    metadata_cache = MetadataCache()
+    metadata_cache.set('resources', [])
+    resource = {'name': 'resource'}
+    metadata_cache.update('resources', lambda resources: resources + [resource])
+    resource['name'] = 'changed'
+    assert metadata_cache.get('resources') == [{'name': 'resource'}]
+
+
+def test_resource_list_is_fetched_once_per_upload_batch(fake_ckan, tmpdir):
+    source_directory = str(tmpdir.mkdir('source'))
+    make_ecmwf_tree(source_directory, 2, 1, 52, 1000)
+    manager = ECMWFRAPIDDatasetManager(fake_ckan.url, 'key')
+    manager.zip_upload_resources(source_directory)
+    request_counts = copy.deepcopy(fake_ckan.state.request_counts)
+    #52 ensembles and 3 warning points files for each run
+    assert request_counts['resource_create'] == 2*55
+    #one resource list for each dataset
+    assert request_counts.get('package_show', 0) <= 2
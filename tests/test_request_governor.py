@@ -0,0 +1,46 @@
+import os
+import time
+
+from dataset_manager import RequestGovernor, WRFHydroHRRRDatasetManager
+
+DATE_STRING = '20150405T2300Z'
+
+
+def test_throttled_segmented_download_keeps_concurrency(fake_ckan, tmpdir):
+    source_directory = tmpdir.mkdir('source')
+    source_directory.join('RapidResult_%s_CF.nc' % DATE_STRING).write(os.urandom(2*1024*1024), 'wb')
+    manager = WRFHydroHRRRDatasetManager(fake_ckan.url, 'key')
+    manager.initialize_run('watershed', 'subbasin', DATE_STRING)
+    manager.zip_upload_directory(str(source_directory))
+
+    #each segment takes about 2.5 seconds at 200 KB/s
+    fake_ckan.state.bandwidth = 200*1024
+    governor = RequestGovernor(initial_concurrency=4, latency_target=1.0)
+    manager = WRFHydroHRRRDatasetManager(fake_ckan.url, 'key',
+                                         request_governor=governor,
+                                         download_segments=4,
+                                         segment_size=512*1024,
+                                         segment_threshold=1024*1024)
+    manager.initialize_run('watershed', 'subbasin', DATE_STRING)
+    start_time = time.time()
+    assert manager.download_resource(str(tmpdir.join('out')))
+    seconds = time.time() - start_time
+
+    stats = governor.get_stats()
+    assert stats['decreases'] == 0
+    assert stats['concurrency'] >= 4
+    assert stats['in_flight'] == 0
+    #one stream would take about 10 seconds
+    assert seconds < 6
+
+
+def test_slow_headers_decrease_concurrency():
+    governor = RequestGovernor(initial_concurrency=4, latency_target=0.05)
+    governor.call(time.sleep, (0.1,), is_failure=lambda result: False)
+    assert governor.get_stats()['decreases'] == 1
+
+
+def test_uploads_are_not_checked_against_latency_target():
+    governor = RequestGovernor(initial_concurrency=4, latency_target=0.05)
+    governor.call(time.sleep, (0.1,), is_failure=lambda result: False, check_latency=False)
+    assert governor.get_stats()['decreases'] == 0
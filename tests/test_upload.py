@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from benchmark import make_ecmwf_tree
+from dataset_manager import ECMWFRAPIDDatasetManager
+
+
+def get_resource_names(server):
+    return sorted(resource['name'] for dataset in server.state.datasets.values() \
+                  for resource in dataset['resources'])
+
+
+@pytest.mark.parametrize('pack_warning_points', [False, True])
+def test_in_process_upload_matches_scheduler(fake_ckan, tmpdir, pack_warning_points):
+    source_directory = str(tmpdir.mkdir('source'))
+    make_ecmwf_tree(source_directory, 1, 1, 3, 1000)
+    manager = ECMWFRAPIDDatasetManager(fake_ckan.url, 'key', pack_warning_points=pack_warning_points)
+    manager.zip_upload_resources(source_directory)
+    in_process_names = get_resource_names(fake_ckan)
+    assert len([name for name in in_process_names if 'warning_points' in name]) == \
+        (1 if pack_warning_points else 3)
+
+    fake_ckan.state.datasets.clear()
+    manager = ECMWFRAPIDDatasetManager(fake_ckan.url, 'key', pack_warning_points=pack_warning_points)
+    manager.zip_upload_resources(source_directory, num_processes=2,
+                                 journal_file=str(tmpdir.join('journal.jsonl')))
+    assert get_resource_names(fake_ckan) == in_process_names
+
+
+def test_scheduler_bundles_runs_with_fewer_ensembles(fake_ckan, tmpdir):
+    source_directory = str(tmpdir.mkdir('source'))
+    make_ecmwf_tree(source_directory, 1, 1, 3, 1000)
+    manager = ECMWFRAPIDDatasetManager(fake_ckan.url, 'key', bundle_ensembles=True)
+    results = manager.zip_upload_resources(source_directory, num_processes=2)
+    assert [result['error'] for job, result in results] == [None]*len(results)
+    assert [name for name in get_resource_names(fake_ckan) if name.endswith('ensembles')]
+
+
+def test_stream_upload_falls_back_when_chunked_is_rejected(fake_ckan, tmpdir):
+    source_directory = str(tmpdir.mkdir('source'))
+    make_ecmwf_tree(source_directory, 1, 1, 2, 1000)
+    fake_ckan.state.reject_chunked = True
+    manager = ECMWFRAPIDDatasetManager(fake_ckan.url, 'key', stream_upload=True)
+    manager.zip_upload_resources(source_directory)
+    resource_names = get_resource_names(fake_ckan)
+    assert len(resource_names) == 2 + 3
+    assert not manager.stream_upload
+    assert len(fake_ckan.state.files) == len(resource_names)
@@ -0,0 +1,37 @@
+from benchmark import make_ecmwf_tree
+from dataset_manager import ECMWFRAPIDDatasetManager, UploadJournal
+
+
+def test_failed_uploads_stop_after_max_attempts(fake_ckan, tmpdir):
+    source_directory = str(tmpdir.mkdir('source'))
+    make_ecmwf_tree(source_directory, 1, 1, 1, 1000)
+    fake_ckan.state.failed_actions.add('resource_create')
+    manager = ECMWFRAPIDDatasetManager(fake_ckan.url, 'key', pack_warning_points=True)
+    manager.watch_upload_resources(source_directory, str(tmpdir.join('journal.jsonl')),
+                                   poll_interval=0.05, stable_polls=1, max_polls=20,
+                                   max_attempts=3, retry_delay=0)
+    #the ensemble and the warning points pack
+    assert fake_ckan.state.request_counts['resource_create'] == 2*3
+
+
+def test_failed_uploads_back_off(fake_ckan, tmpdir):
+    source_directory = str(tmpdir.mkdir('source'))
+    make_ecmwf_tree(source_directory, 1, 1, 1, 1000)
+    fake_ckan.state.failed_actions.add('resource_create')
+    journal_file = str(tmpdir.join('journal.jsonl'))
+    manager = ECMWFRAPIDDatasetManager(fake_ckan.url, 'key', pack_warning_points=True)
+    manager.watch_upload_resources(source_directory, journal_file,
+                                   poll_interval=0.05, stable_polls=1, max_polls=20,
+                                   retry_delay=60)
+    assert fake_ckan.state.request_counts['resource_create'] == 2
+
+    #the failures are kept across restarts and retried once the backoff is over
+    journal = UploadJournal(journal_file)
+    assert sorted(entry['attempts'] for entry in journal.entries.values()) == [1, 1]
+    for entry in journal.entries.values():
+        entry['retry_time'] = 0
+    journal.compact()
+    journal.close()
+    fake_ckan.state.failed_actions.clear()
+    assert manager.watch_upload_resources(source_directory, journal_file,
+                                          poll_interval=0.05, stable_polls=1, max_polls=2) == 2